@@ -12,10 +12,10 @@ Author:
 import time
 import itertools
 import concurrent.futures 
-from obspy.clients.fdsn.client import Client
 from obspy.core.utcdatetime import UTCDateTime
 
 from .mass_downloader import MassDownloader
+from .mass_downloader import utils
 from obspy.clients.fdsn.mass_downloader import Restrictions
 
 def _run_subprocess(mdl,domain,restriction,
@@ -70,8 +70,22 @@ def process(args):
         pass
 
 class BulkDownloader(object):
-    def __init__(self,client_dict):
+    def __init__(self,client_dict,service_cache=None,
+                requests_per_second=None,megabytes_per_second=None,
+                rate_limit_directory=utils.RATE_LIMIT_DIRECTORY):
         self.client_dict= client_dict
+        if service_cache is None:
+            service_cache = utils.ServiceCache()
+        self.service_cache = service_cache
+        rate_limiter = None
+        if requests_per_second or megabytes_per_second:
+            rate_limiter = utils.RateLimiter(
+                        requests_per_second=requests_per_second,
+                        megabytes_per_second=megabytes_per_second,
+                        directory=rate_limit_directory)
+        self.connection_pool = utils.ConnectionPool(
+                        rate_limiter=rate_limiter)
+        self._client = None
 
     """Concurrent bulk downloader based on obspy's Mass Downloader class.
 
@@ -85,6 +99,21 @@ class BulkDownloader(object):
         {"base_url":"IRIS",
         "user":"gaprietogo@unal.edu.co",
         "password":"DaCgmn3hNjg"}  
+    service_cache: class:'mass_downloader.utils.ServiceCache'
+        On-disk cache of the discovered FDSN services. By default
+        they are kept for one day in the user's cache directory, 
+        so repeated runs skip the service discovery.
+    requests_per_second: float
+        Maximum number of requests per second to the data centre.
+        The limit is shared by all the threads and worker processes.
+    megabytes_per_second: float
+        Maximum bandwidth in MB/s from the data centre. Also
+        shared by all the threads and worker processes.
+    rate_limit_directory: str
+        Directory of the state shared by the rate limits of the
+        threads and worker processes. Only downloaders using the
+        same directory share their limits. By default it is in
+        the user's cache directory.
 
     returns
     -------
@@ -97,11 +126,18 @@ class BulkDownloader(object):
         -------
         client object
             Returns the client object according to the 'base_url' 
-            'user' 'password' client parameters
+            'user' 'password' client parameters. It is only built 
+            once and keeps its connections alive, so all the
+            downloads to the data centre reuse them. Its services
+            come from the service cache if possible.
         """
-        return Client(base_url=self.client_dict["base_url"],
-                    user=self.client_dict["user"],
-                    password=self.client_dict["password"])
+        if self._client is None:
+            self._client = self.service_cache.get_client(
+                        self.client_dict["base_url"],
+                        user=self.client_dict["user"],
+                        password=self.client_dict["password"],
+                        connection_pool=self.connection_pool)
+        return self._client
 
     def _get_stations_info(self,bulk):
 
@@ -138,7 +174,8 @@ class BulkDownloader(object):
 
     def _prepare_args_for_process(self,domain,many_restrictions,
                                     mseed_storage,stationxml_storage):
-        mdl = MassDownloader(providers=[self.client])
+        mdl = MassDownloader(providers=[self.client],
+                            connection_pool=self.connection_pool)
         args = zip(itertools.repeat(mdl), 
             itertools.repeat(domain),
             many_restrictions,
@@ -226,7 +263,8 @@ class BulkDownloader(object):
 
             #Thread mode
             if parallel_mode == "thread":
-                mdl = MassDownloader(providers=[self.client])
+                mdl = MassDownloader(providers=[self.client],
+                            connection_pool=self.connection_pool)
 
                 def subprocess(restriction):
                     _run_subprocess(mdl,domain,restriction,
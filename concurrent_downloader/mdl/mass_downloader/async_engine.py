@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Download engine driving all requests of the mass downloader from a single
+asyncio event loop.
+
+The clients are still downloaded one after the other as their order
+determines which one a station is downloaded from. The event loop replaces
+the threads of a single client, it does not download from several clients
+at once.
+
+Requires `aiohttp <https://docs.aiohttp.org>`_, version 3.12 or later for
+clients with credentials.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2014-2015
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+import asyncio
+import collections
+import random
+import shutil
+import tempfile
+import threading
+from urllib.parse import urlparse
+from urllib.request import HTTPDigestAuthHandler
+
+from obspy.clients.fdsn.client import (FDSNException, get_bulk_string,
+                                       raise_on_error)
+
+from . import utils
+
+# Downloaded MiniSEED data is kept in memory up to this size before it is
+# moved to a temporary file.
+SPOOL_SIZE = 2 ** 25
+
+
+class AsyncDownloadEngine(object):
+    """
+    Runs the MiniSEED and StationXML requests of all clients on one event
+    loop in a background thread.
+
+    Instead of one thread per request, every request is a coroutine and any
+    number of them can be waiting for data at the same time. The number of
+    simultaneous requests is limited per host and per service, so the data
+    centers see the same load as with ``connections_per_host`` threads.
+
+    The methods :meth:`map` and :meth:`apply_async` mimic the ones of
+    :class:`multiprocessing.pool.ThreadPool` but expect coroutine functions.
+    They can be called from any thread.
+
+    Credentials of the clients, given directly or obtained with an EIDA
+    token, are sent with HTTP digest authentication in the same way as by
+    the clients themselves.
+
+    :param connections_per_host: The maximum number of simultaneous
+        requests to each service of a host.
+    :type connections_per_host: int
+    """
+    def __init__(self, connections_per_host=3):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError("The asyncio download engine requires aiohttp. "
+                              "Install it with 'pip install aiohttp'.")
+        self._aiohttp = aiohttp
+        self.connections_per_host = connections_per_host
+        self._semaphores = {}
+        # Digest authentication middleware per set of credentials. They keep
+        # the nonce of the server.
+        self._auth = {}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self._session = self._submit(self._open_session()).result()
+
+    async def _open_session(self):
+        # The limits are enforced by the semaphores - the connector only
+        # keeps the connections alive.
+        connector = self._aiohttp.TCPConnector(limit=0, limit_per_host=0)
+        return self._aiohttp.ClientSession(connector=connector)
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def close(self):
+        """
+        Close all connections and stop the event loop.
+        """
+        if self._loop.is_closed():
+            return
+        self._submit(self._session.close()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def map(self, function, iterable):
+        """
+        Run ``function`` for each item of ``iterable`` concurrently and
+        return the results in order.
+
+        :param function: A coroutine function taking a single argument.
+        """
+        futures = [self._submit(function(_i)) for _i in iterable]
+        return [_i.result() for _i in futures]
+
+    def apply_async(self, function, args=(), callback=None,
+                    error_callback=None):
+        """
+        Schedule ``function(*args)`` and return immediately.
+
+        :param function: A coroutine function.
+        :param callback: Called with the result once it is available.
+        :param error_callback: Called with the exception if one is raised.
+        :returns: A :class:`concurrent.futures.Future`.
+        """
+        future = self._submit(function(*args))
+
+        def done(f):
+            if f.exception() is not None:
+                if error_callback is not None:
+                    error_callback(f.exception())
+            elif callback is not None:
+                callback(f.result())
+
+        future.add_done_callback(done)
+        return future
+
+    def star(self, function, on_error, **kwargs):
+        """
+        Wrap a coroutine function so it can be called with a single tuple of
+        arguments. Additional keyword arguments are passed on. Download
+        errors are passed to ``on_error(args, exception)`` whose return value
+        is returned instead.
+        """
+        async def wrapper(args):
+            try:
+                return await function(*args, **kwargs)
+            except tuple(utils.ERRORS) as e:
+                return on_error(args, e)
+        return wrapper
+
+    def get_auth(self, client):
+        """
+        The middlewares authenticating the requests of a client, empty for
+        clients without credentials.
+
+        Raises a :class:`ValueError` if the client has credentials but the
+        installed aiohttp cannot send them.
+        """
+        credentials = None
+        for handler in client._url_opener.handlers:
+            if isinstance(handler, HTTPDigestAuthHandler):
+                credentials = handler.passwd.find_user_password(
+                    None, client.base_url)
+        if credentials is None or credentials[0] is None:
+            return ()
+        if not hasattr(self._aiohttp, "DigestAuthMiddleware"):
+            raise ValueError(
+                "The asyncio download engine requires aiohttp 3.12 or later "
+                "for clients with credentials. Upgrade aiohttp or use the "
+                "threads engine.")
+        key = (client.base_url,) + tuple(credentials)
+        if key not in self._auth:
+            self._auth[key] = self._aiohttp.DigestAuthMiddleware(
+                login=credentials[0], password=credentials[1])
+        return (self._auth[key],)
+
+    async def _post(self, client, service, data, fh):
+        """
+        Post a bulk request to a service of an FDSN client and write the
+        response to ``fh``.
+
+        Errors are raised in the same way as by the client itself.
+        """
+        if service not in client.services:
+            raise FDSNException("The current client does not have a %s "
+                                "service." % service)
+        url = client._build_url(service, "query")
+        headers = client.request_headers.copy()
+        headers["Content-Type"] = "text/plain"
+        timeout = self._aiohttp.ClientTimeout(
+            total=None, sock_connect=client.timeout,
+            sock_read=client.timeout)
+
+        key = (urlparse(url).netloc, service)
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(
+                self.connections_per_host)
+
+        loop = asyncio.get_running_loop()
+        async with self._semaphores[key]:
+            try:
+                async with self._session.post(
+                        url, data=data, headers=headers, timeout=timeout,
+                        middlewares=self.get_auth(client)) as response:
+                    if response.status != 200:
+                        raise_on_error(response.status,
+                                       await response.read())
+                    # Written in batches by a worker thread as the file
+                    # might be on disk.
+                    blocks = []
+                    size = 0
+                    async for block in response.content.iter_chunked(
+                            utils.READ_BLOCK_SIZE):
+                        blocks.append(block)
+                        size += len(block)
+                        if size >= utils.READ_BLOCK_SIZE:
+                            await loop.run_in_executor(
+                                None, fh.writelines, blocks)
+                            blocks = []
+                            size = 0
+                    if blocks:
+                        await loop.run_in_executor(None, fh.writelines,
+                                                   blocks)
+            except (self._aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise_on_error(None, e)
+
+    async def download_and_split_mseed_bulk(self, client, client_name,
+                                            chunks, logger, file_pool=None,
+                                            qc=None):
+        """
+        Same as :func:`utils.download_and_split_mseed_bulk`. The response is
+        received on the event loop. Splitting it, the QC, and closing the
+        files happen in worker threads.
+        """
+        loop = asyncio.get_running_loop()
+        splitter = utils.MseedBulkSplitter(chunks, file_pool=file_pool,
+                                           qc=qc)
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as fh:
+                await self._post(client, "dataselect",
+                                 get_bulk_string(splitter.bulk, {}), fh)
+                fh.seek(0, 0)
+                await loop.run_in_executor(None, splitter.split, fh)
+        except BaseException:
+            await loop.run_in_executor(None, splitter.discard)
+            raise
+        finally:
+            await loop.run_in_executor(None, splitter.close)
+        logger.info("Client '%s' - Successfully downloaded %i channels (of "
+                    "%i)" % (client_name, len(splitter.written_files),
+                             splitter.original_bulk_length))
+        return sorted(splitter.written_files)
+
+    async def download_and_split_mseed_bulk_with_retry(
+            self, client, client_name, chunks, logger, retries=2,
+            backoff=1.0, **kwargs):
+        """
+        Same as :func:`utils.download_and_split_mseed_bulk_with_retry`. Both
+        halves of a failed request are requested at the same time.
+        """
+        async def download(chunks):
+            for attempt in range(retries + 1):
+                try:
+                    return await self.download_and_split_mseed_bulk(
+                        client, client_name, chunks, logger, **kwargs)
+                except utils.FINAL_ERRORS:
+                    raise
+                except utils.ERRORS as e:
+                    if isinstance(e, utils.SPLIT_ERRORS) or \
+                            attempt == retries:
+                        raise
+                    wait = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                    logger.info("Client '%s' - Request of %i chunks failed. "
+                                "Retrying in %.1f seconds." % (
+                                    client_name, len(chunks), wait))
+                    await asyncio.sleep(wait)
+
+        async def bisect(chunks, error):
+            # The chunks failed as a whole.
+            if len(chunks) < 2 or isinstance(error, utils.FINAL_ERRORS):
+                raise error
+            logger.info("Client '%s' - Request of %i chunks failed. "
+                        "Splitting it." % (client_name, len(chunks)))
+            half = len(chunks) // 2
+            parts = (chunks[:half], chunks[half:])
+            results = await asyncio.gather(
+                *[download(_i) for _i in parts], return_exceptions=True)
+            filenames = []
+            failed = []
+            for part, result in zip(parts, results):
+                if isinstance(result, utils.ERRORS):
+                    failed.append((part, result))
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    filenames.extend(result)
+            for part, e in failed:
+                try:
+                    filenames.extend(await bisect(part, e))
+                except utils.ERRORS as e:
+                    utils.log_mseed_download_error(logger, client_name, e)
+            return filenames
+
+        try:
+            return await download(chunks)
+        except utils.ERRORS as e:
+            return await bisect(chunks, e)
+
+    async def download_stationxml(self, client, client_name, bulk, filename,
+                                  logger):
+        """
+        Same as :func:`utils.download_stationxml`.
+        """
+        network = bulk[0][0]
+        station = bulk[0][1]
+        arguments = collections.OrderedDict(level="response")
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as fh:
+                await self._post(client, "station",
+                                 get_bulk_string(bulk, arguments), fh)
+                await asyncio.get_running_loop().run_in_executor(
+                    None, _copy_to_file, fh, filename)
+        except Exception:
+            logger.info("Failed to download StationXML from '%s' for station "
+                        "'%s.%s'." % (client_name, network, station))
+            return None
+        logger.info("Client '%s' - Successfully downloaded '%s'." %
+                    (client_name, filename))
+        return ((network, station), filename)
+
+
+def _copy_to_file(fh, filename):
+    fh.seek(0, 0)
+    with open(filename, "wb") as out:
+        shutil.copyfileobj(fh, out)
@@ -19,17 +19,20 @@ from future.builtins import *  # NOQA
 import collections
 import copy
 import fnmatch
+import functools
+import heapq
 import itertools
-import sys
+import multiprocessing
 from multiprocessing.pool import ThreadPool
 import os
+import sys
 import time
 import timeit
 
 if sys.version_info.major == 2:
-    from itertools import ifilterfalse as filterfalse
+    import Queue as queue
 else:
-    from itertools import filterfalse
+    import queue
 
 import numpy as np
 
@@ -41,9 +44,17 @@ from obspy.core.util import Enum
 from . import utils
 
 # The current status of an entity.
-STATUS = Enum(["none", "needs_downloading", "downloaded", "ignore", "exists",
-               "download_failed", "download_rejected",
-               "download_partially_failed"])
+_STATUS_NAMES = ["none", "needs_downloading", "downloaded", "ignore",
+                 "exists", "download_failed", "download_rejected",
+                 "download_partially_failed"]
+STATUS = Enum(_STATUS_NAMES)
+
+# The time intervals store their status as small integers.
+_STATUS_CODES = {_i: _j for _j, _i in enumerate(_STATUS_NAMES)}
+
+# Files that were not checked while being split are read by a process pool
+# if there are at least this many of them.
+PARALLEL_QC_THRESHOLD = 1000
 
 
 class _SlotsEqualityComparisionObject(object):
@@ -115,12 +126,9 @@ class Station(_SlotsEqualityComparisionObject):
         "DOWNLOADED" or "EXISTS". Otherwise it returns False meaning it does
         not have to be considered anymore.
         """
-        status = set()
         for chan in self.channels:
-            for ti in chan.intervals:
-                status.add(ti.status)
-        if STATUS.EXISTS in status or STATUS.DOWNLOADED in status:
-            return True
+            if chan.intervals.has_status(STATUS.EXISTS, STATUS.DOWNLOADED):
+                return True
         return False
 
     @property
@@ -129,9 +137,8 @@ class Station(_SlotsEqualityComparisionObject):
         Returns True if any of the station's time intervals already exist.
         """
         for chan in self.channels:
-            for ti in chan.intervals:
-                if ti.status == STATUS.EXISTS:
-                    return True
+            if chan.intervals.has_status(STATUS.EXISTS):
+                return True
         return False
 
     def remove_files(self, logger, reason):
@@ -140,8 +147,8 @@ class Station(_SlotsEqualityComparisionObject):
         downloaded!
         """
         for chan in self.channels:
-            for ti in chan.intervals:
-                if ti.status != STATUS.DOWNLOADED or not ti.filename:
+            for ti in chan.intervals.with_status(STATUS.DOWNLOADED):
+                if not ti.filename:
                     continue
                 if os.path.exists(ti.filename):
                     logger.info("Deleting MiniSEED file '%s'. Reason: %s" % (
@@ -334,7 +341,7 @@ class Station(_SlotsEqualityComparisionObject):
             else:
                 self.stationxml_status = STATUS.IGNORE
 
-    def prepare_mseed_download(self, mseed_storage):
+    def prepare_mseed_download(self, mseed_storage, file_index=None):
         """
         Loop through all channels of the station and distribute filenames
         and the current status of the channel.
@@ -344,35 +351,34 @@ class Station(_SlotsEqualityComparisionObject):
         Possible statuses after method execution are IGNORE, EXISTS, and
         NEEDS_DOWNLOADING.
 
-        :param mseed_storage:
+        Directories for files that need downloading are not created here but
+        only once something is written to them.
+
+        :param mseed_storage: The MiniSEED storage setting.
+        :type mseed_storage: str, function, or
+            :class:`~.utils.MseedStorage`
+        :param file_index: Used for the existence checks. A new one will be
+            created if not given.
+        :type file_index: :class:`~.utils.FileExistenceIndex`
         """
-        by_SDS = mseed_storage.split("{<SDSdir>}:")
-        if len(by_SDS) != 1:
-            sds_format = True
-            sds_root = by_SDS[-1]
-        else:
-            sds_format = False
+        if file_index is None:
+            file_index = utils.FileExistenceIndex()
+        if not isinstance(mseed_storage, utils.MseedStorage):
+            mseed_storage = utils.MseedStorage(mseed_storage)
 
         for channel in self.channels:
-            for interval in channel.intervals:
-                if sds_format ==True:
-                    interval.filename = utils.get_mseed_sdsfilename(
-                    sds_root, self.network, self.station,
-                    channel.location, channel.channel,
-                    interval.start.year,interval.start.julday)
-                else:
-                    interval.filename = utils.get_mseed_filename(
-                        mseed_storage, self.network, self.station,
-                        channel.location, channel.channel, interval.start,
-                        interval.end)
-                if interval.filename is True:
-                    interval.status = STATUS.IGNORE
-                elif os.path.exists(interval.filename):
-                    interval.status = STATUS.EXISTS
-                else:
-                    if not os.path.exists(os.path.dirname(interval.filename)):
-                        os.makedirs(os.path.dirname(interval.filename))
-                    interval.status = STATUS.NEEDS_DOWNLOADING
+            intervals = channel.intervals
+            filenames = mseed_storage.get_filenames(
+                self.network, self.station, channel.location,
+                channel.channel, intervals.starts, intervals.ends)
+            intervals.set_filenames(filenames)
+            ignore = np.array([_i is True for _i in filenames], dtype=bool)
+            exists = np.zeros(len(filenames), dtype=bool)
+            exists[~ignore] = file_index.exists_many(
+                [_i for _i in filenames if _i is not True])
+            intervals.status[:] = _STATUS_CODES[STATUS.NEEDS_DOWNLOADING]
+            intervals.status[exists] = _STATUS_CODES[STATUS.EXISTS]
+            intervals.status[ignore] = _STATUS_CODES[STATUS.IGNORE]
 
     def sanitize_downloads(self, logger):
         """
@@ -417,12 +423,26 @@ class Channel(_SlotsEqualityComparisionObject):
     """
     Object representing a Channel. Each time interval should end up in one
     MiniSEED file.
+
+    :param location: The location code.
+    :type location: str
+    :param channel: The channel code.
+    :type channel: str
+    :param intervals: The time intervals of the channel. A list of
+        :class:`~.TimeInterval` objects will be converted.
+    :type intervals: :class:`~.TimeIntervals` or list of
+        :class:`~.TimeInterval`
+    :param sampling_rate: The sampling rate of the channel if known.
+    :type sampling_rate: float
     """
-    __slots__ = ["location", "channel", "intervals"]
+    __slots__ = ["location", "channel", "intervals", "sampling_rate"]
 
-    def __init__(self, location, channel, intervals):
+    def __init__(self, location, channel, intervals, sampling_rate=None):
         self.location = location
         self.channel = channel
+        self.sampling_rate = sampling_rate
+        if not isinstance(intervals, TimeIntervals):
+            intervals = TimeIntervals.from_time_intervals(intervals)
         self.intervals = intervals
 
     @property
@@ -435,18 +455,15 @@ class Channel(_SlotsEqualityComparisionObject):
         requiring station information. This does not yet mean that station
         information will be downloaded. That is decided at a later stage.
         """
-        status = set([_i.status for _i in self.intervals])
-        if STATUS.DOWNLOADED in status or STATUS.EXISTS in status:
-            return True
-        return False
+        return self.intervals.has_status(STATUS.DOWNLOADED, STATUS.EXISTS)
 
     @property
     def temporal_bounds(self):
         """
         Returns a tuple of the minimum start time and the maximum end time.
         """
-        return (min([_i.start for _i in self.intervals]),
-                max([_i.end for _i in self.intervals]))
+        return (obspy.UTCDateTime(ns=int(self.intervals.starts.min())),
+                obspy.UTCDateTime(ns=int(self.intervals.ends.max())))
 
     def __str__(self):
         return "Channel '{location}.{channel}':\n\t{intervals}".format(
@@ -454,12 +471,145 @@ class Channel(_SlotsEqualityComparisionObject):
             intervals="\n\t".join([str(i) for i in self.intervals]))
 
 
+class TimeIntervals(object):
+    """
+    Compact columnar storage of all time intervals of a channel.
+
+    Start and end times are int64 arrays of nanoseconds and the statuses an
+    uint8 array. The time arrays can be shared between many channels and are
+    only copied once they are modified. Filenames are only stored once they
+    are assigned.
+
+    Indexing and iterating yield :class:`~.TimeInterval` objects that are
+    views into the arrays, i.e. modifying them modifies the store.
+
+    :param starts: The start times in nanoseconds.
+    :param ends: The end times in nanoseconds.
+    :param shared: If True, the time arrays are shared with other objects
+        and will be copied before they are modified.
+    :type shared: bool
+    """
+    __slots__ = ["starts", "ends", "status", "_filenames", "_shared"]
+
+    def __init__(self, starts, ends, shared=False):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.status = np.zeros(len(self.starts), dtype=np.uint8)
+        self._filenames = None
+        self._shared = shared
+
+    @classmethod
+    def from_time_intervals(cls, intervals):
+        """
+        Create a store from a list of :class:`~.TimeInterval` objects. The
+        objects will afterwards be views into the new store.
+
+        :param intervals: The time intervals.
+        :type intervals: list of :class:`~.TimeInterval`
+        """
+        intervals = list(intervals)
+        store = cls([_i.start.ns for _i in intervals],
+                    [_i.end.ns for _i in intervals])
+        for index, interval in enumerate(intervals):
+            filename, status = interval.filename, interval.status
+            interval._store, interval._index = store, index
+            interval.filename = filename
+            interval.status = status
+        return store
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Time interval index out of range.")
+        return TimeInterval._view(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield TimeInterval._view(self, index)
+
+    def __eq__(self, other):
+        if type(self) != type(other):
+            return False
+        return np.array_equal(self.starts, other.starts) and \
+            np.array_equal(self.ends, other.ends) and \
+            np.array_equal(self.status, other.status) and \
+            self.filenames == other.filenames
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def filenames(self):
+        """
+        List of the filenames of all intervals.
+        """
+        if self._filenames is None:
+            return [None] * len(self)
+        return list(self._filenames)
+
+    def has_status(self, *status):
+        """
+        Returns True if any interval has one of the given statuses.
+        """
+        return bool(np.isin(self.status,
+                            [_STATUS_CODES[_i] for _i in status]).any())
+
+    def with_status(self, status):
+        """
+        Returns views of all intervals with the given status.
+        """
+        return [TimeInterval._view(self, int(_i)) for _i in
+                np.flatnonzero(self.status == _STATUS_CODES[status])]
+
+    def status_counts(self):
+        """
+        Returns a :class:`collections.Counter` with the number of intervals
+        per status.
+        """
+        counts = np.bincount(self.status, minlength=len(_STATUS_NAMES))
+        return collections.Counter({
+            _STATUS_NAMES[_i]: int(_j) for _i, _j in enumerate(counts)
+            if _j})
+
+    def _set_time(self, key, index, value):
+        if self._shared:
+            self.starts = self.starts.copy()
+            self.ends = self.ends.copy()
+            self._shared = False
+        getattr(self, key)[index] = value.ns
+
+    def set_filenames(self, filenames):
+        """
+        Set the filenames of all intervals at once.
+
+        :param filenames: One filename per interval.
+        :type filenames: list
+        """
+        if len(filenames) != len(self):
+            raise ValueError("Expected %i filenames, got %i." % (
+                len(self), len(filenames)))
+        self._filenames = list(filenames)
+
+    def _set_filename(self, index, value):
+        if self._filenames is None:
+            if value is None:
+                return
+            self._filenames = [None] * len(self)
+        self._filenames[index] = value
+
+
 class TimeInterval(_SlotsEqualityComparisionObject):
     """
     Simple object representing a time interval of a channel.
 
     It knows the temporal bounds of the interval, the (desired) filename,
-    and the current status of the interval.
+    and the current status of the interval. It is a view into a
+    :class:`~.TimeIntervals` store. Creating one directly creates a store
+    with a single interval.
 
     :param start: The start of the interval.
     :type start: :class:`~obspy.core.utcdatetime.UTCDateTime`
@@ -470,14 +620,61 @@ class TimeInterval(_SlotsEqualityComparisionObject):
     :param status: The status of the time interval.
     :param status: :class:`~.STATUS`
     """
-    __slots__ = ["start", "end", "filename", "status"]
+    __slots__ = ["_store", "_index"]
 
     def __init__(self, start, end, filename=None, status=None):
-        self.start = start
-        self.end = end
+        self._store = TimeIntervals([start.ns], [end.ns])
+        self._index = 0
         self.filename = filename
         self.status = status if status is not None else STATUS.NONE
 
+    @classmethod
+    def _view(cls, store, index):
+        view = cls.__new__(cls)
+        view._store = store
+        view._index = index
+        return view
+
+    @property
+    def start(self):
+        return obspy.UTCDateTime(ns=int(self._store.starts[self._index]))
+
+    @start.setter
+    def start(self, value):
+        self._store._set_time("starts", self._index, value)
+
+    @property
+    def end(self):
+        return obspy.UTCDateTime(ns=int(self._store.ends[self._index]))
+
+    @end.setter
+    def end(self, value):
+        self._store._set_time("ends", self._index, value)
+
+    @property
+    def filename(self):
+        if self._store._filenames is None:
+            return None
+        return self._store._filenames[self._index]
+
+    @filename.setter
+    def filename(self, value):
+        self._store._set_filename(self._index, value)
+
+    @property
+    def status(self):
+        return _STATUS_NAMES[self._store.status[self._index]]
+
+    @status.setter
+    def status(self, value):
+        self._store.status[self._index] = _STATUS_CODES[value]
+
+    def __eq__(self, other):
+        if type(self) != type(other):
+            return False
+        return all([getattr(self, _i) == getattr(other, _i)
+                    for _i in ("start", "end", "filename", "status")])
+
     def __repr__(self):
         return "TimeInterval(start={start}, end={end}, filename={filename}, " \
                "status='{status}')".format(
@@ -488,6 +685,25 @@ class TimeInterval(_SlotsEqualityComparisionObject):
                    status=str(self.status))
 
 
+def _scan_mseed_file(filename):
+    """
+    Returns the size and the continuous segments of a MiniSEED file.
+
+    The size is None if the file does not exist and the segments are None
+    for empty files and the error message if the file cannot be read. A
+    module level function so it can be run by a process pool.
+    """
+    if not os.path.exists(filename):
+        return None, None
+    size = os.path.getsize(filename)
+    if not size:
+        return size, None
+    try:
+        return size, utils.get_mseed_segments(filename)
+    except Exception as e:
+        return size, str(e)
+
+
 class ClientDownloadHelper(object):
     """
     :type client: :class:`obspy.fdsn.client.Client`
@@ -501,9 +717,13 @@ class ClientDownloadHelper(object):
     :param mseed_storage: The MiniSEED storage settings.
     :param stationxml_storage: The StationXML storage settings.
     :param logger: An active logger instance.
+    :type file_index: :class:`~.utils.FileExistenceIndex`
+    :param file_index: Cached existence checks of the MiniSEED files. Can
+        be shared between the helpers of a run. A new one is created if not
+        given.
     """
     def __init__(self, client, client_name, restrictions, domain,
-                 mseed_storage, stationxml_storage, logger):
+                 mseed_storage, stationxml_storage, logger, file_index=None):
         self.client = client
         self.client_name = client_name
         self.restrictions = restrictions
@@ -513,6 +733,10 @@ class ClientDownloadHelper(object):
         self.logger = logger
         self.stations = {}
         self.is_availability_reliable = None
+        self.file_index = file_index if file_index is not None \
+            else utils.FileExistenceIndex()
+        # Status and size of the MiniSEED files checked while splitting.
+        self._mseed_qc = {}
 
     def __bool__(self):
         return bool(len(self))
@@ -544,8 +768,28 @@ class ClientDownloadHelper(object):
         This will distribute filenames and identify files that require
         downloading.
         """
+        # Parse the storage setting only once for all stations.
+        mseed_storage = utils.MseedStorage(self.mseed_storage)
+        for station in self.stations.values():
+            station.prepare_mseed_download(mseed_storage=mseed_storage,
+                                           file_index=self.file_index)
+
+    def mseed_files_changed(self):
+        """
+        Returns True if a MiniSEED file found by
+        :meth:`prepare_mseed_download` has been deleted since or a file it
+        found missing has been created since.
+        """
+        filenames = []
+        expected = []
         for station in self.stations.values():
-            station.prepare_mseed_download(mseed_storage=self.mseed_storage)
+            for channel in station.channels:
+                for status in (STATUS.EXISTS, STATUS.NEEDS_DOWNLOADING):
+                    intervals = channel.intervals.with_status(status)
+                    filenames.extend(_i.filename for _i in intervals)
+                    expected.extend([status == STATUS.EXISTS] *
+                                    len(intervals))
+        return self.file_index.exists_many(filenames) != expected
 
     def filter_stations_based_on_minimum_distance(
             self, existing_client_dl_helpers):
@@ -584,70 +828,67 @@ class ClientDownloadHelper(object):
             # the minimum distance.
             kd_tree = utils.SphericalNearestNeighbour(stations)
             nns = kd_tree.query_pairs(
-                self.restrictions.minimum_interstation_distance_in_m)
+                self.restrictions.minimum_interstation_distance_in_m,
+                output_type="ndarray")
 
-            indexes_to_remove = []
             # Keep removing the station with the most pairs until no pairs are
             # left.
-            while nns:
-                most_common = collections.Counter(
-                    itertools.chain.from_iterable(nns)).most_common()[0][0]
-                indexes_to_remove.append(most_common)
-                nns = list(filterfalse(lambda x: most_common in x, nns))
-
-            # Remove these indices this results in a set of stations we wish to
-            # keep.
-            new_remaining_stations = [_i[1] for _i in enumerate(stations)
-                                      if _i[0] not in indexes_to_remove]
-            new_rejected_stations = [_i[1] for _i in enumerate(stations)
-                                     if _i[0] in indexes_to_remove]
-
-            # Station objects are not hashable thus we have to go the long
-            # route.
-            for st in new_remaining_stations:
-                if st not in remaining_stations:
-                    remaining_stations.append(st)
-
-            for st in new_rejected_stations:
-                if st not in rejected_stations:
-                    rejected_stations.append(st)
+            is_removed = np.zeros(len(stations), dtype=bool)
+            is_removed[utils.greedy_vertex_cover(nns, len(stations))] = True
+
+            remaining_stations = [_i for _i, _j in zip(stations, is_removed)
+                                  if not _j]
+            rejected_stations = [_i for _i, _j in zip(stations, is_removed)
+                                 if _j]
 
             # Otherwise it will add new stations approximating a Poisson disk
         # distribution.
         else:
-            while stations:
-                # kd-tree with all existing_stations
-                existing_kd_tree = utils.SphericalNearestNeighbour(
-                    existing_stations)
-                # Now we have to get the distance to the closest existing
-                # station for all new stations.
-                distances = np.ma.array(existing_kd_tree.query(stations)[0])
-                if np.isinf(distances[0]):
+            minimum_distance = \
+                self.restrictions.minimum_interstation_distance_in_m
+            kd_tree = utils.SphericalNearestNeighbour(stations).kd_tree
+            points = kd_tree.data
+            # Distance of each station to the closest existing station.
+            distances = utils.SphericalNearestNeighbour(
+                existing_stations).kd_tree.query(points)[0]
+            # Max-heap of the distances. Ties go to the first station in
+            # sorted order, like np.argmax. Outdated entries are skipped.
+            heap = [(-_d, _i) for _i, _d in enumerate(distances.tolist())]
+            heapq.heapify(heap)
+            is_candidate = np.ones(len(stations), dtype=bool)
+            is_remaining = np.zeros(len(stations), dtype=bool)
+
+            while heap:
+                distance, index = heapq.heappop(heap)
+                distance = -distance
+                if not is_candidate[index] or distance != distances[index]:
+                    continue
+                # All others are even closer to an existing station.
+                if not distance >= minimum_distance:
                     break
-                distances.mask = False
-
-                # Step one is to get rid of all stations that are closer
-                # than the minimum distance to any existing station.
-                remove = np.where(
-                    distances <
-                    self.restrictions.minimum_interstation_distance_in_m)[0]
-                rejected_stations.extend([stations[_i] for _i in remove])
-
-                keep = np.where(
-                    distances >=
-                    self.restrictions.minimum_interstation_distance_in_m)[0]
-                distances.mask[remove] = True
-
-                if len(keep):
-                    # Station with the largest distance to next closer station.
-                    largest = np.argmax(distances)
-                    remaining_stations.append(stations[largest])
-                    existing_stations.append(stations[largest])
-
-                    # Add all rejected stations here.
-                    stations = [stations[_i] for _i in keep if _i != largest]
-                else:
-                    stations = []
+                # Station with the largest distance to the next closest
+                # station.
+                is_candidate[index] = False
+                is_remaining[index] = True
+
+                # It now is the closest existing station for some of the
+                # others. These can only be within the current distance as
+                # no other station has a larger one.
+                near = np.array(kd_tree.query_ball_point(
+                    points[index], distance), dtype=np.int64)
+                near = near[is_candidate[near]]
+                new_distances = np.sqrt(
+                    ((points[near] - points[index]) ** 2).sum(axis=1))
+                closer = new_distances < distances[near]
+                near, new_distances = near[closer], new_distances[closer]
+                distances[near] = new_distances
+                for _i, _d in zip(near.tolist(), new_distances.tolist()):
+                    heapq.heappush(heap, (-_d, _i))
+
+            remaining_stations = [_i for _i, _j in zip(stations, is_remaining)
+                                  if _j]
+            rejected_stations = [_i for _i, _j in zip(stations, is_remaining)
+                                 if not _j]
 
         # Now actually delete the files and everything of the rejected
         # stations.
@@ -673,40 +914,25 @@ class ClientDownloadHelper(object):
                 stationxml_storage=self.stationxml_storage,
                 logger=self.logger)
 
-    def download_stationxml(self, threads=3):
+    def download_stationxml(self, threads=3, engine=None, concurrency=None):
         """
         Actually download the StationXML files.
 
         :param threads: Limits the maximum number of threads for the client.
+        :param engine: If given, the files are downloaded by this
+            :class:`~.async_engine.AsyncDownloadEngine` instead of a thread
+            pool.
+        :param concurrency: If given, the number of simultaneous requests is
+            adapted by its controller of the station service instead of
+            being fixed to ``threads``.
+        :type concurrency: :class:`~.utils.AdaptiveConcurrency`
         """
-
-        def star_download_station(args):
-            """
-            Maps arguments to the utils.download_stationxml() function.
-
-            :param args: The to-be mapped arguments.
-            """
-            try:
-                ret_val = utils.download_stationxml(*args, logger=self.logger)
-            except utils.ERRORS as e:
-                self.logger.error(str(e))
-                return None
-            return ret_val
-
         # Build up everything we want to download.
         arguments = []
         for station in self.stations.values():
-            if not station.miss_station_information:
-                continue
-            s, e = station.temporal_bounds
-            if self.restrictions.station_starttime:
-                s = self.restrictions.station_starttime
-            if self.restrictions.station_endtime:
-                e = self.restrictions.station_endtime
-            bulk = [(station.network, station.station, channel.location,
-                     channel.channel, s, e) for channel in station.channels]
-            arguments.append((self.client, self.client_name, bulk,
-                              station.stationxml_filename))
+            args = self._get_stationxml_arguments(station)
+            if args is not None:
+                arguments.append(args)
 
         if not arguments:
             self.logger.info("Client '%s' - No station information to "
@@ -715,9 +941,15 @@ class ClientDownloadHelper(object):
 
         # Download it.
         s_time = timeit.default_timer()
-        pool = ThreadPool(min(threads, len(arguments)))
-        results = pool.map(star_download_station, arguments)
-        pool.close()
+        if engine is None:
+            controller = self._get_controller(concurrency, "station", threads)
+            pool = ThreadPool(min(controller.maximum, len(arguments)))
+            results = pool.map(self._get_stationxml_function(
+                controller=controller), arguments)
+            pool.close()
+        else:
+            results = engine.map(self._get_stationxml_function(engine),
+                                 arguments)
         e_time = timeit.default_timer()
 
         results = [_i for _i in results if _i is not None]
@@ -729,59 +961,134 @@ class ClientDownloadHelper(object):
         # Update the station structures. Loop over each returned file.
         for s_id, filename in results:
             filecount += 1
-            station = self.stations[s_id]
-            size = os.path.getsize(filename)
-            download_size += size
+            download_size += self._check_downloaded_stationxml(
+                s_id, filename)
 
-            # Extract information about that file.
-            try:
-                info = utils.get_stationxml_contents(filename)
-            # Sometimes some services choose to not return XML files - guard
-            # against it and just delete the file. At subsequent runs the
-            # mass downloader will attempt to download it again.
-            except XMLSyntaxError:
-                self.logger.info(
-                    "Client '%s' - File %s is not an XML file - it will be "
-                    "deleted." % (self.client_name, filename))
-                utils.safe_delete(filename)
-                continue
+        self._finish_stationxml_download(filecount, download_size,
+                                         e_time - s_time)
 
-            still_missing = {}
-            # Make sure all missing information has been downloaded by
-            # looping over each channel of the station that originally
-            # requested to be downloaded.
-            for c_id, times in station.miss_station_information.items():
-                # Get the temporal range of information in the file.
-                c_info = [_i for _i in info if
-                          _i.network == station.network and
-                          _i.station == station.station and
-                          _i.location == c_id[0] and
-                          _i.channel == c_id[1]]
-                if not c_info:
-                    continue
-                starttime = min([_i.starttime for _i in c_info])
-                endtime = max([_i.endtime for _i in c_info])
-                if starttime > times[0] or endtime < times[1]:
-                    # Cope with case that not full day of station info missing
-                    if starttime < times[1]:
-                        still_missing[c_id] = (times[0], starttime)
-                        station.have_station_information[c_id] = (starttime,
-                                                                  times[1])
-                    elif endtime > times[0]:
-                        still_missing[c_id] = (endtime, times[1])
-                        station.have_station_information[c_id] = (times[0],
-                                                                  endtime)
-                    else:
-                        still_missing[c_id] = times
-                    continue
-                station.have_station_information[c_id] = times
+    def _get_stationxml_arguments(self, station):
+        """
+        Arguments for :meth:`_download_stationxml_file` or None if the
+        station does not miss any station information.
+        """
+        if not station.miss_station_information:
+            return None
+        s, e = station.temporal_bounds
+        if self.restrictions.station_starttime:
+            s = self.restrictions.station_starttime
+        if self.restrictions.station_endtime:
+            e = self.restrictions.station_endtime
+        bulk = [(station.network, station.station, channel.location,
+                 channel.channel, s, e) for channel in station.channels]
+        return (self.client, self.client_name, bulk,
+                station.stationxml_filename)
+
+    def _download_stationxml_file(self, args, controller=None):
+        """
+        Maps arguments to the utils.download_stationxml() function.
 
-            station.miss_station_information = still_missing
-            if still_missing:
-                station.stationxml_status = STATUS.DOWNLOAD_PARTIALLY_FAILED
-            else:
-                station.stationxml_status = STATUS.DOWNLOADED
+        :param args: The to-be mapped arguments.
+        :param controller: Passed on to utils.download_stationxml().
+        """
+        try:
+            ret_val = utils.download_stationxml(*args, logger=self.logger,
+                                                controller=controller)
+        except utils.ERRORS as e:
+            return self._on_stationxml_error(args, e)
+        return ret_val
+
+    def _on_stationxml_error(self, args, e):
+        self.logger.error(str(e))
+        return None
+
+    def _get_stationxml_function(self, engine=None, controller=None):
+        """
+        The function downloading a single StationXML file from the arguments
+        returned by :meth:`_get_stationxml_arguments`.
+        """
+        if engine is None:
+            return functools.partial(self._download_stationxml_file,
+                                     controller=controller)
+        return engine.star(engine.download_stationxml,
+                           self._on_stationxml_error, logger=self.logger)
+
+    def _get_controller(self, concurrency, service, threads):
+        """
+        The controller limiting the simultaneous requests to a service. It
+        is fixed to ``threads`` without adaptive concurrency.
+        """
+        if concurrency is None:
+            return utils.ConcurrencyController(initial=threads,
+                                               minimum=threads)
+        return concurrency.get(self.client, service)
+
+    def _check_downloaded_stationxml(self, s_id, filename):
+        """
+        Update the station structures with the contents of a downloaded
+        StationXML file.
+
+        Returns the size of the file.
+        """
+        station = self.stations[s_id]
+        size = os.path.getsize(filename)
+
+        # Extract information about that file.
+        try:
+            info = utils.get_stationxml_contents(filename)
+        # Sometimes some services choose to not return XML files - guard
+        # against it and just delete the file. At subsequent runs the
+        # mass downloader will attempt to download it again.
+        except XMLSyntaxError:
+            self.logger.info(
+                "Client '%s' - File %s is not an XML file - it will be "
+                "deleted." % (self.client_name, filename))
+            utils.safe_delete(filename)
+            return size
+
+        still_missing = {}
+        # Make sure all missing information has been downloaded by
+        # looping over each channel of the station that originally
+        # requested to be downloaded.
+        for c_id, times in station.miss_station_information.items():
+            # Get the temporal range of information in the file.
+            c_info = [_i for _i in info if
+                      _i.network == station.network and
+                      _i.station == station.station and
+                      _i.location == c_id[0] and
+                      _i.channel == c_id[1]]
+            if not c_info:
+                continue
+            starttime = min([_i.starttime for _i in c_info])
+            endtime = max([_i.endtime for _i in c_info])
+            if starttime > times[0] or endtime < times[1]:
+                # Cope with case that not full day of station info missing
+                if starttime < times[1]:
+                    still_missing[c_id] = (times[0], starttime)
+                    station.have_station_information[c_id] = (starttime,
+                                                              times[1])
+                elif endtime > times[0]:
+                    still_missing[c_id] = (endtime, times[1])
+                    station.have_station_information[c_id] = (times[0],
+                                                              endtime)
+                else:
+                    still_missing[c_id] = times
+                continue
+            station.have_station_information[c_id] = times
+
+        station.miss_station_information = still_missing
+        if still_missing:
+            station.stationxml_status = STATUS.DOWNLOAD_PARTIALLY_FAILED
+        else:
+            station.stationxml_status = STATUS.DOWNLOADED
+        return size
 
+    def _finish_stationxml_download(self, filecount, download_size,
+                                    duration):
+        """
+        Mark all stations whose station information has not been downloaded
+        as failed and log some statistics.
+        """
         # Now loop over all stations and set the status of the ones that
         # still need downloading to download failed.
         for station in self.stations.values():
@@ -792,10 +1099,13 @@ class ClientDownloadHelper(object):
                          "in %.1f seconds [%.2f KB/sec]." % (
                              self.client_name, filecount,
                              download_size / 1024.0 ** 2,
-                             e_time - s_time,
-                             (download_size / 1024.0) / (e_time - s_time)))
+                             duration,
+                             (download_size / 1024.0) / duration))
 
-    def download_mseed(self, chunk_size_in_mb=25, threads_per_client=3):
+    def download_mseed(self, chunk_size_in_mb=25, threads_per_client=3,
+                       stream=False, stationxml=False, engine=None,
+                       concurrency=None, retries=2, size_estimator=None,
+                       qc_processes=None):
         """
         Actually download MiniSEED data.
 
@@ -803,58 +1113,63 @@ class ClientDownloadHelper(object):
             size.
         :param threads_per_client: Threads to launch per client. 3 seems to
             be a value in agreement with some data centers.
+        :param stream: Split the data while it is being received instead of
+            going through a temporary file.
+        :param stationxml: If True, the StationXML file of each station is
+            downloaded by the same threads as soon as all its MiniSEED data
+            passed the QC. :meth:`prepare_stationxml_download` and
+            :meth:`download_stationxml` must then not be called anymore.
+        :param engine: If given, all requests are run by this
+            :class:`~.async_engine.AsyncDownloadEngine` which limits the
+            number of simultaneous requests per host instead of
+            ``threads_per_client``. ``stream`` is then ignored.
+        :param concurrency: If given, the number of simultaneous requests to
+            each service is adapted by its controllers, starting from and
+            instead of ``threads_per_client``. Not used by the ``engine``.
+        :type concurrency: :class:`~.utils.AdaptiveConcurrency`
+        :param retries: Failed requests are retried this many times before
+            they are split up. See
+            :func:`~.utils.download_and_split_mseed_bulk_with_retry`.
+        :type retries: int
+        :param size_estimator: Estimates the size of the data to be
+            downloaded and learns from existing and downloaded files. Pass
+            the same one to all clients to share what it learned.
+        :type size_estimator: :class:`~.utils.MseedSizeEstimator`
+        :param qc_processes: Number of processes reading the files that could
+            not be checked while splitting. Defaults to the number of CPUs.
+        :type qc_processes: int
         """
-        # Estimate the download size to have equally sized chunks.
-        channel_sampling_rate = {
-            "F": 5000, "G": 5000, "D": 1000, "C": 1000, "E": 250, "S": 80,
-            "H": 250, "B": 80, "M": 10, "L": 1, "V": 0.1, "U": 0.01,
-            "R": 0.001, "P": 0.0001, "T": 0.00001, "Q": 0.000001, "A": 5000,
-            "O": 5000}
-
-        # Split into chunks of about equal size in terms of filesize.
-        chunks = []
-        chunks_curr = []
-        curr_chunks_mb = 0
-
-        # Don't request more than 50 chunks at once to not choke the servers.
-        max_chunk_length = 50
-
+        if size_estimator is None:
+            size_estimator = utils.MseedSizeEstimator()
+        # Learn the compression of each station from already existing data.
+        self._learn_file_sizes(size_estimator, STATUS.EXISTS)
+
+        # Estimate the download size of each time interval from the sampling
+        # rate and compression of its channel to have equally sized chunks.
+        intervals = []
+        sizes = []
         counter = collections.Counter()
-
-        # Keep track of attempted downloads.
         for sta in self.stations.values():
             for cha in sta.channels:
-                # The band code is used to estimate the sampling rate of the
-                # data to be downloaded.
-                band_code = cha.channel[0].upper()
-                try:
-                    sr = channel_sampling_rate[band_code]
-                except KeyError:
-                    # Generic sampling rate for exotic band codes.
-                    sr = 1.0
-
-                for interval in cha.intervals:
-                    counter[interval.status] += 1
-                    # Only take those time intervals that actually require
-                    # some downloading.
-                    if interval.status != STATUS.NEEDS_DOWNLOADING:
-                        continue
-                    chunks_curr.append((
+                sr = utils.get_sampling_rate(cha.channel, cha.sampling_rate)
+                counter.update(cha.intervals.status_counts())
+                # Only take those time intervals that actually require some
+                # downloading.
+                for interval in cha.intervals.with_status(
+                        STATUS.NEEDS_DOWNLOADING):
+                    intervals.append((
                         sta.network, sta.station, cha.location, cha.channel,
                         interval.start, interval.end, interval.filename))
-                    # Assume that each sample needs 4 byte, STEIM
-                    # compression reduces size to about a third.
-                    # chunk size is in MB
-                    duration = interval.end - interval.start
-                    curr_chunks_mb += \
-                        sr * duration * 4.0 / 3.0 / 1024.0 / 1024.0
-                    if curr_chunks_mb >= chunk_size_in_mb or \
-                            len(chunks_curr) >= max_chunk_length:
-                        chunks.append(chunks_curr)
-                        chunks_curr = []
-                        curr_chunks_mb = 0
-        if chunks_curr:
-            chunks.append(chunks_curr)
+                    sizes.append(size_estimator.estimate(
+                        sta.network, sta.station, sr,
+                        interval.end - interval.start))
+
+        # Split into chunks of about equal size in terms of filesize. Don't
+        # request more than 50 time intervals at once to not choke the
+        # servers.
+        chunks = utils.pack_chunks(
+            intervals, sizes, chunk_size=chunk_size_in_mb * 1024.0 ** 2,
+            max_length=50)
 
         keys = sorted(counter.keys())
         for key in keys:
@@ -864,6 +1179,11 @@ class ClientDownloadHelper(object):
                                      key.upper()))
 
         if not chunks:
+            if stationxml:
+                self.prepare_stationxml_download()
+                self.download_stationxml(threads=threads_per_client,
+                                         engine=engine,
+                                         concurrency=concurrency)
             return
 
         def star_download_mseed(args):
@@ -874,30 +1194,73 @@ class ClientDownloadHelper(object):
             :param args: The arguments to be passed.
             """
             try:
-                ret_val = utils.download_and_split_mseed_bulk(
-                    *args, logger=self.logger)
+                ret_val = utils.download_and_split_mseed_bulk_with_retry(
+                    *args, logger=self.logger, retries=retries,
+                    stream=stream, file_pool=file_pool,
+                    controller=controller, qc=self._check_mseed_file)
             except utils.ERRORS as e:
-                msg = ("Client '%s' - " % args[1]) + str(e)
-                if "no data available" in msg.lower():
-                    self.logger.info(msg.split("Detailed response")[0].strip())
-                else:
-                    self.logger.error(msg)
-                return []
+                return on_error(args, e)
             return ret_val
 
-        pool = ThreadPool(min(threads_per_client, len(chunks)))
+        def on_error(args, e):
+            utils.log_mseed_download_error(self.logger, args[1], e)
+            return []
 
-        d_start = timeit.default_timer()
-        pool.map(
-            star_download_mseed,
-            [(self.client, self.client_name, chunk) for chunk in chunks])
-        pool.close()
-        d_end = timeit.default_timer()
+        # All threads write through the same pool to bound the number of
+        # simultaneously open files.
+        file_pool = utils.FileHandlePool(file_index=self.file_index)
+        if engine is None:
+            # Enough threads for the highest limit of the controllers.
+            controller = self._get_controller(
+                concurrency, "dataselect", threads_per_client)
+            workers = [min(controller.maximum, len(chunks)), 0]
+            download_stationxml_file = None
+            if stationxml:
+                # The StationXML downloads get their own share of the
+                # threads.
+                station_controller = self._get_controller(
+                    concurrency, "station", threads_per_client)
+                workers[1] = station_controller.maximum
+                download_stationxml_file = self._get_stationxml_function(
+                    controller=station_controller)
+            pool = ThreadPool(sum(workers))
+        else:
+            # Everything is handed to the engine at once, it limits the
+            # number of simultaneous requests itself.
+            workers = [len(chunks), len(self.stations)]
+            pool = engine
+            download_stationxml_file = self._get_stationxml_function(engine)
+            star_download_mseed = engine.star(
+                engine.download_and_split_mseed_bulk_with_retry, on_error,
+                logger=self.logger, retries=retries, file_pool=file_pool,
+                qc=self._check_mseed_file)
 
-        self.logger.info("Client '%s' - Launching basic QC checks..." %
-                         self.client_name)
-        downloaded_bytes, discarded_bytes = self._check_downloaded_data()
+        d_start = timeit.default_timer()
+        try:
+            if stationxml:
+                downloaded_bytes, discarded_bytes, d_end, stationxml_stats = \
+                    self._download_mseed_and_stationxml(
+                        pool, workers, star_download_mseed,
+                        download_stationxml_file, chunks)
+            else:
+                pool.map(
+                    star_download_mseed,
+                    [(self.client, self.client_name, chunk)
+                     for chunk in chunks])
+        finally:
+            if engine is None:
+                pool.close()
+            file_pool.close_all()
+
+        if not stationxml:
+            d_end = timeit.default_timer()
+            self.logger.info("Client '%s' - Launching basic QC checks..." %
+                             self.client_name)
+            downloaded_bytes, discarded_bytes = self._check_downloaded_data(
+                processes=qc_processes)
         total_bytes = downloaded_bytes + discarded_bytes
+        # Later clients profit from the newly downloaded data.
+        self._learn_file_sizes(size_estimator, STATUS.DOWNLOADED)
 
         self.logger.info("Client '%s' - Downloaded %.1f MB [%.2f KB/sec] of "
                          "data, %.1f MB of which were discarded afterwards." %
@@ -909,8 +1272,7 @@ class ClientDownloadHelper(object):
         counter = collections.Counter()
         for sta in self.stations.values():
             for chan in sta.channels:
-                for interval in chan.intervals:
-                    counter[interval.status] += 1
+                counter.update(chan.intervals.status_counts())
         keys = sorted(counter.keys())
         for key in keys:
             self.logger.info(
@@ -920,6 +1282,113 @@ class ClientDownloadHelper(object):
 
         self._remove_failed_and_ignored_stations()
 
+        if stationxml:
+            self._finish_stationxml_download(*stationxml_stats)
+
+    def _learn_file_sizes(self, size_estimator, status):
+        """
+        Feed the sizes of the files of all intervals with the given status
+        to the size estimator. The sizes of the existing files come with the
+        directory listings.
+        """
+        for sta in self.stations.values():
+            for cha in sta.channels:
+                size_estimator.add_files(
+                    sta.network, sta.station,
+                    utils.get_sampling_rate(cha.channel, cha.sampling_rate),
+                    ((_i.filename, _i.end - _i.start) for _i in
+                     cha.intervals.with_status(status)),
+                    file_index=self.file_index)
+
+    def _download_mseed_and_stationxml(self, pool, workers,
+                                       star_download_mseed,
+                                       download_stationxml_file, chunks):
+        """
+        Download the MiniSEED chunks and run the QC and the StationXML
+        download of each station as soon as all chunks containing it are
+        done. ``workers`` are the maximum numbers of simultaneous MiniSEED
+        and StationXML downloads, the same as when downloading one after
+        the other.
+
+        Returns the downloaded and discarded MiniSEED bytes, the time the
+        last MiniSEED chunk finished and the StationXML statistics.
+        """
+        done = queue.Queue()
+
+        def run(function, args):
+            pool.apply_async(
+                function, (args,),
+                callback=lambda r: done.put((function, args, r, None)),
+                error_callback=lambda e: done.put((function, args, None, e)))
+
+        # Number of outstanding chunks per station.
+        outstanding = collections.Counter()
+        for chunk in chunks:
+            for s_id in set([_i[:2] for _i in chunk]):
+                outstanding[s_id] += 1
+
+        waiting = {star_download_mseed: collections.deque(
+            [(self.client, self.client_name, _i) for _i in chunks]),
+            download_stationxml_file: collections.deque()}
+        workers = {star_download_mseed: workers[0],
+                   download_stationxml_file: workers[1]}
+        in_flight = collections.Counter()
+        pending_mseed = len(chunks)
+
+        downloaded_bytes = 0
+        discarded_bytes = 0
+        d_end = timeit.default_timer()
+        s_time = timeit.default_timer()
+        filecount = 0
+        download_size = 0
+
+        # Stations that do not need to download anything are complete
+        # from the start.
+        complete = [_i for _i in self.stations if not outstanding[_i]]
+        while True:
+            for s_id in complete:
+                station = self.stations[s_id]
+                downloaded, discarded = \
+                    self._check_downloaded_station_data(station)
+                downloaded_bytes += downloaded
+                discarded_bytes += discarded
+                if not station.has_existing_or_downloaded_time_intervals:
+                    continue
+                station.prepare_stationxml_download(
+                    stationxml_storage=self.stationxml_storage,
+                    logger=self.logger)
+                args = self._get_stationxml_arguments(station)
+                if args is not None:
+                    waiting[download_stationxml_file].append(args)
+
+            for function, arguments in waiting.items():
+                while arguments and in_flight[function] < workers[function]:
+                    run(function, arguments.popleft())
+                    in_flight[function] += 1
+
+            if not sum(in_flight.values()):
+                break
+            function, args, result, exception = done.get()
+            in_flight[function] -= 1
+            if exception is not None:
+                raise exception
+
+            complete = []
+            if function is star_download_mseed:
+                pending_mseed -= 1
+                if not pending_mseed:
+                    d_end = timeit.default_timer()
+                for s_id in set([_i[:2] for _i in args[2]]):
+                    outstanding[s_id] -= 1
+                    if not outstanding[s_id]:
+                        complete.append(s_id)
+            elif result is not None:
+                filecount += 1
+                download_size += self._check_downloaded_stationxml(*result)
+
+        return downloaded_bytes, discarded_bytes, d_end, (
+            filecount, download_size, timeit.default_timer() - s_time)
+
     def _remove_failed_and_ignored_stations(self):
         """
         Removes all stations that have no time interval with either exists
@@ -942,92 +1411,191 @@ class ClientDownloadHelper(object):
         for station in self.stations.values():
             station.sanitize_downloads(logger=self.logger)
 
-    def _check_downloaded_data(self):
+    def _check_downloaded_data(self, processes=None):
         """
-        Read the downloaded data, set the proper status flags and remove
-        data that does not meet the QC criteria. It just checks the
-        downloaded data for minimum length and gaps/overlaps.
+        Set the proper status flags of the downloaded data and remove data
+        that does not meet the QC criteria. It just checks the downloaded
+        data for minimum length and gaps/overlaps.
 
         Returns the downloaded_bytes and the discarded_bytes.
+
+        :param processes: The number of processes reading the files that
+            have not already been checked while being split. Defaults to
+            the number of CPUs. Only used for at least
+            :data:`PARALLEL_QC_THRESHOLD` files.
+        :type processes: int
         """
+        filenames = [
+            interval.filename for sta in self.stations.values()
+            for cha in sta.channels
+            for interval in cha.intervals.with_status(
+                STATUS.NEEDS_DOWNLOADING)
+            if interval.filename not in self._mseed_qc]
+        scanned = self._scan_mseed_files(filenames, processes=processes)
+
         downloaded_bytes = 0
         discarded_bytes = 0
         for sta in self.stations.values():
-            for cha in sta.channels:
-                for interval in cha.intervals:
-                    # The status of the interval should not have changed if
-                    # it did not require downloading in the first place.
-                    if interval.status != STATUS.NEEDS_DOWNLOADING:
-                        continue
+            downloaded, discarded = self._check_downloaded_station_data(
+                sta, scanned=scanned)
+            downloaded_bytes += downloaded
+            discarded_bytes += discarded
+        return downloaded_bytes, discarded_bytes
 
-                    # If the file does not exist, mark the time interval as
-                    # download failed.
-                    if not os.path.exists(interval.filename):
-                        interval.status = STATUS.DOWNLOAD_FAILED
-                        continue
+    def _scan_mseed_files(self, filenames, processes=None):
+        """
+        Read many MiniSEED files with a process pool.
 
-                    size = os.path.getsize(interval.filename)
-                    if size == 0:
-                        self.logger.warning("Zero byte file '%s'. Will be "
-                                            "deleted." % interval.filename)
-                        utils.safe_delete(interval.filename)
-                        interval.status = STATUS.DOWNLOAD_FAILED
-                        continue
+        Returns a dictionary with the result of :func:`_scan_mseed_file`
+        per filename. Empty if there are too few files for it to be worth
+        starting the processes.
+        """
+        processes = processes or multiprocessing.cpu_count()
+        if processes < 2 or len(filenames) < PARALLEL_QC_THRESHOLD:
+            return {}
+        self.logger.info("Client '%s' - Reading %i files with %i "
+                         "processes." % (self.client_name, len(filenames),
+                                         processes))
+        # Few large tasks per process to keep the communication overhead
+        # low while still balancing the load.
+        chunksize = max(1, len(filenames) // (processes * 4))
+        # Never fork: the downloader runs other threads (the planner, the
+        # logging handlers, ...) and a forked child can inherit one of their
+        # locks in a held state and deadlock.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        pool = context.Pool(processes)
+        try:
+            results = pool.map(_scan_mseed_file, filenames,
+                               chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(filenames, results))
+
+    def _check_downloaded_station_data(self, sta, scanned=None):
+        """
+        Same as :meth:`_check_downloaded_data` but for a single station.
 
-                    # Guard against faulty files.
-                    try:
-                        st = obspy.read(interval.filename, headonly=True)
-                    except Exception as e:
-                        self.logger.warning(
-                            "Could not read file '%s' due to: %s\n"
-                            "Will be discarded." % (interval.filename, str(e)))
-                        utils.safe_delete(interval.filename)
-                        discarded_bytes += size
-                        interval.status = STATUS.DOWNLOAD_FAILED
-                        continue
+        Files that have already been checked while being split, see
+        :meth:`_check_mseed_file`, are not read again. Only other files are
+        read and checked here unless they are part of ``scanned``, the
+        results of :meth:`_scan_mseed_files`.
+        """
+        scanned = scanned or {}
+        downloaded_bytes = 0
+        discarded_bytes = 0
+        for cha in sta.channels:
+            # The status of the interval should not have changed if it
+            # did not require downloading in the first place.
+            for interval in cha.intervals.with_status(
+                    STATUS.NEEDS_DOWNLOADING):
+                filename = interval.filename
+                if filename in self._mseed_qc:
+                    status, size = self._mseed_qc.pop(filename)
+                else:
+                    if filename in scanned:
+                        size, segments = scanned[filename]
+                    else:
+                        size, segments = _scan_mseed_file(filename)
+                    status = self._check_scanned_mseed_file(
+                        filename, size, segments,
+                        interval.end - interval.start)
+                    size = size or 0
+                if status == STATUS.DOWNLOADED:
+                    downloaded_bytes += size
+                else:
+                    discarded_bytes += size
+                interval.status = status
+        return downloaded_bytes, discarded_bytes
 
-                    # Valid files with no data.
-                    if len(st) == 0:
-                        self.logger.warning(
-                            "Empty file '%s'. Will be deleted." %
-                            interval.filename)
-                        utils.safe_delete(interval.filename)
-                        discarded_bytes += size
-                        interval.status = STATUS.DOWNLOAD_FAILED
-                        continue
+    def _check_scanned_mseed_file(self, filename, size, segments,
+                                  interval_duration):
+        """
+        Check a MiniSEED file read by :func:`_scan_mseed_file` and delete it
+        if it does not pass.
 
-                    # If user did not want gappy files, remove them.
-                    if self.restrictions.reject_channels_with_gaps is True and\
-                            len(st) > 1:
-                        self.logger.info(
-                            "File '%s' has %i traces and thus contains "
-                            "gaps or overlaps. Will be deleted." % (
-                                interval.filename, len(st)))
-                        utils.safe_delete(interval.filename)
-                        discarded_bytes += size
-                        interval.status = STATUS.DOWNLOAD_REJECTED
-                        continue
+        Returns the new status of its time interval.
+        """
+        # If the file does not exist, mark the time interval as download
+        # failed.
+        if size is None:
+            return STATUS.DOWNLOAD_FAILED
+
+        if size == 0:
+            self.logger.warning("Zero byte file '%s'. Will be "
+                                "deleted." % filename)
+            utils.safe_delete(filename)
+            return STATUS.DOWNLOAD_FAILED
+
+        # Guard against faulty files.
+        if not isinstance(segments, list):
+            self.logger.warning(
+                "Could not read file '%s' due to: %s\n"
+                "Will be discarded." % (filename, segments))
+            utils.safe_delete(filename)
+            return STATUS.DOWNLOAD_FAILED
+
+        status = self._get_mseed_status(filename, segments,
+                                        interval_duration)
+        if status != STATUS.DOWNLOADED:
+            utils.safe_delete(filename)
+        return status
+
+    def _check_mseed_file(self, filename, size, segments, starttime,
+                          endtime):
+        """
+        QC of a MiniSEED file by the :class:`~.utils.MseedBulkSplitter`
+        before it is closed. Records the result for
+        :meth:`_check_downloaded_data` and returns True if the file is to
+        be kept.
+
+        :param size: The number of bytes of the file.
+        :param segments: The continuous segments of the file.
+        :param starttime: The start time of the time interval in
+            nanoseconds.
+        :param endtime: The end time of the time interval in nanoseconds.
+        """
+        status = self._get_mseed_status(filename, segments,
+                                        (endtime - starttime) / 1E9)
+        self._mseed_qc[filename] = (status, size)
+        return status == STATUS.DOWNLOADED
 
-                    if self.restrictions.minimum_length:
-                        duration = sum([tr.stats.endtime - tr.stats.starttime
-                                        for tr in st])
-                        expected_min_duration = \
-                            self.restrictions.minimum_length * \
-                            (interval.end - interval.start)
-                        if duration < expected_min_duration:
-                            self.logger.info(
-                                "File '%s' has only %.2f seconds of data. "
-                                "%.2f are required. File will be deleted." %
-                                (interval.filename, duration,
-                                 expected_min_duration))
-                            utils.safe_delete(interval.filename)
-                            discarded_bytes += size
-                            interval.status = STATUS.DOWNLOAD_REJECTED
-                            continue
+    def _get_mseed_status(self, filename, segments, interval_duration):
+        """
+        Apply the QC criteria of the restrictions to the continuous segments
+        of a MiniSEED file and return the resulting status of its time
+        interval.
+        """
+        # Valid files with no data.
+        if len(segments) == 0:
+            self.logger.warning(
+                "Empty file '%s'. Will be deleted." % filename)
+            return STATUS.DOWNLOAD_FAILED
+
+        # If user did not want gappy files, remove them.
+        if self.restrictions.reject_channels_with_gaps is True and \
+                len(segments) > 1:
+            self.logger.info(
+                "File '%s' has %i traces and thus contains "
+                "gaps or overlaps. Will be deleted." % (
+                    filename, len(segments)))
+            return STATUS.DOWNLOAD_REJECTED
+
+        if self.restrictions.minimum_length:
+            duration = sum([(_i[2] - _i[1]) / 1E9 for _i in segments])
+            expected_min_duration = \
+                self.restrictions.minimum_length * interval_duration
+            if duration < expected_min_duration:
+                self.logger.info(
+                    "File '%s' has only %.2f seconds of data. "
+                    "%.2f are required. File will be deleted." %
+                    (filename, duration, expected_min_duration))
+                return STATUS.DOWNLOAD_REJECTED
 
-                    downloaded_bytes += size
-                    interval.status = STATUS.DOWNLOADED
-        return downloaded_bytes, discarded_bytes
+        return STATUS.DOWNLOADED
 
     def _parse_miniseed_filenames(self, filenames, restrictions):
         time_range = restrictions.minimum_length * (restrictions.endtime -
@@ -1162,8 +1730,11 @@ class ClientDownloadHelper(object):
                          "(%.2f seconds)" % (self.client_name, end - start))
 
         # Get the time intervals from the restrictions.
-        intervals = [TimeInterval(start=_i[0], end=_i[1])
-                     for _i in self.restrictions]
+        # All channels share the same time arrays until one of them is
+        # modified.
+        intervals = list(self.restrictions)
+        starts = np.array([_i[0].ns for _i in intervals], dtype=np.int64)
+        ends = np.array([_i[1].ns for _i in intervals], dtype=np.int64)
 
         for network in inv:
             # Skip network if so desired.
@@ -1198,21 +1769,29 @@ class ClientDownloadHelper(object):
                                                      station.longitude):
                     continue
 
-                channels = []
+                channels = collections.OrderedDict()
                 for channel in station.channels:
                     # Remove channels that somehow slipped past the temporal
                     # constraints due to weird behaviour from the data center.
                     if (channel.start_date > self.restrictions.endtime) or \
                             (channel.end_date < self.restrictions.starttime):
                         continue
-                    new_channel = Channel(
-                        location=channel.location_code, channel=channel.code,
-                        intervals=copy.deepcopy(intervals))
                     # Multiple channel epochs would result in duplicate
-                    # channels which we don't want. Bit of a silly logic here
-                    # to get rid of them.
-                    if new_channel not in channels:
-                        channels.append(new_channel)
+                    # channels which we don't want. Keep the highest
+                    # sampling rate of all epochs to not underestimate the
+                    # download size.
+                    key = (channel.location_code, channel.code)
+                    sampling_rate = channel.sample_rate or None
+                    if key in channels:
+                        channels[key].sampling_rate = max(
+                            channels[key].sampling_rate or 0,
+                            sampling_rate or 0) or None
+                        continue
+                    channels[key] = Channel(
+                        location=channel.location_code, channel=channel.code,
+                        intervals=TimeIntervals(starts, ends, shared=True),
+                        sampling_rate=sampling_rate)
+                channels = list(channels.values())
 
                 if self.restrictions.channel is None:
                     # Group by locations and apply the channel priority filter
@@ -16,10 +16,13 @@ from future.builtins import *  # NOQA
 
 import collections
 import logging
+import multiprocessing
 from multiprocessing.pool import ThreadPool
 import os
+import time
 import warnings
 
+import numpy as np
 from obspy.clients.fdsn.header import URL_MAPPINGS, FDSNException
 from obspy.clients.fdsn.client import Client
 
@@ -42,6 +45,11 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
+# Stands in for the client download helper of a client whose download is
+# still running when the next client is planned.
+_StationSnapshot = collections.namedtuple("_StationSnapshot", ["stations"])
+
+
 class FDSNMassDownloaderException(FDSNException):
     """
     Base exception raised by the download helpers.
@@ -64,9 +72,28 @@ class MassDownloader(object):
     :param debug: Debug flag passed to the underlying FDSN web service clients.
     :type providers: list of str or :class:`~obspy.clients.fdsn.client.Client`
         instances
+    :param connection_pool: All requests of the clients are sent over the
+        persistent connections of this pool. A new one is created if not
+        given. Passing the same pool to multiple mass downloaders lets them
+        share their connections.
+    :type connection_pool: :class:`~.utils.ConnectionPool`
+    :param service_cache: Cache of the services of the providers given by
+        name or URL. Only providers without a valid entry discover their
+        services. Defaults to a cache in the user's cache directory keeping
+        the services for one day.
+    :type service_cache: :class:`~.utils.ServiceCache`
+    :param init_timeout: Providers that could not be initialized within
+        this many seconds are skipped. Waits as long as it takes if None.
+    :type init_timeout: float
     """
-    def __init__(self, providers=None, debug=False):
+    def __init__(self, providers=None, debug=False, connection_pool=None,
+                 service_cache=None, init_timeout=None):
         self.debug = debug
+        self.connection_pool = connection_pool if connection_pool \
+            is not None else utils.ConnectionPool()
+        self.service_cache = service_cache if service_cache is not None \
+            else utils.ServiceCache()
+        self.init_timeout = init_timeout
         # If not given, use all providers ObsPy knows. They will be sorted
         # alphabetically except that ORFEUS is second to last and IRIS last.
         # The reason for this order is that smaller data centers can be
@@ -112,7 +139,10 @@ class MassDownloader(object):
 
     def download(self, domain, restrictions, mseed_storage,
                  stationxml_storage, download_chunk_size_in_mb=20,
-                 threads_per_client=3, print_report=True):
+                 threads_per_client=3, print_report=True,
+                 stream_mseed=False, overlap_stationxml=False,
+                 engine="threads", max_threads_per_client=None,
+                 retries=2, qc_processes=None):
         """
         Launch the actual data download.
 
@@ -136,96 +166,213 @@ class MassDownloader(object):
         :param threads_per_client: The number of download threads launched
             per client.
         :type threads_per_client: int
+        :param stream_mseed: If True, the MiniSEED bulk responses are split
+            into the final files while they are being received instead of
+            first being written to a temporary file.
+        :type stream_mseed: bool
+        :param overlap_stationxml: If True, the StationXML file of a station
+            is downloaded as soon as its MiniSEED data has been downloaded
+            and checked instead of after all MiniSEED data of the client.
+        :type overlap_stationxml: bool
+        :param engine: ``"threads"`` downloads with ``threads_per_client``
+            threads per client. ``"asyncio"`` runs the requests of each
+            client on a single event loop instead and limits them to
+            ``threads_per_client`` simultaneous requests per host and
+            service. In both cases the clients are downloaded one after the
+            other. Requires ``aiohttp``. It sends its requests without the
+            ``connection_pool`` and thus cannot be used if its rate limiter
+            is set.
+        :type engine: str
+        :param max_threads_per_client: If given, the number of simultaneous
+            requests to each service of a data center starts at
+            ``threads_per_client`` and adapts to the throughput, latency
+            and errors up to this number. Not supported by the
+            ``"asyncio"`` engine.
+        :type max_threads_per_client: int
+        :param retries: Failed MiniSEED requests are retried this many times
+            with an exponential backoff. If they still fail, they are split
+            into smaller requests down to single time intervals.
+        :type retries: int
+        :param qc_processes: Number of processes reading the downloaded
+            MiniSEED files that could not be checked while splitting them.
+            Defaults to the number of CPUs.
+        :type qc_processes: int
         """
+        if engine not in ("threads", "asyncio"):
+            raise ValueError("Unknown download engine '%s'." % engine)
+        if engine == "asyncio":
+            if max_threads_per_client is not None:
+                raise ValueError("The asyncio download engine does not "
+                                 "support max_threads_per_client.")
+            if self.connection_pool.rate_limiter is not None:
+                raise ValueError("The asyncio download engine does not "
+                                 "support the rate limiter of the "
+                                 "connection pool.")
         # The downloads from each client will be handled separately.
         # Nonetheless collect all in this dictionary.
         client_download_helpers = {}
 
-        # Do it sequentially for each client. Doing it in parallel is not
-        # really feasible as long as the availability queries are not
-        # reliable for all endpoints.
+        # Existence checks of the MiniSEED files are cached for the whole run
+        # as listing a directory once is a lot cheaper than checking each file.
+        file_index = utils.FileExistenceIndex()
+
+        # The client download helper objects are responsible for the
+        # downloads of a single FDSN endpoint each.
+        helpers = collections.OrderedDict()
         for client_name, client in self._initialized_clients.items():
-            # Log some information about preexisting data.
-            station_count = 0
-            for _c in client_download_helpers.values():
-                station_count += len([
-                    _i for _i in _c.stations.values() if
-                    (_i.stationxml_status == STATUS.EXISTS) or
-                    (_i.has_existing_or_downloaded_time_intervals)])
-            logger.info("Total acquired or preexisting stations: %i" %
-                        station_count)
-
-            # The client download helper object is responsible for the
-            # downloads of a single FDSN endpoint.
-            helper = ClientDownloadHelper(
+            helpers[client_name] = ClientDownloadHelper(
                 client=client, client_name=client_name,
                 restrictions=restrictions, domain=domain,
                 mseed_storage=mseed_storage,
-                stationxml_storage=stationxml_storage, logger=logger)
-            existing_client_dl_helpers = list(
-                client_download_helpers.values())
-            client_download_helpers[client_name] = helper
-
-            # Request the availability.
-            helper.get_availability()
-
-            # Continue if there is no data.
-            if not helper:
-                logger.info("Client '%s' - No data available." % client_name)
-                continue
-
-            # First filter stage. Remove stations based on the station id,
-            # e.g. NETWORK.STATION. Remove all that already exist.
-            helper.discard_stations(
-                existing_client_dl_helpers=existing_client_dl_helpers)
+                stationxml_storage=stationxml_storage, logger=logger,
+                file_index=file_index)
+
+        # Request the availability from all clients at once. It does not
+        # depend on the other clients so only the slowest one counts.
+        if helpers:
+            p = ThreadPool(len(helpers))
+            try:
+                p.map(lambda x: x.get_availability(), helpers.values())
+            finally:
+                p.close()
+
+        # Keep the available stations to be able to redo the planning.
+        available_stations = {
+            _k: dict(_v.stations) for _k, _v in helpers.items()}
+
+        # Everything else happens sequentially for each client. Doing it in
+        # parallel is not really feasible as long as the availability
+        # queries are not reliable for all endpoints and the order of the
+        # clients determines their priority. The only exception is that the
+        # planning of the next client already starts while the current one
+        # downloads. It uses a snapshot of the current client's stations and
+        # is redone if the changes during the download affect it.
+        planner = ThreadPool(1)
+        planned = None
+        if engine == "asyncio":
+            from .async_engine import AsyncDownloadEngine
+            async_engine = AsyncDownloadEngine(
+                connections_per_host=threads_per_client)
+            # Fail before downloading anything if credentials cannot be
+            # sent.
+            try:
+                for client in self._initialized_clients.values():
+                    async_engine.get_auth(client)
+            except ValueError:
+                planner.close()
+                async_engine.close()
+                raise
+        else:
+            async_engine = None
+        # Shared by all clients so data centers serving multiple clients
+        # are not overloaded.
+        if max_threads_per_client is not None:
+            concurrency = utils.AdaptiveConcurrency(
+                initial=threads_per_client, maximum=max_threads_per_client)
+        else:
+            concurrency = None
+        # Learns the compression of the data to plan the chunks of all
+        # clients.
+        size_estimator = utils.MseedSizeEstimator()
+        names = list(helpers.keys())
+        try:
+            for index, (client_name, helper) in enumerate(helpers.items()):
+                # Log some information about preexisting data.
+                station_count = 0
+                for _c in client_download_helpers.values():
+                    station_count += len([
+                        _i for _i in _c.stations.values() if
+                        (_i.stationxml_status == STATUS.EXISTS) or
+                        (_i.has_existing_or_downloaded_time_intervals)])
+                logger.info("Total acquired or preexisting stations: %i" %
+                            station_count)
+
+                existing_client_dl_helpers = list(
+                    client_download_helpers.values())
+                client_download_helpers[client_name] = helper
+
+                # Use the planning done during the download of the previous
+                # client unless the stations the previous client dropped or
+                # the files changed since affect it.
+                if planned is not None:
+                    snapshot, result = planned
+                    message = result.get()
+                # The previous clients created and deleted files after the
+                # directories have been listed.
+                file_index.invalidate()
+                if planned is not None:
+                    if self._is_plan_outdated(
+                            helper, available_stations[client_name],
+                            snapshot, existing_client_dl_helpers[-1].stations,
+                            restrictions):
+                        logger.info("Client '%s' - Stations of the previous "
+                                    "client changed during its download. "
+                                    "Planning again." % client_name)
+                        planned = None
+                    elif helper.mseed_files_changed():
+                        logger.info("Client '%s' - MiniSEED files changed "
+                                    "during the download of the previous "
+                                    "client. Planning again." % client_name)
+                        planned = None
+                    if planned is None:
+                        helper.stations = dict(
+                            available_stations[client_name])
+                if planned is None:
+                    message = self._plan_client_download(
+                        helper, existing_client_dl_helpers)
+                planned = None
+
+                # Start planning the next client against the stations this
+                # one attempts to download.
+                if index + 1 < len(names):
+                    snapshot = dict(helper.stations)
+                    planned = (snapshot, planner.apply_async(
+                        self._plan_client_download,
+                        (helpers[names[index + 1]],
+                         existing_client_dl_helpers +
+                         [_StationSnapshot(stations=snapshot)])))
+
+                if message:
+                    logger.info("Client '%s' - %s" % (client_name, message))
+                    continue
 
-            # Continue if there is no data.
-            if not helper:
-                logger.info("Client '%s' - No new data available after "
-                            "discarding already downloaded data." %
-                            client_name)
-                continue
+                # Download MiniSEED data.
+                helper.download_mseed(
+                    chunk_size_in_mb=download_chunk_size_in_mb,
+                    threads_per_client=threads_per_client,
+                    stream=stream_mseed, stationxml=overlap_stationxml,
+                    engine=async_engine, concurrency=concurrency,
+                    retries=retries, size_estimator=size_estimator,
+                    qc_processes=qc_processes)
+
+                # Download StationXML data.
+                if not overlap_stationxml:
+                    helper.prepare_stationxml_download()
+                    helper.download_stationxml(engine=async_engine,
+                                               concurrency=concurrency)
+
+                # Sanitize the downloaded things if desired. Assures that
+                # all waveform data also has the corresponding station
+                # information.
+                if restrictions.sanitize:
+                    helper.sanitize_downloads()
 
-            # If the availability information is reliable, the filtering
-            # will happen before the downloading.
-            if helper.is_availability_reliable:
-                helper.filter_stations_based_on_minimum_distance(
-                    existing_client_dl_helpers=existing_client_dl_helpers)
-                # Continue if there is no data left after the filtering.
                 if not helper:
-                    logger.info("Client '%s' - No new data available after "
-                                "discarding based on the minimal "
-                                "inter-station distance." % client_name)
+                    logger.info("Client '%s' - No data could be "
+                                "downloaded." % client_name)
                     continue
 
-            logger.info("Client '%s' - Will attempt to download data from %i "
-                        "stations." % (client_name, len(helper)))
-
-            # Download MiniSEED data.
-            helper.prepare_mseed_download()
-            helper.download_mseed(chunk_size_in_mb=download_chunk_size_in_mb,
-                                  threads_per_client=threads_per_client)
-
-            # Download StationXML data.
-            helper.prepare_stationxml_download()
-            helper.download_stationxml()
-
-            # Sanitize the downloaded things if desired. Assures that all
-            # waveform data also has the corresponding station information.
-            if restrictions.sanitize:
-                helper.sanitize_downloads()
-
-            if not helper:
-                logger.info("Client '%s' - No data could be downloaded." %
-                            client_name)
-                continue
-
-            # Filter afterwards if availability information is not reliable.
-            # This unfortunately results in already downloaded data being
-            # discarded but it is the only currently feasible way.
-            if not helper.is_availability_reliable:
-                helper.filter_stations_based_on_minimum_distance(
-                    existing_client_dl_helpers=existing_client_dl_helpers)
+                # Filter afterwards if availability information is not
+                # reliable. This unfortunately results in already downloaded
+                # data being discarded but it is the only currently feasible
+                # way.
+                if not helper.is_availability_reliable:
+                    helper.filter_stations_based_on_minimum_distance(
+                        existing_client_dl_helpers=existing_client_dl_helpers)
+        finally:
+            planner.close()
+            if async_engine is not None:
+                async_engine.close()
 
         if print_report:
             # Collect already existing things.
@@ -243,12 +390,13 @@ class MassDownloader(object):
                         new_stationxml_files[cdh.client_name].append(
                             station.stationxml_filename)
                     for channel in station.channels:
-                        for ti in channel.intervals:
-                            if ti.status == STATUS.EXISTS:
-                                existing_miniseed_files.append(ti.filename)
-                            elif ti.status == STATUS.DOWNLOADED:
-                                new_miniseed_files[cdh.client_name].append(
-                                    ti.filename)
+                        intervals = channel.intervals
+                        existing_miniseed_files.extend(
+                            [_i.filename for _i in
+                             intervals.with_status(STATUS.EXISTS)])
+                        new_miniseed_files[cdh.client_name].extend(
+                            [_i.filename for _i in
+                             intervals.with_status(STATUS.DOWNLOADED)])
 
             def count_filesize(list_of_files):
                 return sum([os.path.getsize(_i) for _i in list_of_files if
@@ -282,6 +430,87 @@ class MassDownloader(object):
 
         return client_download_helpers
 
+    @staticmethod
+    def _is_plan_outdated(helper, available, snapshot, stations,
+                          restrictions):
+        """
+        Returns True if the planning of a client done against a snapshot of
+        the stations of the previous client has to be redone with the final
+        stations of the previous client.
+
+        The previous client only ever drops stations, e.g. the ones without
+        any data. These matter if the client could download them itself or
+        if they might have gotten some of its stations rejected by the
+        minimum distance filter.
+
+        :param helper: The helper of the planned client.
+        :type helper: :class:`~.download_helpers.ClientDownloadHelper`
+        :param available: All stations available from the planned client.
+        :type available: dict
+        :param snapshot: The stations of the previous client the planning
+            has been done with.
+        :type snapshot: dict
+        :param stations: The final stations of the previous client.
+        :type stations: dict
+        :param restrictions: The restrictions of the download.
+        :type restrictions: :class:`~.restrictions.Restrictions`
+        """
+        if not set(stations).issubset(snapshot):
+            return True
+        dropped = [_v for _k, _v in snapshot.items() if _k not in stations]
+        if not dropped:
+            return False
+        if any(_k not in stations for _k in available if _k in snapshot):
+            return True
+        distance = restrictions.minimum_interstation_distance_in_m
+        # The filter is otherwise only run after the download.
+        if not distance or not helper.is_availability_reliable or \
+                not available:
+            return False
+        distances = utils.SphericalNearestNeighbour(
+            list(available.values())).query(dropped)[0]
+        return bool(np.any(distances < distance))
+
+    def _plan_client_download(self, helper, existing_client_dl_helpers):
+        """
+        Select the stations of a client and prepare the MiniSEED download.
+
+        Returns a message if there is nothing to download, otherwise None.
+
+        :param helper: The helper of the client to plan.
+        :type helper: :class:`~.download_helpers.ClientDownloadHelper`
+        :param existing_client_dl_helpers: The helpers of all clients with a
+            higher priority. Only their ``stations`` are used.
+        """
+        # Continue if there is no data.
+        if not helper:
+            return "No data available."
+
+        # First filter stage. Remove stations based on the station id,
+        # e.g. NETWORK.STATION. Remove all that already exist.
+        helper.discard_stations(
+            existing_client_dl_helpers=existing_client_dl_helpers)
+
+        # Continue if there is no data.
+        if not helper:
+            return "No new data available after discarding already " \
+                "downloaded data."
+
+        # If the availability information is reliable, the filtering
+        # will happen before the downloading.
+        if helper.is_availability_reliable:
+            helper.filter_stations_based_on_minimum_distance(
+                existing_client_dl_helpers=existing_client_dl_helpers)
+            # Continue if there is no data left after the filtering.
+            if not helper:
+                return "No new data available after discarding based on " \
+                    "the minimal inter-station distance."
+
+        logger.info("Client '%s' - Will attempt to download data from %i "
+                    "stations." % (helper.client_name, len(helper)))
+        helper.prepare_mseed_download()
+        return None
+
     def _initialize_clients(self):
         """
         Initialize all clients.
@@ -295,9 +524,14 @@ class MassDownloader(object):
             # use it.
             if isinstance(client_name, Client):
                 name, client = client_name.base_url, client_name
+                utils.enable_keep_alive(client, self.connection_pool)
             else:
                 try:
-                    this_client = Client(client_name, debug=self.debug)
+                    # The service discovery already goes through the
+                    # connection pool.
+                    this_client = self.service_cache.get_client(
+                        client_name, debug=self.debug,
+                        connection_pool=self.connection_pool)
                     name, client = client_name, this_client
                 except utils.ERRORS as e:
                     if "timeout" in str(e).lower():
@@ -322,7 +556,24 @@ class MassDownloader(object):
         p = ThreadPool(len(self.providers))
         with warnings.catch_warnings(record=True) as w:
             warnings.simplefilter("always")
-            clients = p.map(_get_client, self.providers)
+            results = [p.apply_async(_get_client, (_i,))
+                       for _i in self.providers]
+            # All are initialized at the same time so a common deadline is
+            # the same as a timeout per provider.
+            if self.init_timeout is not None:
+                deadline = time.time() + self.init_timeout
+            clients = []
+            for provider, result in zip(self.providers, results):
+                try:
+                    clients.append(result.get(
+                        None if self.init_timeout is None else
+                        max(deadline - time.time(), 0)))
+                except multiprocessing.TimeoutError:
+                    logger.warn("Failed to initialize client '%s'. "
+                                "(timeout)" % (
+                                    provider.base_url if hasattr(
+                                        provider, "base_url") else provider))
+        # Providers that did not finish in time are left behind.
         p.close()
         for warning in w:
             logger.debug("Warning during initialization of one of the "
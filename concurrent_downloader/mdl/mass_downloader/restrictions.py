@@ -14,7 +14,11 @@ from __future__ import (absolute_import, division, print_function,
 from future.builtins import *  # NOQA
 from future.utils import native_str
 
-from obspy.core.compatibility import collections_abc
+try:
+    from obspy.core.compatibility import collections_abc
+except ImportError:
+    # Newer ObsPy versions dropped their Python 2 compatibility layer.
+    import collections.abc as collections_abc
 
 import obspy
 
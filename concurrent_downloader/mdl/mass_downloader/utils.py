@@ -12,12 +12,28 @@ Utility functions required for the download helpers.
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from future.builtins import *  # NOQA
+from future.utils import native_str
 
+import bisect
 import collections
+import contextlib
+import copy
+import errno
 import fnmatch
+import functools
+import hashlib
+import heapq
+import io
 import itertools
 import os
+import pickle
+import random
+import struct
 import sys
+import tempfile
+import threading
+import time
+import warnings
 from lxml import etree
 import numpy as np
 from scipy.spatial import cKDTree
@@ -25,18 +41,68 @@ from socket import timeout as socket_timeout
 
 if sys.version_info.major == 2:
     from urllib2 import HTTPError, URLError
+    import urllib2 as urllib_request
+    import httplib as http_client
     from httplib import HTTPException
+    from urlparse import urlparse
 else:
     from urllib.error import HTTPError, URLError
+    import urllib.request as urllib_request
+    import http.client as http_client
     from http.client import HTTPException
+    from urllib.parse import urlparse
+
+# Only needed to share the rate limits between processes.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import obspy
-from obspy.core import compatibility
+try:
+    from obspy.core.compatibility import collections_abc
+except ImportError:
+    # Newer ObsPy versions dropped their Python 2 compatibility layer.
+    import collections.abc as collections_abc
 from obspy.core.util.base import NamedTemporaryFile
-from obspy.clients.fdsn.client import FDSNException
+from obspy.clients.fdsn.client import (Client, FDSNException,
+                                       get_bulk_string, raise_on_error)
+from obspy.clients.fdsn.header import (FDSNBadRequestException,
+                                       FDSNForbiddenException,
+                                       FDSNNoDataException,
+                                       FDSNRequestTooLargeException,
+                                       FDSNServiceUnavailableException,
+                                       FDSNTimeoutException,
+                                       FDSNTooManyRequestsException,
+                                       FDSNUnauthorizedException)
 from obspy.io.mseed.util import get_record_information
 
 
+# Errors after which a bulk request is not retried.
+FINAL_ERRORS = (FDSNNoDataException, FDSNUnauthorizedException,
+                FDSNForbiddenException)
+
+# Errors after which a bulk request is split without retrying it first.
+SPLIT_ERRORS = (FDSNBadRequestException, FDSNRequestTooLargeException)
+
+# Errors signaling that a data center is overloaded.
+CONGESTION_ERRORS = (FDSNServiceUnavailableException, FDSNTimeoutException,
+                     FDSNTooManyRequestsException, socket_timeout)
+
+# Default directory of the shared state of the rate limiters.
+CACHE_DIRECTORY = os.path.join(
+    os.environ.get("XDG_CACHE_HOME",
+                   os.path.join(os.path.expanduser("~"), ".cache")),
+    "concurrent_downloader")
+RATE_LIMIT_DIRECTORY = os.path.join(CACHE_DIRECTORY, "rate_limits")
+
+# Downloaded bytes are debited from the bandwidth limits in blocks of at
+# least this size. Every debit locks and writes the shared state.
+RATE_LIMIT_BLOCK_SIZE = 2 ** 18
+
+# Default directory of the service cache.
+SERVICE_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "fdsn_services")
+
 # Different types of errors that can happen when downloading data via the
 # FDSN clients.
 ERRORS = [FDSNException, HTTPException, HTTPError, URLError, socket_timeout]
@@ -51,10 +117,57 @@ else:
 
 ERRORS = tuple(ERRORS)
 
+
+class MseedParseError(FDSNException):
+    """
+    Raised if a data center sent something that looks like a MiniSEED
+    record but cannot be parsed. Being an FDSN error, the request is
+    retried and bisected like any other failed request.
+    """
+
 # mean earth radius in meter as defined by the International Union of
 # Geodesy and Geophysics. Used for the spherical kd-tree.
 EARTH_RADIUS = 6371009
 
+# Number of bytes that are read ahead when splitting MiniSEED data. Has to be
+# at least as large as the largest expected record as the record length of
+# records without blockette 1000 can only be determined by looking at the
+# following record.
+MAX_RECORD_LENGTH = 2 ** 14
+
+# Size of the blocks read from files or HTTP responses while splitting.
+READ_BLOCK_SIZE = 2 ** 20
+
+# Maximum number of simultaneously open output files of a FileHandlePool and
+# the number of bytes buffered per file before it is written.
+MAX_OPEN_FILES = 64
+WRITE_BUFFER_SIZE = 2 ** 18
+
+# Typical sampling rates of the SEED band codes. Only used if the station
+# service did not return the sampling rate of a channel.
+BAND_CODE_SAMPLING_RATES = {
+    "F": 5000, "G": 5000, "D": 1000, "C": 1000, "E": 250, "S": 80,
+    "H": 250, "B": 80, "M": 10, "L": 1, "V": 0.1, "U": 0.01,
+    "R": 0.001, "P": 0.0001, "T": 0.00001, "Q": 0.000001, "A": 5000,
+    "O": 5000}
+
+# Assume that each sample needs 4 byte, STEIM compression reduces size to
+# about a third. Used until the actual size of some data is known.
+DEFAULT_BYTES_PER_SAMPLE = 4.0 / 3.0
+
+# Data type of the arrays returned by scan_mseed_headers(). Times are in
+# nanoseconds since the epoch, the offset is the position of the record in
+# the file.
+MSEED_HEADER_DTYPE = np.dtype([
+    ("network", "U2"), ("station", "U5"), ("location", "U2"),
+    ("channel", "U3"), ("starttime", np.int64), ("endtime", np.int64),
+    ("npts", np.int64), ("sampling_rate", np.float64),
+    ("record_length", np.int64), ("offset", np.int64)])
+
+
+# Prefix of mseed_storage settings that result in an SDS archive.
+SDS_KEY = "{<SDSdir>}:"
+
 
 ChannelAvailability = collections.namedtuple(
     "ChannelAvailability",
@@ -62,7 +175,8 @@ ChannelAvailability = collections.namedtuple(
      "filename"])
 
 
-def download_stationxml(client, client_name, bulk, filename, logger):
+def download_stationxml(client, client_name, bulk, filename, logger,
+                        controller=None):
     """
     Download all channels for a station in the already prepared bulk list.
 
@@ -74,6 +188,9 @@ def download_stationxml(client, client_name, bulk, filename, logger):
         to come from the same station.
     :param filename: The filename to download to.
     :param logger: The logger instance to use for logging.
+    :param controller: Limits the simultaneous requests to the station
+        service and learns from this one.
+    :type controller: :class:`ConcurrencyController`
 
     :returns: A tuple with the network and station id and the filename upon
         success
@@ -81,8 +198,14 @@ def download_stationxml(client, client_name, bulk, filename, logger):
     network = bulk[0][0]
     station = bulk[0][1]
     try:
-        client.get_stations_bulk(bulk=bulk, level="response",
-                                 filename=filename)
+        if controller is None:
+            client.get_stations_bulk(bulk=bulk, level="response",
+                                     filename=filename)
+        else:
+            with controller.request() as request:
+                client.get_stations_bulk(bulk=bulk, level="response",
+                                         filename=filename)
+                request.nbytes = os.path.getsize(filename)
     except Exception:
         logger.info("Failed to download StationXML from '%s' for station "
                     "'%s.%s'." % (client_name, network, station))
@@ -92,7 +215,9 @@ def download_stationxml(client, client_name, bulk, filename, logger):
     return ((network, station), filename)
 
 
-def download_and_split_mseed_bulk(client, client_name, chunks, logger):
+def download_and_split_mseed_bulk(client, client_name, chunks, logger,
+                                  stream=False, file_pool=None,
+                                  controller=None, qc=None):
     """
     Downloads the channels of a list of stations in bulk, saves it to a
     temporary folder and splits it at the record level to obtain the final
@@ -109,41 +234,311 @@ def download_and_split_mseed_bulk(client, client_name, chunks, logger):
         Each chunk is a tuple of network, station, location, channel,
         starttime, endtime, and desired filename.
     :param logger: An active logger instance.
+    :param stream: If True, the temporary file is skipped and the records
+        are split while the HTTP response is still being received. Requires
+        an FDSN client with a dataselect service.
+    :type stream: bool
+    :param file_pool: The pool the final files are written with. Can be
+        shared between threads to bound the number of open files. A private
+        one is used if not given. All files of this request are flushed and
+        closed before returning.
+    :type file_pool: :class:`FileHandlePool`
+    :param controller: Limits the simultaneous requests to the dataselect
+        service and learns from this one.
+    :type controller: :class:`ConcurrencyController`
+    :param qc: Decides which of the final files are kept, see
+        :class:`MseedBulkSplitter`. Only the accepted files are returned.
     """
-    # Create a dictionary of channel ids, each containing a list of
-    # intervals, each of which will end up in a separate file.
-    filenames = collections.defaultdict(list)
-    for chunk in chunks:
-        candidate = {
-            "starttime": chunk[4],
-            "endtime": chunk[5],
-            "filename": chunk[6],
-            "current_latest_endtime": None,
-            "sequence_number": None}
-        # Should not be necessary if chunks have been deduplicated before but
-        # better safe than sorry.
-        if candidate in filenames[tuple(chunk[:4])]:
-            continue
-        filenames[tuple(chunk[:4])].append(candidate)
+    splitter = MseedBulkSplitter(chunks, file_pool=file_pool, qc=qc)
+    try:
+        if controller is None:
+            _download_and_split(client, splitter, stream)
+        else:
+            with controller.request() as request:
+                _download_and_split(client, splitter, stream)
+                request.nbytes = splitter.nbytes
+    except BaseException:
+        # Do not leave the files of a partially received response behind.
+        splitter.discard()
+        raise
+    finally:
+        splitter.close()
+    logger.info("Client '%s' - Successfully downloaded %i channels (of %i)" % (
+        client_name, len(splitter.written_files),
+        splitter.original_bulk_length))
+    return sorted(splitter.written_files)
+
+
+def download_and_split_mseed_bulk_with_retry(
+        client, client_name, chunks, logger, retries=2, backoff=1.0,
+        **kwargs):
+    """
+    :func:`download_and_split_mseed_bulk` retrying failed requests.
+
+    A failed request is retried up to ``retries`` times after waiting
+    ``backoff * 2 ** n`` seconds with a random jitter of +/- 50 %. Requests
+    the data center rejected as invalid or too large are not retried.
+    Missing data and authentication failures are raised right away.
+
+    If the request still fails, the chunks are split in two halves which
+    are requested separately in the same way. Every failed half is split
+    again down to single chunks to isolate the offending ones, unless the
+    error is final. Chunks that still fail on their own are logged and
+    skipped.
+
+    :param retries: The number of retries of each request.
+    :type retries: int
+    :param backoff: The initial waiting time in seconds.
+    :type backoff: float
+    :param kwargs: Passed on to :func:`download_and_split_mseed_bulk`.
+    """
+    def download(chunks):
+        for attempt in range(retries + 1):
+            try:
+                return download_and_split_mseed_bulk(
+                    client, client_name, chunks, logger, **kwargs)
+            except FINAL_ERRORS:
+                raise
+            except ERRORS as e:
+                if isinstance(e, SPLIT_ERRORS) or attempt == retries:
+                    raise
+                wait = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.info("Client '%s' - Request of %i chunks failed. "
+                            "Retrying in %.1f seconds." % (
+                                client_name, len(chunks), wait))
+                time.sleep(wait)
+
+    def bisect(chunks, error):
+        # The chunks failed as a whole.
+        if len(chunks) < 2 or isinstance(error, FINAL_ERRORS):
+            raise error
+        logger.info("Client '%s' - Request of %i chunks failed. Splitting "
+                    "it." % (client_name, len(chunks)))
+        half = len(chunks) // 2
+        filenames = []
+        failed = []
+        for part in (chunks[:half], chunks[half:]):
+            try:
+                filenames.extend(download(part))
+            except ERRORS as e:
+                failed.append((part, e))
+        for part, e in failed:
+            try:
+                filenames.extend(bisect(part, e))
+            except ERRORS as e:
+                log_mseed_download_error(logger, client_name, e)
+        return filenames
+
+    try:
+        return download(chunks)
+    except ERRORS as e:
+        return bisect(chunks, e)
+
+
+def log_mseed_download_error(logger, client_name, error):
+    """
+    Log the error of a MiniSEED download. Missing data is not an error.
+    """
+    msg = ("Client '%s' - " % client_name) + str(error)
+    if "no data available" in msg.lower():
+        logger.info(msg.split("Detailed response")[0].strip())
+    else:
+        logger.error(msg)
+
+
+def _download_and_split(client, splitter, stream):
+    if stream:
+        # Split the records as they arrive.
+        response = open_waveforms_bulk_stream(client, splitter.bulk)
+        try:
+            splitter.split(response)
+            # Reading stops without an error if the connection is closed
+            # early.
+            if getattr(response, "length", None):
+                raise http_client.IncompleteRead(b"", response.length)
+        finally:
+            response.close()
+    else:
+        # Save first to a temporary file, then cut the file into separate
+        # files.
+        with NamedTemporaryFile() as tf:
+            temp_filename = tf.name
+            client.get_waveforms_bulk(splitter.bulk, filename=temp_filename)
+            # If that succeeds, split the old file into multiple new ones.
+            with open(temp_filename, "rb") as fh:
+                splitter.split(fh)
 
-    sequence_number = [0]
 
-    def get_filename(starttime, endtime, c):
+class MseedBulkSplitter(object):
+    """
+    Routes the records of a bulk MiniSEED request to the final files of the
+    requested time intervals.
+
+    :param chunks: A list of tuples, each denoting a single MiniSEED chunk.
+        Each chunk is a tuple of network, station, location, channel,
+        starttime, endtime, and desired filename.
+    :param file_pool: The pool the final files are written with. A private
+        one is used if not given.
+    :type file_pool: :class:`FileHandlePool`
+    :param qc: Called when the splitter is closed for every written file
+        with the filename, the number of bytes, the continuous segments as
+        returned by :func:`get_trace_segments`, and the start and end time
+        of its time interval in nanoseconds. Files for which it returns
+        False are deleted, usually before anything has been written to
+        disk.
+    """
+    def __init__(self, chunks, file_pool=None, qc=None):
+        # Create a dictionary of channel ids, each containing a list of
+        # intervals, each of which will end up in a separate file.
+        filenames = collections.defaultdict(list)
+        seen = set()
+        for chunk in chunks:
+            # Should not be necessary if chunks have been deduplicated before
+            # but better safe than sorry.
+            key = (tuple(chunk[:4]), chunk[4].ns, chunk[5].ns, chunk[6])
+            if key in seen:
+                continue
+            seen.add(key)
+            # All times are handled as integer nanoseconds while splitting.
+            filenames[tuple(chunk[:4])].append({
+                "starttime": chunk[4].ns,
+                "endtime": chunk[5].ns,
+                "filename": chunk[6],
+                "current_latest_endtime": None,
+                "sequence_number": None})
+        # Index the candidates of each channel to not have to scan all of
+        # them for every single record.
+        self.filenames = {key: IntervalIndex(value)
+                          for key, value in filenames.items()}
+        self.sequence_number = 0
+
+        # Only the filename is not needed for the actual data request.
+        bulk = [list(_i[:-1]) for _i in chunks]
+        self.original_bulk_length = len(bulk)
+
+        # Merge adjacent bulk-request for continuous downloads. This is a bit
+        # redundant after splitting it up before, but eases the logic in the
+        # other parts and puts less strain on the data centers' FDSN
+        # implementation. It furthermore avoid the repeated download of
+        # records that are part of two neighbouring time intervals.
+        bulk_channels = collections.defaultdict(list)
+        for b in bulk:
+            bulk_channels[(b[0], b[1], b[2], b[3])].append(b)
+
+        # Merge them.
+        for key, value in bulk_channels.items():
+            # Sort based on starttime.
+            value = sorted(value, key=lambda x: x[4])
+            # Merge adjacent.
+            cur_bulk = value[0:1]
+            for b in value[1:]:
+                # Random threshold of 2 seconds. Reasonable for most real
+                # world cases.
+                if b[4] <= cur_bulk[-1][5] + 2:
+                    cur_bulk[-1][5] = b[5]
+                    continue
+                cur_bulk.append(b)
+            bulk_channels[key] = cur_bulk
+        self.bulk = list(itertools.chain.from_iterable(
+            bulk_channels.values()))
+
+        self.file_pool = file_pool if file_pool is not None \
+            else FileHandlePool()
+        self.written_files = set()
+        # Number of bytes of all received records.
+        self.nbytes = 0
+        self.qc = qc
+        # Time interval, number of bytes, and record start times, end times
+        # and sampling rates of each written file.
+        self._stats = {}
+
+    def split(self, fh):
         """
-        Helper function finding the corresponding filename in all filenames.
+        Route each record of the given file-like object to its final file.
 
-        :param starttime: The start time of the record.
-        :param endtime: The end time of the record.
-        :param c: A list of candidates.
+        :param fh: An open binary file-like object positioned at the first
+            record.
+        """
+        for channel_id, starttime, endtime, sampling_rate, record in \
+                iter_mseed_records(fh):
+            self.nbytes += len(record)
+            # Sometimes the services return something nobody wants...
+            if channel_id not in self.filenames:
+                continue
+            # Get the best matching time interval.
+            interval = self._get_interval(
+                starttime=starttime, endtime=endtime,
+                c=self.filenames[channel_id])
+            # Again sometimes there are time ranges nobody asked for...
+            if interval is None:
+                continue
+            filename = interval["filename"]
+            if filename not in self._stats:
+                self._stats[filename] = [interval, 0, [], [], []]
+            stats = self._stats[filename]
+            stats[1] += len(record)
+            stats[2].append(starttime)
+            stats[3].append(endtime)
+            stats[4].append(sampling_rate)
+            self.written_files.add(filename)
+            self.file_pool.write(filename, record)
+
+    def get_segments(self, filename):
+        """
+        The continuous segments of a written file, computed from the records
+        that passed through the splitter. Same as
+        :func:`get_mseed_segments` but without reading the file again.
+        """
+        _, _, starttimes, endtimes, sampling_rates = self._stats[filename]
+        headers = np.zeros(len(starttimes), dtype=MSEED_HEADER_DTYPE)
+        headers["starttime"] = starttimes
+        headers["endtime"] = endtimes
+        headers["sampling_rate"] = sampling_rates
+        return get_trace_segments(headers)
+
+    def close(self):
+        """
+        Run the QC on all files written so far, delete the rejected ones and
+        flush and close the others.
+        """
+        if self.qc is not None:
+            rejected = set()
+            for filename in sorted(self.written_files):
+                interval, nbytes = self._stats[filename][:2]
+                if not self.qc(filename, nbytes,
+                               self.get_segments(filename),
+                               interval["starttime"], interval["endtime"]):
+                    rejected.add(filename)
+            self.file_pool.discard(rejected)
+            self.written_files -= rejected
+        self.file_pool.close(self.written_files)
+        self._stats = {}
+
+    def discard(self):
+        """
+        Delete all files written so far.
+        """
+        self.file_pool.discard(self.written_files)
+        self.written_files = set()
+        self._stats = {}
+
+    def _get_interval(self, starttime, endtime, c):
+        """
+        Helper function finding the corresponding time interval in all
+        candidates.
+
+        :param starttime: The start time of the record in nanoseconds.
+        :param endtime: The end time of the record in nanoseconds.
+        :param c: The :class:`IntervalIndex` of all candidates.
         """
         # Make two passes. First find all candidates. This assumes that a
         # record cannot be larger than a single desired time interval. This
         # is probably always given except if somebody wants to download
         # files split into 1 second intervals...
-        candidates = [
-            _i for _i in c if
-            (_i["starttime"] <= starttime <= _i["endtime"]) or
-            (_i["starttime"] <= endtime <= _i["endtime"])]
+        candidates = c.query(starttime)
+        for _i in c.query(endtime):
+            if not any(_i is _j for _j in candidates):
+                candidates.append(_i)
         if not candidates:
             return None
 
@@ -197,87 +592,1486 @@ def download_and_split_mseed_bulk(client, client_name, chunks, logger):
 
         # Increment sequence number and make sure the current chunk is aware
         # of it.
-        sequence_number[0] += 1
-        ret_val["sequence_number"] = sequence_number[0]
+        self.sequence_number += 1
+        ret_val["sequence_number"] = self.sequence_number
 
         # Also write the time of the last chunk to it if necessary.
         ce = ret_val["current_latest_endtime"]
         if not ce or endtime > ce:
             ret_val["current_latest_endtime"] = endtime
 
-        return ret_val["filename"]
-
-    # Only the filename is not needed for the actual data request.
-    bulk = [list(_i[:-1]) for _i in chunks]
-    original_bulk_length = len(bulk)
-
-    # Merge adjacent bulk-request for continuous downloads. This is a bit
-    # redundant after splitting it up before, but eases the logic in the
-    # other parts and puts less strain on the data centers' FDSN
-    # implementation. It furthermore avoid the repeated download of records
-    # that are part of two neighbouring time intervals.
-    bulk_channels = collections.defaultdict(list)
-    for b in bulk:
-        bulk_channels[(b[0], b[1], b[2], b[3])].append(b)
-
-    # Merge them.
-    for key, value in bulk_channels.items():
-        # Sort based on starttime.
-        value = sorted(value, key=lambda x: x[4])
-        # Merge adjacent.
-        cur_bulk = value[0:1]
-        for b in value[1:]:
-            # Random threshold of 2 seconds. Reasonable for most real world
-            # cases.
-            if b[4] <= cur_bulk[-1][5] + 2:
-                cur_bulk[-1][5] = b[5]
+        return ret_val
+
+
+def iter_mseed_records(fh, block_size=READ_BLOCK_SIZE):
+    """
+    Iterate over all MiniSEED records of a binary file-like object.
+
+    The object is only read sequentially in blocks so this works for files
+    as well as for HTTP responses that are still being received. The headers
+    of all complete records in a block are decoded at once with
+    :func:`scan_mseed_headers`. Data that cannot be handled by it, e.g.
+    records without blockette 1000, is parsed record by record with ObsPy.
+    Trailing bytes shorter than 256 bytes are ignored. Iterating stops with
+    a warning at the first bytes that are not a MiniSEED data record, e.g.
+    zero padding at the end of a response. Records that ObsPy cannot parse
+    raise a :class:`MseedParseError`.
+
+    :param fh: An open binary file-like object.
+    :param block_size: The number of bytes to read at once.
+    :type block_size: int
+    :returns: Generator yielding tuples of the channel id (a tuple of
+        network, station, location, and channel code), the start and end
+        time of the record in nanoseconds, its sampling rate, and the raw
+        bytes of the record.
+    """
+    buf = b""
+    pos = 0
+    eof = False
+    fast = True
+    while True:
+        # Make sure a full record is available if there is one.
+        while not eof and len(buf) - pos < MAX_RECORD_LENGTH:
+            data = fh.read(block_size)
+            if not data:
+                eof = True
+                break
+            buf = buf[pos:] + data
+            pos = 0
+        if len(buf) - pos < 256:
+            break
+
+        if fast:
+            try:
+                headers, consumed = _scan_mseed_buffer(memoryview(buf)[pos:])
+            except ValueError:
+                fast = False
+            else:
+                for h in headers.tolist():
+                    offset = pos + h[9]
+                    yield h[:4], h[4], h[5], h[7], \
+                        buf[offset:offset + h[8]]
+                # Should not happen as a full record always fits into the
+                # buffer but guard against an endless loop.
+                if not consumed:
+                    break
+                pos += consumed
                 continue
-            cur_bulk.append(b)
-        bulk_channels[key] = cur_bulk
-    bulk = list(itertools.chain.from_iterable(bulk_channels.values()))
 
-    # Save first to a temporary file, then cut the file into separate files.
-    with NamedTemporaryFile() as tf:
-        temp_filename = tf.name
-        open_files = {}
+        if buf[pos + 6:pos + 7] not in (b"D", b"R", b"Q", b"M"):
+            # Drain the rest of the response.
+            ignored = len(buf) - pos
+            while not eof:
+                data = fh.read(block_size)
+                eof = not data
+                ignored += len(data)
+            warnings.warn("Ignoring %i bytes that are not MiniSEED data "
+                          "records." % ignored)
+            break
+        # Only pass the start of the current record to not have ObsPy
+        # seek through everything else.
+        try:
+            info = get_record_information(
+                io.BytesIO(buf[pos:pos + MAX_RECORD_LENGTH]))
+        except Exception as e:
+            raise MseedParseError("Could not parse a MiniSEED record: %s" %
+                                  str(e))
+        record_length = info["record_length"]
+        yield ((info["network"], info["station"], info["location"],
+                info["channel"]), info["starttime"].ns, info["endtime"].ns,
+               info["samp_rate"], buf[pos:pos + record_length])
+        pos += record_length
+
+
+def scan_mseed_headers(filename_or_buffer):
+    """
+    Decode the fixed section data headers of all records in a MiniSEED file
+    in a single vectorized pass.
+
+    Much faster than reading the file with ObsPy if only the header
+    information is needed. Only records with blockette 1000 are supported,
+    a :class:`ValueError` is raised otherwise so callers can fall back to
+    ObsPy. Blockettes 100, 500, and 1001 are honored in the same way as by
+    :func:`~obspy.io.mseed.util.get_record_information`.
+
+    :param filename_or_buffer: The filename or a bytes-like object.
+    :returns: A structured array with the :data:`MSEED_HEADER_DTYPE` data
+        type, one entry per record. Times are integer nanoseconds since the
+        epoch, the end time is the time of the last sample.
+    """
+    if isinstance(filename_or_buffer, (str, native_str)):
+        if not os.path.getsize(filename_or_buffer):
+            return np.empty(0, dtype=MSEED_HEADER_DTYPE)
+        buf = np.memmap(filename_or_buffer, dtype=np.uint8, mode="r")
+    else:
+        buf = filename_or_buffer
+    return _scan_mseed_buffer(buf)[0]
+
+
+def get_trace_segments(headers):
+    """
+    Merge the records of a MiniSEED file into continuous segments the same
+    way reading the file would create traces.
+
+    Two records of the same channel and sampling rate are considered
+    continuous if the start of the second is within half a sample of the
+    expected time.
+
+    :param headers: The record headers as returned by
+        :func:`scan_mseed_headers`.
+    :returns: A list of tuples of the channel id, the start, and the end
+        time of each segment in nanoseconds.
+    """
+    n = len(headers)
+    if not n:
+        return []
+    # Records of a channel usually come in runs - only sort the runs.
+    keys = ["network", "station", "location", "channel"]
+    change = np.ones(n, dtype=bool)
+    for key in keys:
+        change[1:] |= headers[key][1:] != headers[key][:-1]
+    runs = np.flatnonzero(change)
+    index = collections.OrderedDict()
+    group = [index.setdefault(_i, len(index)) for _i in
+             zip(*[headers[key][runs].tolist() for key in keys])]
+    ids = list(index.keys())
+    group = np.repeat(group, np.diff(np.append(runs, n)))
+    sampling_rate = headers["sampling_rate"]
+
+    # Sort by channel and sampling rate but otherwise keep the order of the
+    # file.
+    order = np.lexsort((np.arange(n), sampling_rate, group))
+    group = group[order]
+    sampling_rate = sampling_rate[order]
+    starttime = headers["starttime"][order]
+    endtime = headers["endtime"][order]
+
+    with np.errstate(divide="ignore"):
+        period = np.where(sampling_rate > 0, 1E9 / sampling_rate, 0.0)
+    # A new segment starts at every change of the channel or the sampling
+    # rate and at every gap or overlap larger than half a sample.
+    new = np.ones(n, dtype=bool)
+    new[1:] = (group[1:] != group[:-1]) | \
+        (sampling_rate[1:] != sampling_rate[:-1]) | \
+        (sampling_rate[1:] <= 0) | \
+        (np.abs(starttime[1:] - (endtime[:-1] + period[1:])) >
+         0.5 * period[1:])
+    first = np.flatnonzero(new)
+    ends = np.maximum.reduceat(endtime, first)
+
+    segments = sorted(zip(order[first].tolist(), group[first].tolist(),
+                          starttime[first].tolist(), ends.tolist()))
+    return [(ids[_i[1]], _i[2], _i[3]) for _i in segments]
+
+
+def get_mseed_segments(filename):
+    """
+    Get the continuous segments of a MiniSEED file without reading the data.
+
+    Uses the vectorized header scanner and falls back to reading the headers
+    with ObsPy for files it cannot handle. Raises if neither can read the
+    file.
+
+    :param filename: The MiniSEED file.
+    :returns: A list of tuples of the channel id, the start, and the end time
+        of each segment in nanoseconds.
+    """
+    try:
+        return get_trace_segments(scan_mseed_headers(filename))
+    except ValueError:
+        st = obspy.read(filename, headonly=True)
+        return [((tr.stats.network, tr.stats.station, tr.stats.location,
+                  tr.stats.channel), tr.stats.starttime.ns,
+                 tr.stats.endtime.ns) for tr in st]
+
+
+def _scan_mseed_buffer(buf):
+    """
+    Decode the headers of all complete records in a buffer.
+
+    :param buf: A bytes-like object or an uint8 array.
+    :returns: A tuple of the structured header array and the number of bytes
+        spanned by the complete records.
+    """
+    if not isinstance(buf, np.ndarray):
+        buf = np.frombuffer(buf, dtype=np.uint8)
+    size = len(buf)
+    if size < 64:
+        return np.empty(0, dtype=MSEED_HEADER_DTYPE), 0
+
+    # Assume a constant record length first which is almost always the case
+    # and then check it.
+    first_length = int(_decode_mseed_headers(
+        buf, np.zeros(1, dtype=np.int64))["record_length"][0])
+    offsets = np.arange(size // first_length, dtype=np.int64) * first_length
+    try:
+        headers = _decode_mseed_headers(buf, offsets)
+        uniform = np.all(headers["record_length"] == first_length)
+    except ValueError:
+        uniform = False
+
+    if not uniform:
+        # Varying record lengths. Walk the records one by one.
+        offsets = []
+        position = 0
+        while position + 64 <= size:
+            try:
+                length = int(_decode_mseed_headers(
+                    buf, np.array([position], dtype=np.int64))[
+                        "record_length"][0])
+            except ValueError:
+                # Return the records before it, the caller deals with the
+                # rest.
+                if not offsets:
+                    raise
+                break
+            if position + length > size:
+                break
+            offsets.append(position)
+            position += length
+        headers = _decode_mseed_headers(
+            buf, np.array(offsets, dtype=np.int64))
+
+    if not len(headers):
+        return headers, 0
+    return headers, int(headers["offset"][-1] + headers["record_length"][-1])
+
+
+def _decode_mseed_headers(buf, offsets):
+    """
+    Vectorized decoding of the record headers starting at the given offsets.
+
+    :param buf: The uint8 buffer.
+    :param offsets: The byte offsets of the records as an int64 array.
+    """
+    size = len(buf)
+    n = len(offsets)
+    headers = np.empty(n, dtype=MSEED_HEADER_DTYPE)
+    if not n:
+        return headers
+
+    h = buf[offsets[:, None] + np.arange(48)]
+    if not np.all(np.isin(h[:, 6], np.frombuffer(b"DRQM", dtype=np.uint8))):
+        raise ValueError("Not a MiniSEED data record.")
+
+    # Only decode the codes once per distinct channel.
+    raw = np.ascontiguousarray(h[:, 8:20])
+    change = np.ones(n, dtype=bool)
+    change[1:] = np.any(raw[1:] != raw[:-1], axis=1)
+    runs = np.flatnonzero(change)
+    codes, inverse = np.unique(raw[runs].view("S12").ravel(),
+                               return_inverse=True)
+    inverse = np.repeat(inverse.ravel(), np.diff(np.append(runs, n)))
+    codes = [_i.ljust(12).decode("ascii", "replace") for _i in codes.tolist()]
+    for key, start, end in (("station", 0, 5), ("location", 5, 7),
+                            ("channel", 7, 10), ("network", 10, 12)):
+        headers[key] = np.array(
+            [_i[start:end].strip() for _i in codes])[inverse]
+    headers["offset"] = offsets
+
+    # The byte order is determined per record based on a plausible year and
+    # day of year in the big endian interpretation.
+    big_year = h[:, 20].astype(np.int64) << 8 | h[:, 21]
+    big_julday = h[:, 22].astype(np.int64) << 8 | h[:, 23]
+    little = (big_julday < 1) | (big_julday > 366) | (big_year < 1900) | \
+        (big_year > 2500)
+
+    def _unsigned(b, start, length):
+        value = np.zeros(len(b), dtype=np.int64)
+        for i in range(length):
+            shift_big = 8 * (length - 1 - i)
+            shift_little = 8 * i
+            value += b[:, start + i].astype(np.int64) << np.where(
+                little, shift_little, shift_big)
+        return value
+
+    def _signed(b, start, length):
+        value = _unsigned(b, start, length)
+        limit = 1 << (8 * length - 1)
+        return np.where(value >= limit, value - (limit << 1), value)
+
+    year = _unsigned(h, 20, 2)
+    julday = _unsigned(h, 22, 2)
+    if np.any((julday < 1) | (julday > 366)):
+        raise ValueError("Invalid day of year in MiniSEED record.")
+    days = (year - 1970).astype("datetime64[Y]").astype(
+        "datetime64[D]").astype(np.int64) + julday - 1
+    hms = h[:, 24:27].astype(np.int64)
+    seconds = days * 86400 + hms[:, 0] * 3600 + hms[:, 1] * 60 + hms[:, 2]
+    # Fractional seconds are in units of 0.0001 seconds.
+    starttime = seconds * 10 ** 9 + _unsigned(h, 28, 2) * 100000
+
+    npts = _unsigned(h, 30, 2)
+    factor = _signed(h, 32, 2)
+    multiplier = _signed(h, 34, 2)
+    # Time correction if not yet applied.
+    correction = _signed(h, 40, 4)
+    starttime += np.where(h[:, 36] & 2, 0, correction * 100000)
+
+    # Sampling rate as defined in the SEED manual.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f = factor.astype(np.float64)
+        m = multiplier.astype(np.float64)
+        sampling_rate = np.select(
+            [(f > 0) & (m > 0), (f > 0) & (m < 0), (f < 0) & (m > 0),
+             (f < 0) & (m < 0)],
+            [f * m, -f / m, -m / f, 1.0 / (f * m)], default=0.0)
+
+    # Walk the blockette chains of all records simultaneously.
+    record_length = np.zeros(n, dtype=np.int64)
+    blockette = _unsigned(h, 46, 2)
+    active = blockette > 0
+    while np.any(active):
+        idx = np.minimum(offsets[:, None] + blockette[:, None] +
+                         np.arange(19), size - 1)
+        b = buf[idx]
+        b_type = _unsigned(b, 0, 2)
+        next_blockette = _unsigned(b, 2, 2)
+        if np.any(active & (next_blockette != 0) &
+                  ((next_blockette < 4) | (next_blockette - 4 <=
+                                           blockette))):
+            raise ValueError("Invalid blockette offset.")
+
+        is_b1000 = active & (b_type == 1000)
+        record_length[is_b1000] = 2 ** b[is_b1000, 6].astype(np.int64)
+        is_b1001 = active & (b_type == 1001)
+        starttime[is_b1001] += \
+            b[is_b1001, 5].astype(np.int8).astype(np.int64) * 1000
+        is_b500 = active & (b_type == 500)
+        starttime[is_b500] += \
+            b[is_b500, 18].astype(np.int8).astype(np.int64) * 1000
+        is_b100 = active & (b_type == 100)
+        if np.any(is_b100):
+            raw = b[is_b100, 4:8]
+            raw = np.where(little[is_b100, None], raw[:, ::-1], raw)
+            sampling_rate[is_b100] = np.ascontiguousarray(raw).view(
+                ">f4").ravel()
+
+        blockette = np.where(active, next_blockette, 0)
+        active = blockette > 0
+
+    if np.any(record_length == 0):
+        raise ValueError("MiniSEED record without blockette 1000.")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        duration = np.where(
+            sampling_rate > 0,
+            np.round((npts - 1) / sampling_rate * 1E9), 0).astype(np.int64)
+
+    headers["starttime"] = starttime
+    headers["endtime"] = starttime + duration
+    headers["npts"] = npts
+    headers["sampling_rate"] = sampling_rate
+    headers["record_length"] = record_length
+    return headers
+
+
+def open_waveforms_bulk_stream(client, bulk):
+    """
+    Send a bulk request to the dataselect service of an FDSN client and
+    return the still open HTTP response so the data can be consumed while
+    it is being received.
+
+    Errors are raised in the same way as by
+    :meth:`~obspy.clients.fdsn.client.Client.get_waveforms_bulk`.
+
+    :param client: An active FDSN client instance.
+    :type client: :class:`~obspy.clients.fdsn.client.Client`
+    :param bulk: The bulk request as a list of network, station, location,
+        channel, starttime, endtime tuples.
+    :returns: The open HTTP response. Must be closed by the caller.
+    """
+    if "dataselect" not in client.services:
+        raise FDSNException("The current client does not have a dataselect "
+                            "service.")
+    url = client._build_url("dataselect", "query")
+    headers = client.request_headers.copy()
+    headers["Content-Type"] = "text/plain"
+    # Do not ask for gzip - MiniSEED data barely compresses and the gzip
+    # stream could not be split on the fly.
+    request = urllib_request.Request(url=url, headers=headers)
+    try:
+        response = client._url_opener.open(
+            request, data=get_bulk_string(bulk, {}), timeout=client.timeout)
+    except HTTPError as e:
+        try:
+            details = e.read()
+        except Exception:
+            details = None
+        raise_on_error(e.code, details)
+    except Exception as e:
+        raise_on_error(None, e)
+
+    code = response.getcode()
+    if code != 200:
+        response.close()
+        raise_on_error(code, None)
+    return response
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent HTTP and HTTPS connections.
+
+    Connections are kept alive after a request and reused by the next
+    request to the same host, sparing it the TCP and TLS handshakes. A
+    single pool can be shared by any number of clients and threads - each
+    data center ends up with its own set of connections.
+
+    The idle connections are not pickled, a copy in another process starts
+    out empty.
+
+    :param max_idle_per_host: The maximum number of idle connections kept
+        per host. Further connections are closed once their request is done.
+    :type max_idle_per_host: int
+    :param rate_limiter: Limits the requests and the bandwidth per host of
+        all requests sent over the pool.
+    :type rate_limiter: :class:`RateLimiter`
+    """
+    def __init__(self, max_idle_per_host=16, rate_limiter=None):
+        self.max_idle_per_host = max_idle_per_host
+        self.rate_limiter = rate_limiter
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"max_idle_per_host": self.max_idle_per_host,
+                "rate_limiter": self.rate_limiter}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def acquire(self, scheme, host, timeout):
+        """
+        Get a connection to the given host.
+
+        Returns the connection and whether it has been used before.
+        """
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+        if scheme == "https":
+            connection = http_client.HTTPSConnection(host, timeout=timeout)
+        else:
+            connection = http_client.HTTPConnection(host, timeout=timeout)
+        connection.response_class = _PooledHTTPResponse
+        return connection, False
+
+    def release(self, scheme, host, connection):
+        """
+        Return a connection whose response has been read completely.
+        """
+        with self._lock:
+            idle = self._idle[(scheme, host)]
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle = list(itertools.chain.from_iterable(self._idle.values()))
+            self._idle.clear()
+        for connection in idle:
+            connection.close()
+
 
-        client.get_waveforms_bulk(bulk, filename=temp_filename)
-        # If that succeeds, split the old file into multiple new ones.
-        file_size = os.path.getsize(temp_filename)
+class _PooledHTTPResponse(http_client.HTTPResponse):
+    """
+    Response handing its connection back to the pool once the body has been
+    read to the end.
+    """
+    _release = None
+
+    def close(self):
+        # Closing it before the end leaves unread data on the connection so
+        # it cannot be reused.
+        release, self._release = self._release, None
+        super(_PooledHTTPResponse, self).close()
+        if release is not None:
+            release(False)
+
+    def _close_conn(self):
+        super(_PooledHTTPResponse, self)._close_conn()
+        release, self._release = self._release, None
+        if release is not None:
+            release(not self.will_close)
+
+
+class KeepAliveHandler(urllib_request.AbstractHTTPHandler):
+    """
+    urllib handler sending HTTP and HTTPS requests over the persistent
+    connections of a :class:`ConnectionPool`.
+
+    It takes precedence over the default handlers. Requests tunneled
+    through a proxy are left to them.
+
+    :param pool: The pool to take the connections from.
+    :type pool: :class:`ConnectionPool`
+    """
+    handler_order = urllib_request.HTTPHandler.handler_order - 1
+
+    def __init__(self, pool):
+        urllib_request.AbstractHTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._open("http", req)
+
+    def https_open(self, req):
+        return self._open("https", req)
+
+    def _open(self, scheme, req):
+        if getattr(req, "_tunnel_host", None):
+            return None
+        # Same as urllib except that the connection is kept alive.
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+        headers.pop("Connection", None)
+
+        limiter = self.pool.rate_limiter
+        if limiter is not None:
+            limiter.acquire(req.host)
+
+        while True:
+            connection, reused = self.pool.acquire(scheme, req.host,
+                                                   req.timeout)
+            try:
+                connection.request(req.get_method(), req.selector, req.data,
+                                   headers)
+                response = connection.getresponse()
+            except (http_client.BadStatusLine, ConnectionResetError,
+                    ConnectionAbortedError, BrokenPipeError) as e:
+                connection.close()
+                # The server might have closed an idle connection in the
+                # meantime - try the next one.
+                if reused:
+                    continue
+                raise URLError(e)
+            except OSError as e:
+                connection.close()
+                raise URLError(e)
+            except Exception:
+                connection.close()
+                raise
+            break
+
+        def release(reusable):
+            if reusable:
+                self.pool.release(scheme, req.host, connection)
+            else:
+                connection.close()
+
+        response._release = release
+        if limiter is not None:
+            response.fp = _CountingReader(
+                response.fp, functools.partial(limiter.consume, req.host))
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+
+def enable_keep_alive(client, pool):
+    """
+    Let an FDSN client send all its requests over the persistent
+    connections of the given pool.
+
+    :param client: An FDSN client instance.
+    :type client: :class:`~obspy.clients.fdsn.client.Client`
+    :param pool: The pool to use.
+    :type pool: :class:`ConnectionPool`
+    """
+    handlers = [_i for _i in client._url_opener.handlers
+                if isinstance(_i, KeepAliveHandler)]
+    if handlers:
+        handlers[0].pool = pool
+    else:
+        client._url_opener.add_handler(KeepAliveHandler(pool))
+    return client
+
+
+class _CountingReader(object):
+    """
+    Wraps the file object of a response and reports the number of bytes
+    read from it in blocks of at least ``block_size`` bytes. The rest is
+    reported at the end of the response or when it is closed.
+    """
+    def __init__(self, fp, callback, block_size=RATE_LIMIT_BLOCK_SIZE):
+        self._fp = fp
+        self._callback = callback
+        self._block_size = block_size
+        self._pending = 0
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+    def _count(self, nbytes):
+        self._pending += nbytes
+        # Nothing read means the end of the response.
+        if self._pending >= self._block_size or \
+                (not nbytes and self._pending):
+            pending, self._pending = self._pending, 0
+            self._callback(pending)
+
+    def read(self, *args):
+        data = self._fp.read(*args)
+        self._count(len(data))
+        return data
+
+    def read1(self, *args):
+        data = self._fp.read1(*args)
+        self._count(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self._fp.readline(*args)
+        self._count(len(data))
+        return data
+
+    def readinto(self, b):
+        n = self._fp.readinto(b)
+        self._count(n or 0)
+        return n
+
+    def close(self):
+        self._count(0)
+        self._fp.close()
+
+
+class RateLimiter(object):
+    """
+    Token buckets limiting the number of requests per second and the
+    bandwidth per host.
+
+    The buckets of each host are stored in a small file which is locked
+    while it is updated, so all threads and processes of a user using
+    limiters with the same directory and limits share them - for example
+    all worker processes of a :class:`~concurrent_downloader.mdl.\
+bulk_downloader.BulkDownloader`. Without :mod:`fcntl` or if the file
+    cannot be used they are only shared by the threads of a process.
+
+    Each bucket holds one second worth of tokens. Requests wait for a full
+    token. Downloaded bytes are debited in blocks of
+    ``RATE_LIMIT_BLOCK_SIZE`` bytes while they are read and the reader
+    waits while the bucket is in debt.
+
+    :param requests_per_second: Maximum average number of requests per
+        second and host. Not limited if None.
+    :type requests_per_second: float
+    :param megabytes_per_second: Maximum average bandwidth in MB/s per
+        host. Not limited if None.
+    :type megabytes_per_second: float
+    :param directory: The directory of the shared state. Only limiters
+        with the same directory share their buckets.
+    :type directory: str
+    """
+    def __init__(self, requests_per_second=None, megabytes_per_second=None,
+                 directory=RATE_LIMIT_DIRECTORY):
+        self.requests_per_second = requests_per_second
+        self.megabytes_per_second = megabytes_per_second
+        self.directory = directory
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"requests_per_second": self.requests_per_second,
+                "megabytes_per_second": self.megabytes_per_second,
+                "directory": self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def acquire(self, host):
+        """
+        Block until a request to the host may be sent.
+        """
+        if not self.requests_per_second:
+            return
+        while True:
+            wait = self._take(host, requests=1)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def consume(self, host, nbytes):
+        """
+        Debit bytes downloaded from the host and block while the bandwidth
+        is exceeded.
+        """
+        if not self.megabytes_per_second or not nbytes:
+            return
+        wait = self._take(host, nbytes=nbytes)
+        if wait:
+            time.sleep(wait)
 
-        with open(temp_filename, "rb") as fh:
+    def _take(self, host, requests=0, nbytes=0):
+        """
+        Update the buckets of the host. Returns the seconds to wait before
+        trying again or 0 if a request may be sent.
+        """
+        rates = (self.requests_per_second or 0.0,
+                 (self.megabytes_per_second or 0.0) * 1024.0 ** 2)
+        with self._locked_state(host) as state:
+            now = time.time()
+            if state[2] is None:
+                tokens = list(rates)
+            else:
+                tokens = [min(rate, token + (now - state[2]) * rate)
+                          for rate, token in zip(rates, state[:2])]
+            wait = 0.0
+            if requests:
+                if tokens[0] >= requests:
+                    tokens[0] -= requests
+                else:
+                    wait = (requests - tokens[0]) / rates[0]
+            if nbytes:
+                tokens[1] -= nbytes
+                if tokens[1] < 0:
+                    wait = -tokens[1] / rates[1]
+            state[:] = tokens + [now]
+        return wait
+
+    @contextlib.contextmanager
+    def _locked_state(self, host):
+        with self._lock:
+            fd = self._open_state(host)
+            if fd is None:
+                yield self._local.setdefault(host, [0.0, 0.0, None])
+                return
             try:
-                while True:
-                    if fh.tell() >= (file_size - 256):
-                        break
-                    info = get_record_information(fh)
-                    channel_id = (info["network"], info["station"],
-                                  info["location"], info["channel"])
-
-                    # Sometimes the services return something nobody wants...
-                    if channel_id not in filenames:
-                        fh.read(info["record_length"])
-                        continue
-                    # Get the best matching filename.
-                    filename = get_filename(
-                        starttime=info["starttime"], endtime=info["endtime"],
-                        c=filenames[channel_id])
-                    # Again sometimes there are time ranges nobody asked for...
-                    if filename is None:
-                        fh.read(info["record_length"])
-                        continue
-                    if filename not in open_files:
-                        open_files[filename] = open(filename, "wb")
-                    open_files[filename].write(fh.read(info["record_length"]))
+                data = os.read(fd, 24)
+                if len(data) == 24:
+                    state = list(struct.unpack("<3d", data))
+                else:
+                    state = [0.0, 0.0, None]
+                yield state
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, struct.pack("<3d", *state))
             finally:
-                for f in open_files.values():
-                    try:
-                        f.close()
-                    except Exception:
-                        pass
-    logger.info("Client '%s' - Successfully downloaded %i channels (of %i)" % (
-        client_name, len(open_files), original_bulk_length))
-    return sorted(open_files.keys())
+                os.close(fd)
+
+    def _open_state(self, host):
+        """
+        Open and lock the state file of a host. Returns None if the state
+        cannot be shared between processes.
+        """
+        if fcntl is None:
+            return None
+        # Limiters with different limits do not share their buckets.
+        key = "%s %r %r" % (host, self.requests_per_second,
+                            self.megabytes_per_second)
+        filename = os.path.join(
+            self.directory,
+            hashlib.md5(key.encode("utf-8")).hexdigest() + ".bucket")
+        fd = None
+        try:
+            if not os.path.exists(self.directory):
+                try:
+                    os.makedirs(self.directory, 0o700)
+                except OSError:
+                    pass
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError:
+            if fd is not None:
+                os.close(fd)
+            return None
+        return fd
+
+
+class ServiceCache(object):
+    """
+    On-disk cache of the services discovered by FDSN clients.
+
+    The service discovery downloads the WADL documents of all services of a
+    data center. The result rarely changes, so clients created through
+    :meth:`get_client` reuse it for ``ttl`` seconds, across runs and
+    processes. Each entry is a small pickle file named after the hash of
+    the discovery URLs.
+
+    :param directory: The cache directory. It is created if necessary.
+    :type directory: str
+    :param ttl: Number of seconds an entry stays valid. 0 disables the
+        cache.
+    :type ttl: float
+    :param revalidate: If True, expired entries are still used but the
+        services are discovered again in the background and the entry is
+        replaced.
+    :type revalidate: bool
+    """
+    def __init__(self, directory=SERVICE_CACHE_DIRECTORY, ttl=86400,
+                 revalidate=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.revalidate = revalidate
+
+    def _get_filename(self, client):
+        # Same key as the in-memory cache of the client itself.
+        services = ["dataselect", "event", "station"]
+        services = [_i for _i in services if
+                    client._service_mappings.get(_i, "") is not None]
+        urls = [client._build_url(_i, "application.wadl") for _i in services]
+        if "event" in services:
+            urls.append(client._build_url("event", "catalogs"))
+            urls.append(client._build_url("event", "contributors"))
+        key = "\n".join(sorted(urls)).encode("utf-8")
+        return os.path.join(self.directory,
+                            hashlib.md5(key).hexdigest() + ".pickle")
+
+    def get(self, client, expired=False):
+        """
+        The cached services of the client or None if there is no valid
+        entry.
+
+        :param expired: Also return expired entries.
+        """
+        if not self.ttl:
+            return None
+        filename = self._get_filename(client)
+        try:
+            if not expired and \
+                    time.time() - os.path.getmtime(filename) > self.ttl:
+                return None
+            with open(filename, "rb") as fh:
+                return pickle.load(fh)
+        except Exception:
+            return None
+
+    def is_expired(self, client):
+        """
+        True if the entry of the client is missing or too old.
+        """
+        try:
+            age = time.time() - os.path.getmtime(self._get_filename(client))
+        except OSError:
+            return True
+        return age > self.ttl
+
+    def put(self, client):
+        """
+        Store the services of the client. Failures are ignored - the cache
+        is only an optimization.
+        """
+        if not self.ttl:
+            return
+        filename = self._get_filename(client)
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file first so concurrent readers never
+            # see a partial file.
+            with tempfile.NamedTemporaryFile(dir=self.directory,
+                                             delete=False) as fh:
+                pickle.dump(client.services, fh, protocol=2)
+            os.replace(fh.name, filename)
+        except Exception:
+            pass
+
+    def _refresh(self, client):
+        # Runs on a copy so the services of the returned client do not
+        # change while it is being used.
+        try:
+            client._discover_services()
+        except Exception:
+            return
+        self.put(client)
+
+    def get_client(self, base_url, **kwargs):
+        """
+        Create an FDSN client and only discover its services if they are not
+        cached.
+
+        :param base_url: Passed on to
+            :class:`~obspy.clients.fdsn.client.Client`.
+        :param kwargs: Passed on to
+            :class:`~obspy.clients.fdsn.client.Client`. If it contains
+            ``connection_pool``, the client is connected to it with
+            :func:`enable_keep_alive` before any request is sent.
+        """
+        pool = kwargs.pop("connection_pool", None)
+        # The token can only be set once the services are known.
+        eida_token = kwargs.pop("eida_token", None)
+        client = Client(base_url, _discover_services=False, **kwargs)
+        if pool is not None:
+            enable_keep_alive(client, pool)
+        services = self.get(client, expired=self.revalidate)
+        if services is None:
+            client._discover_services()
+            self.put(client)
+        else:
+            client.services = services
+            if self.revalidate and self.is_expired(client):
+                thread = threading.Thread(target=self._refresh,
+                                          args=(copy.copy(client),))
+                thread.daemon = True
+                thread.start()
+        if eida_token is not None:
+            client.set_eida_token(eida_token)
+        return client
+
+
+class ConcurrencyController(object):
+    """
+    Adaptive limit of the simultaneous requests to one service of a data
+    center.
+
+    The limit follows an additive increase, multiplicative decrease scheme
+    evaluated over windows of as many requests as the current limit:
+
+    * It is raised by one as long as the throughput of a window rises and
+      the latency stays flat.
+    * It is lowered by one if the latency rises without the throughput
+      rising.
+    * It is halved on HTTP 429 or 503 responses, on timeouts and if more
+      than a fifth of the requests of a window fail. A decrease starts a
+      new window and failures of requests sent before it are ignored, as
+      the requests that were in flight all saw the same congestion.
+      Sustained congestion halves the limit again with every new window.
+
+    With ``minimum == maximum`` it is a plain semaphore.
+
+    :param initial: The initial limit.
+    :type initial: int
+    :param maximum: The maximum limit.
+    :type maximum: int
+    :param minimum: The minimum limit.
+    :type minimum: int
+    """
+    def __init__(self, initial=3, maximum=None, minimum=1):
+        self.minimum = minimum
+        self.maximum = max(initial, maximum or initial)
+        self.limit = initial
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._previous = None
+        # Time of the last decrease.
+        self._decreased_at = None
+        self._start_window()
+
+    def _start_window(self):
+        self._window_start = time.time()
+        self._durations = []
+        self._bytes = 0
+        self._errors = 0
+
+    def _set_limit(self, limit):
+        self.limit = min(max(limit, self.minimum), self.maximum)
+        self._start_window()
+        self._condition.notify_all()
+
+    def _decrease(self):
+        self._previous = None
+        self._decreased_at = time.time()
+        self._set_limit(self.limit // 2)
+
+    def acquire(self):
+        """
+        Block until another request may be sent.
+        """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, duration, nbytes=0, error=None):
+        """
+        Record a finished request.
+
+        :param duration: The duration of the request in seconds.
+        :param nbytes: The number of downloaded bytes.
+        :param error: The exception of a failed request.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+            if isinstance(error, CONGESTION_ERRORS):
+                # Only react to requests sent after the last decrease.
+                if self._decreased_at is None or \
+                        time.time() - duration >= self._decreased_at:
+                    self._decrease()
+                return
+            self._durations.append(duration)
+            self._bytes += nbytes
+            # Missing data is a regular answer.
+            if error is not None and \
+                    not isinstance(error, FDSNNoDataException):
+                self._errors += 1
+            if len(self._durations) < self.limit:
+                return
+
+            count = len(self._durations)
+            throughput = self._bytes / max(time.time() - self._window_start,
+                                           1E-6)
+            latency = sorted(self._durations)[count // 2]
+            previous, self._previous = self._previous, (throughput, latency)
+            if self._errors > 0.2 * count:
+                self._decrease()
+            elif previous is None or (throughput > 1.05 * previous[0] and
+                                      latency <= 1.1 * previous[1]):
+                self._set_limit(self.limit + 1)
+            elif throughput <= 1.05 * previous[0] and \
+                    latency > 1.1 * previous[1]:
+                self._set_limit(self.limit - 1)
+            else:
+                self._start_window()
+
+    @contextlib.contextmanager
+    def request(self):
+        """
+        Context manager around a single request. Set the ``nbytes``
+        attribute of the returned object to the downloaded number of bytes.
+        """
+        self.acquire()
+        record = _RequestRecord()
+        start = time.time()
+        try:
+            yield record
+        except Exception as e:
+            self.release(time.time() - start, record.nbytes, e)
+            raise
+        self.release(time.time() - start, record.nbytes)
+
+
+class _RequestRecord(object):
+    nbytes = 0
+
+
+class AdaptiveConcurrency(object):
+    """
+    One :class:`ConcurrencyController` per data center and service, shared by
+    all clients and threads.
+
+    :param initial: The initial limit of each controller.
+    :type initial: int
+    :param maximum: The maximum limit of each controller.
+    :type maximum: int
+    """
+    def __init__(self, initial=3, maximum=None):
+        self.initial = initial
+        self.maximum = max(initial, maximum or initial)
+        self._controllers = {}
+        self._lock = threading.Lock()
+
+    def get(self, client, service):
+        """
+        The controller of a service of the client's data center.
+        """
+        key = (urlparse(client.base_url).netloc, service)
+        with self._lock:
+            if key not in self._controllers:
+                self._controllers[key] = ConcurrencyController(
+                    initial=self.initial, maximum=self.maximum)
+            return self._controllers[key]
+
+
+def get_sampling_rate(channel, sampling_rate=None):
+    """
+    Returns ``sampling_rate`` if it is known, otherwise the typical sampling
+    rate of the channel's band code.
+
+    >>> get_sampling_rate("HHZ", 200.0)
+    200.0
+    >>> get_sampling_rate("HHZ")
+    250
+    >>> get_sampling_rate("XHZ")
+    1.0
+    """
+    if sampling_rate:
+        return sampling_rate
+    # Generic sampling rate for exotic band codes.
+    return BAND_CODE_SAMPLING_RATES.get(channel[:1].upper(), 1.0)
+
+
+class MseedSizeEstimator(object):
+    """
+    Estimates the size of MiniSEED data from the number of samples and the
+    number of bytes per sample observed in files of the same station.
+
+    The compression of a station mostly depends on its noise level and
+    data logger so this is a lot more accurate than a fixed ratio. Stations
+    without any observation use the ratio of all observed files and if
+    nothing has been observed yet, :data:`DEFAULT_BYTES_PER_SAMPLE`.
+
+    Thread-safe so it can be shared by all clients.
+
+    :param files_per_channel: Learn from at most this many files of each
+        channel.
+    :type files_per_channel: int
+    """
+    def __init__(self, files_per_channel=3):
+        self.files_per_channel = files_per_channel
+        # Observed bytes and samples per station and in total.
+        self._stations = collections.defaultdict(lambda: [0, 0.0])
+        self._total = [0, 0.0]
+        self._lock = threading.Lock()
+
+    def add(self, network, station, nbytes, nsamples):
+        """
+        Add an observation of ``nbytes`` for ``nsamples`` samples.
+        """
+        if nsamples <= 0:
+            return
+        with self._lock:
+            for counts in (self._stations[(network, station)], self._total):
+                counts[0] += nbytes
+                counts[1] += nsamples
+
+    def add_files(self, network, station, sampling_rate, files,
+                  file_index=None):
+        """
+        Learn from existing files of a channel.
+
+        :param sampling_rate: The sampling rate of the channel.
+        :param files: Tuples of filename and the duration of the time
+            interval it covers in seconds. Only the first
+            ``files_per_channel`` files that exist are used.
+        :param file_index: If given, the sizes are taken from its directory
+            listings where possible.
+        :type file_index: :class:`FileExistenceIndex`
+        """
+        getsize = os.path.getsize if file_index is None \
+            else file_index.getsize
+        count = 0
+        for filename, duration in files:
+            if count >= self.files_per_channel:
+                break
+            try:
+                nbytes = getsize(filename)
+            except OSError:
+                continue
+            self.add(network, station, nbytes, sampling_rate * duration)
+            count += 1
+
+    def bytes_per_sample(self, network, station):
+        """
+        The expected number of bytes per sample of a station.
+        """
+        with self._lock:
+            for counts in (self._stations.get((network, station)),
+                           self._total):
+                if counts and counts[1]:
+                    return counts[0] / counts[1]
+        return DEFAULT_BYTES_PER_SAMPLE
+
+    def estimate(self, network, station, sampling_rate, duration):
+        """
+        The expected size in bytes of ``duration`` seconds of data of a
+        channel.
+        """
+        return sampling_rate * duration * \
+            self.bytes_per_sample(network, station)
+
+
+def pack_chunks(items, sizes, chunk_size, max_length):
+    """
+    Split ``items`` into consecutive chunks whose total sizes are as close as
+    possible to ``chunk_size``.
+
+    The order is kept so the data of a station ends up in as few chunks as
+    possible. A chunk is closed before an item if adding it would overshoot
+    ``chunk_size`` by more than the chunk currently falls short of it. Items
+    larger than ``chunk_size`` get a chunk on their own.
+
+    :param items: The items to split.
+    :param sizes: The size of each item.
+    :param chunk_size: The desired total size of each chunk.
+    :param max_length: The maximum number of items per chunk.
+
+    >>> pack_chunks("abcdef", [1, 1, 3, 2, 2, 1], 3, 10)
+    [['a', 'b'], ['c'], ['d', 'e'], ['f']]
+    """
+    chunks = []
+    current = []
+    current_size = 0
+    for item, size in zip(items, sizes):
+        if current and (
+                len(current) >= max_length or
+                current_size + size - chunk_size > chunk_size - current_size):
+            chunks.append(current)
+            current = []
+            current_size = 0
+        current.append(item)
+        current_size += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class FileHandlePool(object):
+    """
+    Thread-safe pool of output files with a bounded number of open handles.
+
+    Writes are buffered per file and only hit the disk once the buffer is
+    full or the file is closed. If too many files are open, the least
+    recently used one is closed and later reopened in append mode. The first
+    time a file is opened it is truncated and its directory is created if
+    necessary. Once a file is closed with :meth:`close` the pool forgets
+    about it, writing to it again starts it from scratch.
+
+    :param max_open_files: The maximum number of simultaneously open files.
+    :type max_open_files: int
+    :param buffer_size: The number of bytes to buffer per file.
+    :type buffer_size: int
+    :param file_index: If given, created and deleted files are registered
+        with it.
+    :type file_index: :class:`FileExistenceIndex`
+    """
+    def __init__(self, max_open_files=MAX_OPEN_FILES,
+                 buffer_size=WRITE_BUFFER_SIZE, file_index=None):
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self.file_index = file_index
+        self._lock = threading.Lock()
+        # Open handles in least recently used order.
+        self._handles = collections.OrderedDict()
+        self._buffers = collections.defaultdict(list)
+        self._buffer_sizes = collections.defaultdict(int)
+        # Files that have been opened (and truncated) and not been closed
+        # yet. Only the files of the requests in progress.
+        self._opened = set()
+        # Directories known to exist.
+        self._directories = set()
+
+    def write(self, filename, data):
+        """
+        Buffer some data for a file and write it if the buffer is full.
+
+        :param filename: The file to write to.
+        :param data: The bytes to write.
+        """
+        with self._lock:
+            self._buffers[filename].append(data)
+            self._buffer_sizes[filename] += len(data)
+            if self._buffer_sizes[filename] >= self.buffer_size:
+                self._flush(filename)
+
+    def close(self, filenames):
+        """
+        Flush and close the given files.
+
+        :param filenames: The files to close.
+        """
+        with self._lock:
+            for filename in filenames:
+                try:
+                    self._flush(filename)
+                finally:
+                    fh = self._handles.pop(filename, None)
+                    self._opened.discard(filename)
+                    if fh is not None:
+                        fh.close()
+
+    def discard(self, filenames):
+        """
+        Drop the buffers of the given files and delete them. The next write
+        starts them from scratch.
+
+        :param filenames: The files to discard.
+        """
+        with self._lock:
+            for filename in filenames:
+                self._buffers.pop(filename, None)
+                self._buffer_sizes.pop(filename, None)
+                fh = self._handles.pop(filename, None)
+                if fh is not None:
+                    fh.close()
+                if filename in self._opened:
+                    self._opened.discard(filename)
+                    safe_delete(filename)
+                    if self.file_index is not None:
+                        self.file_index.discard(filename)
+
+    def close_all(self):
+        """
+        Flush and close all files.
+        """
+        self.close(set(self._handles.keys()) | set(self._buffers.keys()))
+
+    def _flush(self, filename):
+        data = self._buffers.pop(filename, None)
+        self._buffer_sizes.pop(filename, None)
+        if not data:
+            return
+        self._get_handle(filename).write(b"".join(data))
+
+    def _get_handle(self, filename):
+        if filename in self._handles:
+            self._handles.move_to_end(filename)
+            return self._handles[filename]
+        while len(self._handles) >= self.max_open_files:
+            self._handles.popitem(last=False)[1].close()
+        if filename in self._opened:
+            mode = "ab"
+        else:
+            mode = "wb"
+            # Directories are only created once something is written.
+            dirname = os.path.dirname(filename)
+            if dirname and dirname not in self._directories:
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                self._directories.add(dirname)
+        self._handles[filename] = open(filename, mode)
+        if mode == "wb" and self.file_index is not None:
+            self.file_index.add(filename)
+        self._opened.add(filename)
+        return self._handles[filename]
+
+
+class FileExistenceIndex(object):
+    """
+    Cached file existence checks requiring a single directory listing per
+    directory instead of one ``stat`` call per file. Very noticeable on
+    network file systems.
+
+    The listings are cached, thus files created or deleted later on are
+    only known if they are passed to :meth:`add` or :meth:`discard` or
+    after :meth:`invalidate`. They also provide the sizes of the files
+    that have not been added since.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listings = {}
+
+    def exists(self, filename):
+        """
+        Returns True if the file (or directory) exists.
+
+        :param filename: The path to check.
+        """
+        dirname, basename = os.path.split(filename)
+        return basename in self._get_listing(dirname)
+
+    def exists_many(self, filenames):
+        """
+        Returns a list of booleans telling if each of the files exists.
+
+        :param filenames: The paths to check.
+        """
+        listings = {}
+        result = []
+        for filename in filenames:
+            dirname, basename = os.path.split(filename)
+            try:
+                listing = listings[dirname]
+            except KeyError:
+                listing = listings[dirname] = self._get_listing(dirname)
+            result.append(basename in listing)
+        return result
+
+    def add(self, filename):
+        """
+        Register a file that has been created after the directory has been
+        listed.
+
+        :param filename: The path of the new file.
+        """
+        dirname, basename = os.path.split(filename)
+        # Its size is not known anymore.
+        self._get_listing(dirname)[basename] = None
+
+    def discard(self, filename):
+        """
+        Register a file that has been deleted after the directory has been
+        listed.
+
+        :param filename: The path of the deleted file.
+        """
+        dirname, basename = os.path.split(filename)
+        self._get_listing(dirname).pop(basename, None)
+
+    def getsize(self, filename):
+        """
+        Returns the size of a file in bytes. The ``stat`` results of the
+        directory listing are cached, so asking again is free. Raises an
+        :class:`OSError` if the file does not exist according to the index.
+
+        :param filename: The path of the file.
+        """
+        dirname, basename = os.path.split(filename)
+        listing = self._get_listing(dirname)
+        if basename not in listing:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+        entry = listing[basename]
+        if entry is None:
+            return os.path.getsize(filename)
+        return entry.stat().st_size
+
+    def invalidate(self):
+        """
+        Forget all listings. The directories are listed again on the next
+        check.
+        """
+        with self._lock:
+            self._listings.clear()
+
+    def _get_listing(self, dirname):
+        # Maps the names to their directory entries or None for files added
+        # later on.
+        with self._lock:
+            if dirname not in self._listings:
+                try:
+                    entries = dict((_i.name, _i)
+                                   for _i in os.scandir(dirname or "."))
+                except OSError:
+                    # Does not exist or is not a directory.
+                    entries = {}
+                self._listings[dirname] = entries
+            return self._listings[dirname]
+
+
+class IntervalIndex(object):
+    """
+    Sorted index over time intervals answering which intervals contain a
+    certain point in time in logarithmic time.
+
+    Intervals are closed on both sides and are allowed to overlap.
+
+    :param intervals: The intervals to index. Each is a dictionary with at
+        least a ``"starttime"`` and an ``"endtime"`` key. The times can be
+        anything that can be compared, e.g.
+        :class:`~obspy.core.utcdatetime.UTCDateTime` objects or integer
+        nanoseconds.
+    :type intervals: list of dict
+    """
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals, key=lambda x: x["starttime"])
+        self._starts = [_i["starttime"] for _i in self.intervals]
+        self._ends = [_i["endtime"] for _i in self.intervals]
+        # Running maximum of the end times. Allows to stop searching as soon
+        # as no earlier interval can reach the queried time anymore.
+        self._max_ends = []
+        for end in self._ends:
+            if self._max_ends and self._max_ends[-1] > end:
+                end = self._max_ends[-1]
+            self._max_ends.append(end)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def query(self, time):
+        """
+        Returns a list of all intervals containing the given time.
+
+        :param time: The time to look up. Must be of the same type as the
+            interval bounds.
+        """
+        i = bisect.bisect_right(self._starts, time) - 1
+        found = []
+        while i >= 0 and self._max_ends[i] >= time:
+            if self._ends[i] >= time:
+                found.append(self.intervals[i])
+            i -= 1
+        return found
 
 
 class SphericalNearestNeighbour(object):
@@ -298,8 +2092,9 @@ class SphericalNearestNeighbour(object):
         m = np.isfinite(d)
         return d[m], i[m]
 
-    def query_pairs(self, maximum_distance):
-        return self.kd_tree.query_pairs(maximum_distance)
+    def query_pairs(self, maximum_distance, output_type="set"):
+        return self.kd_tree.query_pairs(maximum_distance,
+                                        output_type=output_type)
 
     @staticmethod
     def spherical2cartesian(data):
@@ -325,6 +2120,70 @@ class SphericalNearestNeighbour(object):
         return cart_data
 
 
+def greedy_vertex_cover(pairs, count):
+    """
+    Greedily removes the vertex with the most edges until no edges are left.
+
+    Ties are broken in favour of the vertex appearing first in the
+    remaining pairs. This is the same order as repeatedly calling
+    ``collections.Counter(itertools.chain.from_iterable(pairs))
+    .most_common()`` and dropping the edges of the chosen vertex but it
+    runs in ``O(E log E)`` with a lazily updated heap.
+
+    Returns the removed vertices in the order of removal.
+
+    :param pairs: The edges as an array of shape ``(E, 2)``.
+    :type pairs: :class:`numpy.ndarray`
+    :param count: The number of vertices.
+    :type count: int
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    if not len(pairs):
+        return []
+    # Every edge appears twice, the position in the flattened array is the
+    # tie breaker and edge = position // 2, other vertex = position ^ 1.
+    flat = pairs.ravel()
+    positions = np.argsort(flat, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(
+        flat, minlength=count))])
+    degree = np.diff(offsets).tolist()
+    # Index into positions of the first remaining edge of each vertex.
+    first = offsets[:-1].tolist()
+    offsets = offsets.tolist()
+    positions = positions.tolist()
+    flat = flat.tolist()
+    is_edge = [True] * len(pairs)
+    is_removed = [False] * count
+
+    heap = [(-degree[_i], positions[first[_i]], _i) for _i in range(count)
+            if degree[_i]]
+    heapq.heapify(heap)
+
+    removed = []
+    while heap:
+        neg_degree, position, vertex = heapq.heappop(heap)
+        # Skip outdated entries.
+        if is_removed[vertex] or -neg_degree != degree[vertex] or \
+                position != positions[first[vertex]]:
+            continue
+        is_removed[vertex] = True
+        removed.append(vertex)
+
+        for position in positions[first[vertex]:offsets[vertex + 1]]:
+            if not is_edge[position >> 1]:
+                continue
+            is_edge[position >> 1] = False
+            other = flat[position ^ 1]
+            degree[other] -= 1
+            if not degree[other]:
+                continue
+            while not is_edge[positions[first[other]] >> 1]:
+                first[other] += 1
+            heapq.heappush(
+                heap, (-degree[other], positions[first[other]], other))
+    return removed
+
+
 def filter_channel_priority(channels, key, priorities=None):
     """
     This function takes a dictionary containing channels keys and returns a new
@@ -500,7 +2359,7 @@ def get_stationxml_filename(str_or_fct, network, station, channels,
     if isinstance(path, (str, bytes)):
         return path
 
-    elif isinstance(path, compatibility.collections_abc.Container):
+    elif isinstance(path, collections_abc.Container):
         if "available_channels" not in path or \
                 "missing_channels" not in path or \
                 "filename" not in path:
@@ -509,9 +2368,9 @@ def get_stationxml_filename(str_or_fct, network, station, channels,
                 "must contain the following keys: 'available_channels', "
                 "'missing_channels', and 'filename'.")
         if not isinstance(path["available_channels"],
-                          compatibility.collections_abc.Iterable) or\
+                          collections_abc.Iterable) or\
                 not isinstance(path["missing_channels"],
-                               compatibility.collections_abc.Iterable) or \
+                               collections_abc.Iterable) or \
                 not isinstance(path["filename"], (str, bytes)):
             raise ValueError("Return types must be two lists of channels and "
                              "a string for the filename.")
@@ -567,6 +2426,7 @@ def get_mseed_filename(str_or_fct, network, station, location, channel,
         raise TypeError("'%s' is not a filepath." % str(path))
     return path
 
+
 def get_mseed_sdsfilename(str_or_fct, network, station, 
                         location, channel, year, julday):
     """
@@ -597,6 +2457,98 @@ def get_mseed_sdsfilename(str_or_fct, network, station,
 
     return path
 
+
+class MseedStorage(object):
+    """
+    Compiled version of the ``mseed_storage`` setting.
+
+    The setting is parsed once and the filenames of all time intervals of a
+    channel are then generated in one go, following the same rules as
+    :func:`get_mseed_filename` and, for settings starting with
+    ``"{<SDSdir>}:"``, :func:`get_mseed_sdsfilename`.
+
+    :param str_or_fct: The ``mseed_storage`` setting.
+    :type str_or_fct: str or function
+    """
+    def __init__(self, str_or_fct):
+        self.str_or_fct = str_or_fct
+        self.function = None
+        self.sds_root = None
+        self.folder = None
+        self.template = None
+
+        if callable(str_or_fct):
+            self.function = str_or_fct
+        elif SDS_KEY in str_or_fct:
+            self.sds_root = str_or_fct.split(SDS_KEY)[-1]
+        elif all(["{%s}" % _i in str_or_fct for _i in (
+                "network", "station", "location", "channel", "starttime",
+                "endtime")]):
+            self.template = str_or_fct
+        else:
+            self.folder = str_or_fct
+
+    def get_filenames(self, network, station, location, channel, starttimes,
+                      endtimes):
+        """
+        Get the filenames for a number of time intervals of one channel.
+
+        :param starttimes: The start times in nanoseconds.
+        :type starttimes: :class:`numpy.ndarray`
+        :param endtimes: The end times in nanoseconds.
+        :type endtimes: :class:`numpy.ndarray`
+        :returns: A list with one filename per interval. Intervals that
+            should be ignored have ``True`` instead of a filename.
+        """
+        if self.function is not None:
+            filenames = []
+            for start, end in zip(starttimes.tolist(), endtimes.tolist()):
+                path = self.function(
+                    network, station, location, channel,
+                    obspy.UTCDateTime(ns=start), obspy.UTCDateTime(ns=end))
+                if path is not True and not isinstance(path, (str, bytes)):
+                    raise TypeError("'%s' is not a filepath." % str(path))
+                filenames.append(path)
+            return filenames
+
+        if self.sds_root is not None:
+            days = np.asarray(starttimes).astype("datetime64[ns]").astype(
+                "datetime64[D]")
+            years = days.astype("datetime64[Y]")
+            juldays = (days - years).astype(np.int64) + 1
+            years = years.astype(np.int64) + 1970
+            template = "%s/%%d/%s/%s/%s.D/%s.%s.%s.%s.D.%%d.%%03d" % (
+                self.sds_root.replace("%", "%%"), network, station, channel,
+                network, station, location, channel)
+            return [template % (_y, _y, _j) for _y, _j in
+                    zip(years.tolist(), juldays.tolist())]
+
+        starttimes = _format_mseed_times(starttimes)
+        endtimes = _format_mseed_times(endtimes)
+
+        if self.folder is not None:
+            prefix = os.path.join(self.folder, "%s.%s.%s.%s__" % (
+                network, station, location, channel))
+            return [prefix + _s + "__" + _e + ".mseed"
+                    for _s, _e in zip(starttimes, endtimes)]
+
+        fmt = functools.partial(
+            self.template.format, network=network, station=station,
+            location=location, channel=channel)
+        return [fmt(starttime=_s, endtime=_e)
+                for _s, _e in zip(starttimes, endtimes)]
+
+
+def _format_mseed_times(times):
+    """
+    Format nanosecond times like ``UTCDateTime.strftime("%Y%m%dT%H%M%SZ")``.
+    """
+    times = np.asarray(times).astype("datetime64[ns]").astype(
+        "datetime64[s]")
+    return [_i[:4] + _i[5:7] + _i[8:13] + _i[14:16] + _i[17:19] + "Z"
+            for _i in np.datetime_as_string(times).tolist()]
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod(exclude_empty=True)
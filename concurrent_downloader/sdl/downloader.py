@@ -7,9 +7,19 @@ last update: 14-11-2020
 """
 
 import os
+import queue
+import datetime as dt
+import threading
 import warnings
 import concurrent.futures
-from functools import partial
+import multiprocessing
+try:
+  from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+  # the streams are pickled instead
+  resource_tracker = shared_memory = None
+import numpy as np
+from obspy import Stream, Trace
 from obspy.clients.fdsn.mass_downloader.utils import get_mseed_filename
 from . import utils2download as u2d
 
@@ -17,53 +27,289 @@ from . import utils2download as u2d
 def run_process(ppc_restrictions,mseed_storage,st):
   u2d.write_stream(st,ppc_restrictions,mseed_storage)
 
+def share_stream(st):
+  """
+  Copy the data of all traces of a stream into one shared memory block,
+  so it can be handed to a worker process without pickling the samples.
+
+  Returns:
+  --------
+  shm: multiprocessing.shared_memory.SharedMemory object
+      The block. It has to be unlinked once the worker is done.
+  headers: list
+      Stats, dtype, number of samples and offset in the block of each 
+      trace. See run_shared_process
+  """
+  nbytes = sum(tr.data.nbytes for tr in st)
+  shm = shared_memory.SharedMemory(create=True,size=max(nbytes,1))
+  headers = []
+  offset = 0
+  for tr in st:
+    data = np.ascontiguousarray(tr.data)
+    np.ndarray(data.shape,dtype=data.dtype,buffer=shm.buf,
+                offset=offset)[:] = data
+    headers.append((tr.stats,data.dtype.str,len(data),offset))
+    offset += data.nbytes
+  return shm, headers
+
+def run_shared_process(ppc_restrictions,mseed_storage,name,headers):
+  """
+  Rebuild a stream shared by share_stream in a worker process and write
+  it. The samples are used in place, without any copy.
+  """
+  shm = shared_memory.SharedMemory(name=name)
+  try:
+    st = Stream([Trace(data=np.ndarray(npts,dtype=dtype,buffer=shm.buf,
+                                      offset=offset),
+                      header=stats)
+                for stats, dtype, npts, offset in headers])
+    u2d.write_stream(st,ppc_restrictions,mseed_storage)
+    del st
+  finally:
+    try:
+      shm.close()
+    except BufferError:
+      # some samples are still referenced, closed with the process
+      pass
+
+def release_shared(shm):
+  shm.close()
+  shm.unlink()
+
+def fetch_chunk(client,dld_restrictions,starttime,endtime):
+  """
+  Download the waveforms of one time chunk and group them.
+
+  Returns:
+  --------
+  st_values: list or None
+      One obspy.Stream object per group, None if the download failed.
+  """
+  try:
+    st = client.get_waveforms(network=dld_restrictions.network,
+                              station=dld_restrictions.station, 
+                              location=dld_restrictions.location,
+                              channel=dld_restrictions.channel,
+                              starttime=starttime,
+                              endtime=endtime)
+    st_dict = st._groupby(dld_restrictions.groupby)
+    return list(st_dict.values())
+
+  except:
+    st_warn = (f"{dld_restrictions.network}."
+                f"{dld_restrictions.station}."
+                f"{dld_restrictions.location}."
+                f"{dld_restrictions.channel}."
+                f"{starttime}."
+                f"{endtime}")
+    warnings.warn(f"No:\t{st_warn}") 
+    return None
+
+def wait_writing(futures):
+  """
+  Wait until the streams of one chunk are written and warn about failures.
+  """
+  for future in futures:
+    try:
+      future.result()
+    except Exception as e:
+      warnings.warn(f"Failed writing:\t{e}")
+
+def skip_existing_chunks(times,mseed_storage,client,dld_restrictions,
+                        ppc_restrictions):
+  """
+  Remove the chunks whose files already exist for all channels. The
+  channels are listed with one get_stations request. Clients without 
+  get_stations, e.g. SDS clients, download all the chunks.
+
+  Returns:
+  --------
+  times: list
+      The chunktimes that still have to be downloaded.
+  """
+  if not hasattr(client,"get_stations"):
+    return times
+  channels = u2d.get_channels(client,dld_restrictions)
+  if not channels:
+    warnings.warn("Could not list the channels. Existing files are only "
+                  "detected after downloading.")
+    return times
+
+  try:
+    groups = u2d.get_existing_files(mseed_storage,channels,
+                                    dld_restrictions.groupby,
+                                    ppc_restrictions)
+  except (KeyError,IndexError,ValueError):
+    warnings.warn(f"Can not predict the filenames grouped by "
+                  f"{dld_restrictions.groupby}. Existing files are only "
+                  f"detected after downloading.")
+    return times
+
+  now = dt.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+  missing = []
+  for starttime, endtime in times:
+    if u2d.chunk_exists(groups,starttime,endtime):
+      print(f"{now}[Exist]:  {starttime} - {endtime}  (skipped)")
+    else:
+      missing.append((starttime,endtime))
+  return missing
+
 def MseedDownloader(mseed_storage,client,dld_restrictions,
                       ppc_restrictions=None, n_processor=1, 
-                      concurrent_feature="thread"):
+                      concurrent_feature="thread",
+                      n_fetchers=1, queue_depth=2, skip_existing=False):
+  """
+  Download the waveforms chunk by chunk and write them in mseed_storage.
+
+  The chunks are downloaded by n_fetchers threads into a queue that holds
+  at most queue_depth chunks. Meanwhile the groups of the downloaded
+  chunks are preprocessed and written by n_processor threads or processes,
+  so the network and the CPU are busy at the same time. At most
+  queue_depth + n_fetchers + 2 chunks are held in memory.
 
+  Parameters:
+  -----------
+  mseed_storage: str
+      Where to store the waveform files. See u2d.write_stream
+  client: obspy Client object
+      Client with a get_waveforms method, e.g. FDSN or SDS client.
+  dld_restrictions: DownloadRestrictions object
+      Restrictions to download the waveforms.
+  ppc_restrictions: PreprocRestrictions object
+      Restrictions to preprocess the streams.
+  n_processor: int
+      Number of threads or processes that preprocess and write the streams.
+  concurrent_feature: str
+      "thread" or "process". The processes are started with forkserver 
+      or spawn, so a script using "process" has to call MseedDownloader 
+      under if __name__ == "__main__":
+  n_fetchers: int
+      Number of chunks downloaded at the same time.
+  queue_depth: int
+      Maximum number of downloaded chunks waiting to be written.
+  skip_existing: True or False
+      If True, the channels are listed with one extra get_stations 
+      request before downloading and the chunks whose files already 
+      exist for all of them are not downloaded at all. Useful to resume
+      an interrupted run. Ignored if the client has no get_stations 
+      method.
+  """
   times = u2d.get_chunktimes(starttime=dld_restrictions.starttime,
                         endtime = dld_restrictions.endtime,
                         chunklength_in_sec=dld_restrictions.chunklength,
                         overlap_in_sec=dld_restrictions.overlap_in_sec)
+
+  if skip_existing:
+    times = skip_existing_chunks(times,mseed_storage,client,
+                                dld_restrictions,ppc_restrictions)
   def run_thread(st):
     u2d.write_stream(st,ppc_restrictions,mseed_storage)
 
-  for starttime, endtime in times:
-    try:
-      st = client.get_waveforms(network=dld_restrictions.network,
-                                station=dld_restrictions.station, 
-                                location=dld_restrictions.location,
-                                channel=dld_restrictions.channel,
-                                starttime=starttime,
-                                endtime=endtime)
-      st_dict = st._groupby(dld_restrictions.groupby)
-      st_values = list(st_dict.values())
+  def submit_thread(st):
+    return writer.submit(run_thread,st)
+
+  def submit_pickled(st):
+    return writer.submit(run_process,ppc_restrictions,mseed_storage,st)
 
+  def submit_shared(st):
+    # masked arrays can not be shared, they are pickled
+    if any(np.ma.isMaskedArray(tr.data) for tr in st):
+      return submit_pickled(st)
+    try:
+      shm, headers = share_stream(st)
+    except OSError:
+      # e.g. no space left for shared memory
+      return submit_pickled(st)
+    try:
+      future = writer.submit(run_shared_process,ppc_restrictions,
+                            mseed_storage,shm.name,headers)
     except:
-      st_warn = (f"{dld_restrictions.network}."
-                  f"{dld_restrictions.station}."
-                  f"{dld_restrictions.location}."
-                  f"{dld_restrictions.channel}."
-                  f"{starttime}."
-                  f"{endtime}")
-      warnings.warn(f"No:\t{st_warn}") 
-      st_values = None
-
-    if st_values != None:
-      if n_processor == 1:
+      release_shared(shm)
+      raise
+    future.add_done_callback(lambda f: release_shared(shm))
+    return future
+
+  if n_processor == 1:
+    writer = None
+  elif concurrent_feature in ("thread","Thread","t","T"):
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=n_processor)
+    submit = submit_thread
+  elif concurrent_feature in ("process","Process","p","P"):
+    # one pool for the whole run, the samples are handed over in shared
+    # memory. The workers have to share the tracker of the shared memory
+    # blocks, otherwise they clean them up on their own when they exit.
+    # The tracker only exists on POSIX, elsewhere the streams are pickled.
+    submit = submit_pickled
+    if shared_memory is not None and os.name == "posix":
+      try:
+        resource_tracker.ensure_running()
+        submit = submit_shared
+      except OSError:
+        pass
+    # never fork: the fetchers are running and a forked worker can inherit
+    # one of their locks (logging, ssl, ...) in a held state and deadlock.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+      context = multiprocessing.get_context("forkserver")
+    else:
+      context = multiprocessing.get_context("spawn")
+    writer = concurrent.futures.ProcessPoolExecutor(max_workers=n_processor,
+                                                    mp_context=context)
+  else:
+    raise ValueError(f"Unknown concurrent_feature: {concurrent_feature}")
+
+  chunks = queue.Queue(maxsize=queue_depth)
+  pending = iter(times)
+  lock = threading.Lock()
+  stop = threading.Event()
+
+  def fetch():
+    while not stop.is_set():
+      with lock:
+        chunktime = next(pending, None)
+      if chunktime is None:
+        return
+      # the consumer waits for one item per chunk, so an unexpected
+      # error is handed over instead of the chunk
+      try:
+        st_values = fetch_chunk(client,dld_restrictions,*chunktime)
+      except BaseException as e:
+        st_values = e
+      # wait while the queue is full
+      while not stop.is_set():
+        try:
+          chunks.put(st_values, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+
+  fetchers = concurrent.futures.ThreadPoolExecutor(max_workers=n_fetchers)
+  writing = []
+  try:
+    for _ in range(n_fetchers):
+      fetchers.submit(fetch)
+
+    for _ in times:
+      st_values = chunks.get()
+      if isinstance(st_values,BaseException):
+        raise st_values
+      if st_values == None:
+        continue
+
+      if writer == None:
         for one_st in st_values:
           u2d.write_stream(one_st,ppc_restrictions,mseed_storage)
       else:
-        if n_processor > len(st_values):
-          n_processor = len(st_values)
-
-        if concurrent_feature in ("thread","Thread","t","T"):
-          with concurrent.futures.ThreadPoolExecutor(max_workers=n_processor) as executor:
-            executor.map(run_thread,st_values) 
+        submitted = [submit(one_st) for one_st in st_values]
+        # the previous chunk is finished while this one is already written
+        wait_writing(writing)
+        writing = submitted
+    wait_writing(writing)
 
-        elif concurrent_feature in ("process","Process","p","P"):
-          with concurrent.futures.ProcessPoolExecutor(max_workers=n_processor) as executor:
-            executor.map(partial(run_process,ppc_restrictions,mseed_storage),st_values) 
+  finally:
+    stop.set()
+    fetchers.shutdown()
+    if writer != None:
+      writer.shutdown()
 
 if __name__ == "__main__":
   from obspy.clients.fdsn import Client as FDSN_Client
@@ -7,8 +7,11 @@ last update: 14-11-2020
 """
 
 import os
+import re
+import glob
 import time
 import datetime as dt
+from obspy import UTCDateTime
 
 def write_stream(one_st,ppc_restrictions,mseed_storage):
     """
@@ -43,10 +46,8 @@ def write_stream(one_st,ppc_restrictions,mseed_storage):
     filename = os.path.basename(mseed_filename)
     if os.path.isfile(mseed_filename) == False:
         mseed_dir = os.path.dirname(mseed_filename)
-        if os.path.isdir(mseed_dir) == False:
-            os.makedirs(mseed_dir)
-        else:
-            pass
+        # other writers might create it at the same time
+        os.makedirs(mseed_dir,exist_ok=True)
 
         one_st.write(mseed_filename,format="MSEED")
         print(f"{now}[Downloaded]:  {mseed_filename}  {comment}")
@@ -218,6 +219,169 @@ def get_chunktimes(starttime,endtime,chunklength_in_sec, overlap_in_sec=0):
         times.append((deltat,endtime))
     return times
 
+class _TimeMarker(object):
+    """
+    Placeholder for the starttime and endtime in get_mseed_filename
+    """
+    def __init__(self,name):
+        self.name = name
+
+    def strftime(self,fmt):
+        return self.name
+
+def get_channels(client,dld_restrictions):
+    """
+    Get the channels selected by the restrictions with one get_stations
+    request.
+
+    Parameters:
+    -----------
+    client: obspy Client object
+        Client with a get_stations method.
+    dld_restrictions: DownloadRestrictions object
+        Restrictions to download the waveforms.
+
+    Returns:
+    --------
+    channels: list or None
+        Each channel is a dict with the network, station, location, channel
+        and sampling_rate keys and the start_date and end_date of the 
+        channel epoch. None if the client can not list the channels.
+    """
+    try:
+        inv = client.get_stations(network=dld_restrictions.network,
+                                  station=dld_restrictions.station,
+                                  location=dld_restrictions.location,
+                                  channel=dld_restrictions.channel,
+                                  starttime=dld_restrictions.starttime,
+                                  endtime=dld_restrictions.endtime,
+                                  level="channel")
+    except:
+        return None
+
+    channels = []
+    for net in inv:
+        for sta in net:
+            for cha in sta:
+                channels.append({"network":net.code,"station":sta.code,
+                                "location":cha.location_code,
+                                "channel":cha.code,
+                                "sampling_rate":cha.sample_rate,
+                                "start_date":cha.start_date,
+                                "end_date":cha.end_date})
+    return channels
+
+def get_existing_files(mseed_storage,channels,groupby,ppc_restrictions):
+    """
+    Find the files already written for each group of channels.
+
+    The filenames are predicted with get_mseed_filename with any starttime
+    and endtime, so each group is only listed once.
+
+    Parameters:
+    -----------
+    mseed_storage: str
+        Where the waveform files are stored. See write_stream
+    channels: list
+        Channels as returned by get_channels
+    groupby: str
+        Key to group the channels, e.g. '{network}.{station}.{channel}' 
+        or 'id'. See DownloadRestrictions
+    ppc_restrictions: PreprocRestrictions object
+        Restrictions to preprocess a stream.
+
+    Returns:
+    --------
+    groups: dict
+        Group key -> (channels of the group, list of tuples with the 
+        starttime and endtime of each existing file of the group)
+    """
+    if groupby == "id":
+        groupby = "{network}.{station}.{location}.{channel}"
+
+    strftime = "%Y%m%dT%H%M%SZ"
+    start = _TimeMarker("_starttime_")
+    end = _TimeMarker("_endtime_")
+    groups = {}
+    for cha in channels:
+        key = groupby.format(**cha)
+        if key not in groups:
+            groups[key] = ([], [])
+        group_channels, files = groups[key]
+        group_channels.append(cha)
+
+        if ppc_restrictions == None:
+            ppc = False
+        else:
+            ppc = f"{cha['network']}.{cha['station']}" in \
+                    ppc_restrictions.seed_ids
+        path = get_mseed_filename(_str=mseed_storage,
+                                  network=cha["network"],
+                                  station=cha["station"],
+                                  location=cha["location"],
+                                  channel=cha["channel"],
+                                  starttime=start, endtime=end,
+                                  ppc=ppc)
+        pattern = glob.escape(path).replace(start.name,"*").replace(
+                                                    end.name,"*")
+        regex = re.escape(path).replace(re.escape(start.name),
+                                        r"(\d{8}T\d{6}Z)").replace(
+                                        re.escape(end.name),
+                                        r"(\d{8}T\d{6}Z)")
+        regex = re.compile(regex + "$")
+        for filename in glob.glob(pattern):
+            match = regex.match(filename)
+            if match == None:
+                continue
+            files.append((UTCDateTime.strptime(match.group(1),strftime),
+                          UTCDateTime.strptime(match.group(2),strftime)))
+    return groups
+
+def chunk_exists(groups,starttime,endtime):
+    """
+    Check if the files of all groups recorded during a time chunk exist.
+
+    The times in the filenames are those of the first and last sample of
+    the data, so a file is accepted if it starts and ends within one
+    sample period and one second of the chunk, and it is shorter than 
+    two chunks.
+
+    Parameters:
+    -----------
+    groups: dict
+        Groups as returned by get_existing_files
+    starttime: obspy.UTCDateTime object
+        Start time of the chunk
+    endtime: obspy.UTCDateTime object
+        End time of the chunk
+
+    Returns:
+    --------
+    exists: True or False
+        True if the chunk does not need to be downloaded.
+    """
+    length = endtime - starttime
+    n_active = 0
+    for group_channels, files in groups.values():
+        rates = [cha["sampling_rate"] for cha in group_channels
+                if (cha["start_date"] == None or 
+                    cha["start_date"] <= endtime) and
+                    (cha["end_date"] == None or 
+                    cha["end_date"] >= starttime)]
+        if not rates:
+            continue
+        n_active += 1
+
+        rates = [rate for rate in rates if rate]
+        tolerance = 1 + (1 / min(rates) if rates else 0)
+        for file_start, file_end in files:
+            if (file_start <= starttime + tolerance) and \
+                    (file_end >= endtime - tolerance) and \
+                    (file_end - file_start < 2 * length):
+                break
+        else:
+            return False
+    return n_active > 0
 
 if __name__ == "__main__":
     from obspy.clients.fdsn import Client as FDSN_Client
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the tests: a minimal FDSN web service running in a
+thread.
+"""
+import io
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    ThreadingHTTPServer = None
+
+import numpy as np
+import obspy
+import pytest
+from obspy.clients.fdsn import Client
+from obspy.core.inventory import (Channel, Inventory, Network, Site,
+                                  Station)
+
+T0 = obspy.UTCDateTime(2020, 1, 1)
+
+
+class FakeProvider(object):
+    """
+    Serves the station and dataselect services for a network of stations
+    with the channels BHZ, BHN, and BHE sampled at 1 Hz.
+
+    :param network: The network code.
+    :param stations: The station codes and their coordinates as a list of
+        ``(code, latitude, longitude)`` tuples.
+    :param no_data: Station codes without any waveform data.
+    :param delay: Seconds each station request takes.
+    :param data_delay: Seconds each dataselect request takes.
+    :param failures: The number of dataselect requests answered with an
+        HTTP 503 error before any data is served.
+    """
+    def __init__(self, network, stations, no_data=(), delay=0.0,
+                 data_delay=0.0, failures=0):
+        self.network = network
+        self.stations = stations
+        self.no_data = set(no_data)
+        self.delay = delay
+        self.data_delay = data_delay
+        self.failures = failures
+        # Close the connections after each response without telling the
+        # clients, like servers dropping idle connections.
+        self.drop_connections = False
+        # Method, path, time, and client port of all requests.
+        self.requests = []
+        self.inventory = Inventory(networks=[Network(code=network, stations=[
+            Station(code=code, latitude=lat, longitude=lon, elevation=0,
+                    site=Site(name=code), start_date=T0 - 86400,
+                    channels=[Channel(code=cha, location_code="",
+                                      latitude=lat, longitude=lon,
+                                      elevation=0, depth=0, sample_rate=1.0,
+                                      start_date=T0 - 86400)
+                              for cha in ("BHZ", "BHN", "BHE")])
+            for code, lat, lon in stations])], source="test")
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, code, body=b""):
+                self.send_response(code)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                self.close_connection = provider.drop_connections
+
+            def do_GET(self):
+                provider.requests.append(("GET", self.path, time.time(),
+                                          self.client_address[1]))
+                time.sleep(provider.delay)
+                buf = io.StringIO()
+                provider.inventory.write(buf, format="STATIONTXT",
+                                         level="channel")
+                self.reply(200, buf.getvalue().encode())
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode()
+                provider.requests.append(("POST", self.path, time.time(),
+                                          self.client_address[1]))
+                lines = [_i.split() for _i in body.splitlines()
+                         if _i and "=" not in _i]
+                if "dataselect" in self.path:
+                    time.sleep(provider.data_delay)
+                    if provider.failures:
+                        provider.failures -= 1
+                        self.reply(503, b"Service unavailable")
+                    else:
+                        self.reply(*provider.get_waveforms(lines))
+                else:
+                    time.sleep(provider.delay)
+                    self.reply(200, provider.get_stationxml(lines))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%i" % self.server.server_port
+
+    def client(self):
+        return Client(self.url, _discover_services=False)
+
+    def get_waveforms(self, lines):
+        st = obspy.Stream()
+        for net, sta, loc, cha, start, end in lines:
+            if sta in self.no_data:
+                continue
+            start, end = obspy.UTCDateTime(start), obspy.UTCDateTime(end)
+            tr = obspy.Trace(np.arange(int(end - start), dtype=np.int32))
+            tr.stats.update(dict(network=net, station=sta,
+                                 location="" if loc == "--" else loc,
+                                 channel=cha, starttime=start,
+                                 sampling_rate=1.0))
+            st += tr
+        if not len(st):
+            return 204, b""
+        buf = io.BytesIO()
+        st.write(buf, format="MSEED", reclen=512)
+        return 200, buf.getvalue()
+
+    def get_stationxml(self, lines):
+        wanted = set((_i[0], _i[1]) for _i in lines)
+        inventory = self.inventory.copy()
+        for network in inventory:
+            network.stations = [_i for _i in network
+                                if (network.code, _i.code) in wanted]
+        buf = io.BytesIO()
+        inventory.write(buf, format="STATIONXML")
+        return buf.getvalue()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_provider():
+    """
+    Factory of :class:`FakeProvider` objects that are shut down after the
+    test.
+    """
+    if ThreadingHTTPServer is None:
+        pytest.skip("Requires Python 3.7 or later.")
+    providers = []
+
+    def create(*args, **kwargs):
+        providers.append(FakeProvider(*args, **kwargs))
+        return providers[-1]
+
+    yield create
+    for provider in providers:
+        provider.close()
+
+
+@pytest.fixture
+def mass_download(tmpdir):
+    """
+    Downloads everything the given providers have with the mass downloader
+    to a temporary directory or a directory within it.
+
+    Returns the client download helpers and the relative paths of all
+    written files.
+    """
+    def download(providers, days=1, directory="", **kwargs):
+        return run_mass_downloader(
+            providers, os.path.join(str(tmpdir), directory), days, **kwargs)
+    return download
+
+
+def run_mass_downloader(providers, directory, days=1, **kwargs):
+    from concurrent_downloader.mdl.mass_downloader import (
+        GlobalDomain, MassDownloader, Restrictions)
+    restrictions = Restrictions(
+        starttime=T0, endtime=T0 + days * 86400, chunklength_in_sec=86400,
+        reject_channels_with_gaps=False, minimum_length=0.0,
+        minimum_interstation_distance_in_m=kwargs.pop(
+            "minimum_interstation_distance_in_m", 0))
+    mdl = MassDownloader(providers=[_i.client() for _i in providers])
+    helpers = mdl.download(
+        GlobalDomain(), restrictions,
+        mseed_storage=os.path.join(directory, "waveforms"),
+        stationxml_storage=os.path.join(directory, "stations"),
+        print_report=False, **kwargs)
+    files = sorted(os.path.relpath(os.path.join(_i, _k), directory)
+                   for _i, _, _j in os.walk(directory) for _k in _j)
+    return helpers, files
+
+
+@pytest.fixture
+def discovery(monkeypatch):
+    """
+    Replaces the service discovery of the FDSN clients. Returns the list of
+    base URLs whose services have been discovered. Discovering the services
+    of URLs containing ``slow`` takes a second.
+    """
+    discovered = []
+
+    def discover(self):
+        discovered.append(self.base_url)
+        if "slow" in self.base_url:
+            time.sleep(1.0)
+        self.services = {"dataselect": {"starttime": None},
+                         "station": {"level": None}}
+
+    monkeypatch.setattr(Client, "_discover_services", discover)
+    return discovered
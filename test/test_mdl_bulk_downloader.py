@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the bulk downloader.
+
+Run with ``python -m pytest test`` from the root of the repository.
+"""
+import pickle
+
+from concurrent_downloader.mdl.bulk_downloader import BulkDownloader
+from concurrent_downloader.mdl.mass_downloader import utils
+
+CLIENT = {"base_url": "http://example.com", "user": None, "password": None}
+
+
+def test_client_is_discovered_once(tmpdir, discovery):
+    cache = utils.ServiceCache(directory=str(tmpdir))
+    bdl = BulkDownloader(CLIENT, service_cache=cache)
+    client = bdl.client
+    assert bdl.client is client
+    assert discovery == ["http://example.com"]
+    # Worker processes get a copy of the downloader.
+    copy = pickle.loads(pickle.dumps(bdl))
+    assert copy.client.services == client.services
+    # Another run.
+    other = BulkDownloader(CLIENT, service_cache=utils.ServiceCache(
+        directory=str(tmpdir)))
+    assert other.client is not client
+    assert other.client.services == client.services
+    assert discovery == ["http://example.com"]
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the download helpers of the mass downloader.
+
+Run with ``python -m pytest test`` from the root of the repository.
+"""
+import io
+import itertools
+import logging
+import os
+
+import numpy as np
+import obspy
+import pytest
+
+from concurrent_downloader.mdl.mass_downloader import (
+    Restrictions, download_helpers, utils)
+from concurrent_downloader.mdl.mass_downloader.download_helpers import (
+    STATUS, Channel, ClientDownloadHelper, Station, TimeInterval,
+    TimeIntervals)
+
+logger = logging.getLogger("test_mdl_download_helpers")
+
+T0 = obspy.UTCDateTime(2020, 1, 1)
+
+
+def get_station(network="AA", station="A", channels=("BHZ", "BHN"),
+                hours=2, latitude=0.0, longitude=0.0):
+    return Station(network, station, latitude, longitude, [
+        Channel("", _c, [TimeInterval(T0 + _i * 3600, T0 + (_i + 1) * 3600)
+                         for _i in range(hours)])
+        for _c in channels])
+
+
+def get_helper(mseed_storage, stations=(), **kwargs):
+    helper = ClientDownloadHelper(
+        client=None, client_name="test", restrictions=None, domain=None,
+        mseed_storage=mseed_storage, stationxml_storage=None, logger=logger,
+        **kwargs)
+    for station in stations:
+        helper.stations[(station.network, station.station)] = station
+    return helper
+
+
+def test_prepare_mseed_download_uses_the_existence_index(tmpdir):
+    directory = str(tmpdir)
+    helper = get_helper(directory, [get_station()])
+    helper.prepare_mseed_download()
+    channels = helper.stations[("AA", "A")].channels
+    filenames = [_i.filename for _i in channels[0].intervals]
+    assert all(_i.startswith(directory) for _i in filenames)
+    assert [_i.status for _i in channels[0].intervals] == \
+        [STATUS.NEEDS_DOWNLOADING] * 2
+
+    open(filenames[1], "wb").close()
+    # The directory has been listed before the file was created.
+    helper.prepare_mseed_download()
+    assert channels[0].intervals[1].status == STATUS.NEEDS_DOWNLOADING
+    assert helper.mseed_files_changed() is False
+    helper.file_index.invalidate()
+    assert helper.mseed_files_changed() is True
+    helper.prepare_mseed_download()
+    assert [_i.status for _i in channels[0].intervals] == \
+        [STATUS.NEEDS_DOWNLOADING, STATUS.EXISTS]
+    assert helper.mseed_files_changed() is False
+
+    os.remove(filenames[1])
+    helper.file_index.discard(filenames[1])
+    assert helper.mseed_files_changed() is True
+
+
+def test_prepare_mseed_download_shares_the_index(tmpdir):
+    index = utils.FileExistenceIndex()
+    a = get_helper(str(tmpdir), [get_station()], file_index=index)
+    b = get_helper(str(tmpdir), [get_station()], file_index=index)
+    a.prepare_mseed_download()
+    filename = a.stations[("AA", "A")].channels[0].intervals[0].filename
+    # Written by the first client through its file pool.
+    pool = utils.FileHandlePool(buffer_size=1, file_index=index)
+    pool.write(filename, b"abc")
+    pool.close_all()
+    b.prepare_mseed_download()
+    assert b.stations[("AA", "A")].channels[0].intervals[0].status == \
+        STATUS.EXISTS
+
+
+def test_time_intervals_views_modify_the_store():
+    channel = Channel("", "BHZ", [
+        TimeInterval(T0, T0 + 10, filename="a", status=STATUS.EXISTS),
+        TimeInterval(T0 + 10, T0 + 20)])
+    intervals = channel.intervals
+    assert len(intervals) == 2
+    assert intervals.filenames == ["a", None]
+    assert [_i.status for _i in intervals] == [STATUS.EXISTS, STATUS.NONE]
+    assert intervals[-1].end == T0 + 20
+
+    interval = intervals[1]
+    interval.status = STATUS.DOWNLOADED
+    interval.filename = "b"
+    interval.end = T0 + 15
+    assert intervals[1] == TimeInterval(T0 + 10, T0 + 15, filename="b",
+                                        status=STATUS.DOWNLOADED)
+    assert intervals.has_status(STATUS.DOWNLOADED)
+    assert not intervals.has_status(STATUS.IGNORE)
+    assert [_i.filename for _i in intervals.with_status(STATUS.EXISTS)] == \
+        ["a"]
+    assert intervals.status_counts() == {STATUS.EXISTS: 1,
+                                         STATUS.DOWNLOADED: 1}
+    assert channel.temporal_bounds == (T0, T0 + 15)
+
+
+def test_time_intervals_copy_shared_times_on_write():
+    starts = np.array([T0.ns, (T0 + 10).ns])
+    ends = np.array([(T0 + 10).ns, (T0 + 20).ns])
+    a = TimeIntervals(starts, ends, shared=True)
+    b = TimeIntervals(starts, ends, shared=True)
+    assert a.starts is b.starts
+    a[0].start = T0 + 5
+    assert a[0].start == T0 + 5
+    assert b[0].start == T0
+    assert starts[0] == T0.ns
+    # Statuses and filenames are never shared.
+    a[1].status = STATUS.IGNORE
+    a.set_filenames(["x", "y"])
+    assert b[1].status == STATUS.NONE
+    assert b.filenames == [None, None]
+    with pytest.raises(ValueError):
+        a.set_filenames(["x"])
+    with pytest.raises(IndexError):
+        a[2]
+
+
+def get_random_stations(seed, count, network="AA"):
+    rs = np.random.RandomState(seed)
+    return [get_station(network, "S%03i" % _i, channels=("BHZ",), hours=1,
+                        latitude=rs.uniform(10, 11),
+                        longitude=rs.uniform(10, 11))
+            for _i in range(count)]
+
+
+def reference_filter_with_existing(stations, existing, minimum_distance):
+    """
+    The original iterative implementation of the filter against existing
+    stations.
+    """
+    stations = sorted(stations, key=lambda x: (x.network, x.station))
+    existing = list(existing)
+    remaining = []
+    while stations:
+        distances = utils.SphericalNearestNeighbour(existing).query(
+            stations)[0]
+        keep = np.where(distances >= minimum_distance)[0]
+        if not len(keep):
+            break
+        largest = keep[np.argmax(distances[keep])]
+        remaining.append(stations[largest])
+        existing.append(stations[largest])
+        stations = [stations[_i] for _i in keep if _i != largest]
+    return remaining
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_minimum_distance_filter_with_existing_stations(tmpdir, seed):
+    minimum_distance = 10000
+    stations = get_random_stations(seed, 300)
+    existing = get_helper(str(tmpdir), get_random_stations(seed + 100, 20,
+                                                           network="BB"))
+    helper = get_helper(str(tmpdir), stations)
+    helper.restrictions = Restrictions(
+        starttime=T0, endtime=T0 + 3600,
+        minimum_interstation_distance_in_m=minimum_distance)
+
+    expected = reference_filter_with_existing(
+        stations, existing.stations.values(), minimum_distance)
+    rejected = helper.filter_stations_based_on_minimum_distance([existing])
+    assert sorted(helper.stations) == sorted(
+        (_i.network, _i.station) for _i in expected)
+    assert len(rejected) + len(helper.stations) == len(stations)
+
+    # All remaining stations keep the minimum distance to each other and to
+    # the existing ones.
+    count = len(helper.stations)
+    tree = utils.SphericalNearestNeighbour(
+        list(helper.stations.values()) + list(existing.stations.values()))
+    assert all(_i >= count for _i in itertools.chain.from_iterable(
+        tree.query_pairs(minimum_distance)))
+
+
+def test_minimum_distance_filter_without_existing_stations(tmpdir):
+    minimum_distance = 10000
+    stations = get_random_stations(0, 300)
+    helper = get_helper(str(tmpdir), stations)
+    helper.restrictions = Restrictions(
+        starttime=T0, endtime=T0 + 3600,
+        minimum_interstation_distance_in_m=minimum_distance)
+    rejected = helper.filter_stations_based_on_minimum_distance([])
+    assert rejected and helper.stations
+    assert len(rejected) + len(helper.stations) == len(stations)
+    tree = utils.SphericalNearestNeighbour(list(helper.stations.values()))
+    assert not tree.query_pairs(minimum_distance)
+
+
+def get_qc_records():
+    """
+    Two hours of data of three channels, each hour in its own records. The
+    BHN channel has a gap in the first hour, the BHE channel only has 30
+    minutes of data in the first hour and nothing in the second one. The
+    second hour starts a second late so no record starts at the boundary.
+    """
+    st = obspy.Stream()
+    for channel, hour, offset, npts in (
+            ("BHZ", 0, 0, 3600), ("BHZ", 1, 1, 3598),
+            ("BHN", 0, 0, 1000), ("BHN", 0, 1200, 2400),
+            ("BHN", 1, 1, 3598), ("BHE", 0, 0, 1800)):
+        tr = obspy.Trace(np.arange(npts, dtype=np.int32))
+        tr.stats.update(dict(network="AA", station="A", channel=channel,
+                             sampling_rate=1.0,
+                             starttime=T0 + hour * 3600 + offset))
+        st += tr
+    buf = io.BytesIO()
+    st.write(buf, format="MSEED", reclen=512)
+    return buf.getvalue()
+
+
+def run_qc(directory, inline, processes=1):
+    """
+    Split the QC records into the files of a helper and run its QC.
+    """
+    helper = get_helper(directory, [get_station(
+        channels=("BHZ", "BHN", "BHE"))])
+    helper.restrictions = Restrictions(
+        starttime=T0, endtime=T0 + 7200, reject_channels_with_gaps=True,
+        minimum_length=0.9)
+    helper.prepare_mseed_download()
+    chunks = [("AA", "A", "", _c.channel, _i.start, _i.end, _i.filename)
+              for _c in helper.stations[("AA", "A")].channels
+              for _i in _c.intervals]
+    splitter = utils.MseedBulkSplitter(
+        chunks, qc=helper._check_mseed_file if inline else None)
+    splitter.split(io.BytesIO(get_qc_records()))
+    splitter.close()
+    nbytes = helper._check_downloaded_data(processes=processes)
+    statuses = dict((_c.channel, [_i.status for _i in _c.intervals])
+                    for _c in helper.stations[("AA", "A")].channels)
+    files = sorted(os.path.relpath(os.path.join(_i, _k), directory)
+                   for _i, _, _j in os.walk(directory) for _k in _j)
+    return statuses, nbytes, files
+
+
+def test_inline_qc_matches_reading_the_files(tmpdir):
+    statuses, nbytes, files = run_qc(str(tmpdir.mkdir("a")), inline=True)
+    assert statuses == {
+        "BHZ": [STATUS.DOWNLOADED, STATUS.DOWNLOADED],
+        "BHN": [STATUS.DOWNLOAD_REJECTED, STATUS.DOWNLOADED],
+        "BHE": [STATUS.DOWNLOAD_REJECTED, STATUS.DOWNLOAD_FAILED]}
+    assert len(files) == 3
+    assert nbytes[0] == sum(os.path.getsize(os.path.join(str(tmpdir), "a",
+                                                         _i))
+                            for _i in files)
+    assert nbytes[1] > 0
+    assert run_qc(str(tmpdir.mkdir("b")), inline=False) == \
+        (statuses, nbytes, files)
+
+
+def test_parallel_qc_matches_serial_qc(tmpdir, monkeypatch):
+    serial = run_qc(str(tmpdir.mkdir("a")), inline=False)
+    scans = []
+    scan = ClientDownloadHelper._scan_mseed_files
+
+    def wrapper(self, filenames, processes=None):
+        scans.append(scan(self, filenames, processes=processes))
+        return scans[-1]
+
+    monkeypatch.setattr(download_helpers, "PARALLEL_QC_THRESHOLD", 1)
+    monkeypatch.setattr(ClientDownloadHelper, "_scan_mseed_files", wrapper)
+    assert run_qc(str(tmpdir.mkdir("b")), inline=False, processes=2) == \
+        serial
+    # All six files have been read by the pool, including the missing one.
+    assert len(scans[0]) == 6
+    assert sum(_i[0] is None for _i in scans[0].values()) == 1
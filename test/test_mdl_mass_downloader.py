@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the mass downloader running against the fake FDSN web services
+of ``conftest.py``.
+
+Run with ``python -m pytest test`` from the root of the repository.
+"""
+import logging
+import os
+import threading
+import time
+
+import obspy
+import pytest
+
+from concurrent_downloader.mdl.mass_downloader import (
+    GlobalDomain, Restrictions, utils)
+from concurrent_downloader.mdl.mass_downloader.download_helpers import (
+    STATUS, Channel, ClientDownloadHelper, Station, TimeInterval)
+from concurrent_downloader.mdl.mass_downloader.mass_downloader import \
+    MassDownloader
+
+logger = logging.getLogger("test_mdl_mass_downloader")
+
+T0 = obspy.UTCDateTime(2020, 1, 1)
+
+
+class Helper(object):
+    def __init__(self, is_availability_reliable=True):
+        self.is_availability_reliable = is_availability_reliable
+
+
+def get_stations(network, *coordinates):
+    return dict(((network, "S%02i" % _i), Station(
+        network, "S%02i" % _i, lat, lon,
+        [Channel("", "BHZ", [TimeInterval(T0, T0 + 3600)])]))
+        for _i, (lat, lon) in enumerate(coordinates))
+
+
+def merge(a, b):
+    a = dict(a)
+    a.update(b)
+    return a
+
+
+def count_planning(monkeypatch):
+    calls = []
+    plan = MassDownloader._plan_client_download
+
+    def wrapper(self, helper, *args, **kwargs):
+        calls.append(helper.client_name)
+        return plan(self, helper, *args, **kwargs)
+
+    monkeypatch.setattr(MassDownloader, "_plan_client_download", wrapper)
+    return calls
+
+
+def test_plan_is_outdated_only_if_the_dropped_stations_matter():
+    restrictions = Restrictions(starttime=T0, endtime=T0 + 3600,
+                                minimum_interstation_distance_in_m=50000)
+    snapshot = get_stations("AA", (0, 0), (10, 0), (20, 0))
+    dropped = dict(_i for _i in snapshot.items() if _i[0][1] != "S01")
+    available = get_stations("BB", (0, 50), (30, 50))
+    outdated = MassDownloader._is_plan_outdated
+
+    assert not outdated(Helper(), available, snapshot, snapshot,
+                        restrictions)
+    # Far away from all stations of the planned client.
+    assert not outdated(Helper(), available, snapshot, dropped, restrictions)
+    # The planned client could download the dropped station itself.
+    assert outdated(Helper(), merge(available, {("AA", "S01"): None}),
+                    snapshot, dropped, restrictions)
+    # The dropped station might have rejected a station.
+    close = merge(available, get_stations("CC", (10.1, 0)))
+    assert outdated(Helper(), close, snapshot, dropped, restrictions)
+    # Without reliable availability the filter is not part of the planning.
+    assert not outdated(Helper(False), close, snapshot, dropped,
+                        restrictions)
+    # Stations are never added but better safe than sorry.
+    assert outdated(Helper(), available, dropped, snapshot, restrictions)
+
+
+def test_stations_without_data_do_not_outdate_the_plan(
+        fake_provider, mass_download, monkeypatch):
+    calls = count_planning(monkeypatch)
+    a = fake_provider("AA", [("S00", 0, 0), ("S01", 10, 0)],
+                      no_data=["S01"])
+    b = fake_provider("BB", [("S00", 0, 50), ("S01", 10, 50)])
+    _, files = mass_download([a, b])
+    assert calls == [a.url, b.url]
+    assert files == sorted(
+        ["stations/%s.xml" % _i for _i in ("AA.S00", "BB.S00", "BB.S01")] +
+        ["waveforms/%s..%s__20200101T000000Z__20200102T000000Z.mseed" %
+         (_i, _j) for _i in ("AA.S00", "BB.S00", "BB.S01")
+         for _j in ("BHE", "BHN", "BHZ")])
+
+
+def test_stations_without_data_are_planned_again(
+        fake_provider, mass_download, monkeypatch):
+    calls = count_planning(monkeypatch)
+    a = fake_provider("AA", [("S00", 0, 0), ("S01", 10, 0)],
+                      no_data=["S01"])
+    b = fake_provider("AA", [("S01", 10, 0)])
+    helpers, files = mass_download([a, b])
+    assert calls == [a.url, b.url, b.url]
+    assert list(helpers[b.url].stations) == [("AA", "S01")]
+    assert "stations/AA.S01.xml" in files
+    assert len(files) == 8
+
+
+def test_availability_is_requested_concurrently(fake_provider, mass_download):
+    providers = [fake_provider(_i, [("S00", 0, _j * 10)], delay=0.5)
+                 for _j, _i in enumerate(("AA", "BB", "CC"))]
+    _, files = mass_download(providers)
+    starts = [_j[2] for _i in providers for _j in _i.requests
+              if _j[0] == "GET"]
+    assert len(starts) == 3
+    assert max(starts) - min(starts) < 0.4
+    assert len(files) == 12
+
+
+def get_statuses(helpers):
+    return dict((_k, dict((_i, (
+        _j.stationxml_status,
+        [_l.status for _k in _j.channels for _l in _k.intervals]))
+        for _i, _j in _v.stations.items()))
+        for _k, _v in helpers.items())
+
+
+def test_overlapping_stationxml_downloads(fake_provider, mass_download):
+    provider = fake_provider("AA", [("S%02i" % _i, _i * 10, 0)
+                                    for _i in range(4)],
+                             no_data=["S02"], delay=0.2, data_delay=0.05)
+    kwargs = dict(days=2, download_chunk_size_in_mb=0.001,
+                  threads_per_client=1)
+    sequential, expected = mass_download([provider], directory="a",
+                                         **kwargs)
+    del provider.requests[:]
+    overlapping, files = mass_download([provider], directory="b",
+                                       overlap_stationxml=True, **kwargs)
+    assert files == expected
+    assert len(files) == 3 * 7
+    assert get_statuses(overlapping) == get_statuses(sequential)
+
+    # The first StationXML file is requested while MiniSEED data is still
+    # being downloaded.
+    stations = [_i[2] for _i in provider.requests
+                if _i[0] == "POST" and "station" in _i[1]]
+    waveforms = [_i[2] for _i in provider.requests
+                 if _i[0] == "POST" and "dataselect" in _i[1]]
+    assert len(waveforms) == 4 * 3 * 2
+    assert min(stations) < max(waveforms)
+
+
+def test_asyncio_engine(fake_provider, mass_download, monkeypatch):
+    pytest.importorskip("aiohttp")
+    threads = []
+    check = ClientDownloadHelper._check_mseed_file
+
+    def wrapper(self, *args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return check(self, *args, **kwargs)
+
+    monkeypatch.setattr(ClientDownloadHelper, "_check_mseed_file", wrapper)
+    stations = [("S%02i" % _i, _i * 10, 0) for _i in range(3)]
+    provider = fake_provider("AA", stations, no_data=["S01"], failures=1)
+    helpers, files = mass_download([provider], days=2, directory="a",
+                                   engine="asyncio")
+    # The QC did not block the event loop.
+    assert len(threads) == 12
+    assert all(_i.startswith("asyncio") for _i in threads)
+    expected = mass_download([fake_provider("AA", stations,
+                                            no_data=["S01"])],
+                             days=2, directory="b")[1]
+    assert files == expected
+    assert len(files) == 2 * 7
+    statuses = get_statuses(helpers)[provider.url]
+    assert statuses[("AA", "S00")] == (
+        STATUS.DOWNLOADED, [STATUS.DOWNLOADED] * 6)
+    assert statuses[("AA", "S02")] == (
+        STATUS.DOWNLOADED, [STATUS.DOWNLOADED] * 6)
+    # The failed request has been retried.
+    assert provider.failures == 0
+
+
+def test_asyncio_engine_unsupported_options(fake_provider, tmpdir):
+    pytest.importorskip("aiohttp")
+    provider = fake_provider("AA", [("S00", 0, 0)])
+    restrictions = Restrictions(starttime=T0, endtime=T0 + 3600)
+    kwargs = dict(domain=GlobalDomain(), restrictions=restrictions,
+                  mseed_storage=str(tmpdir), stationxml_storage=str(tmpdir),
+                  engine="asyncio")
+    mdl = MassDownloader(providers=[provider.client()])
+    with pytest.raises(ValueError, match="max_threads_per_client"):
+        mdl.download(max_threads_per_client=10, **kwargs)
+    mdl = MassDownloader(
+        providers=[provider.client()], connection_pool=utils.ConnectionPool(
+            rate_limiter=utils.RateLimiter(requests_per_second=10)))
+    with pytest.raises(ValueError, match="rate limiter"):
+        mdl.download(**kwargs)
+    assert not os.listdir(str(tmpdir))
+
+
+def test_initialize_clients_from_the_service_cache(tmpdir, discovery):
+    urls = ["http://a.example.com", "http://b.example.com"]
+    cache = utils.ServiceCache(directory=str(tmpdir))
+    mdl = MassDownloader(providers=urls, service_cache=cache)
+    assert list(mdl._initialized_clients) == urls
+    assert sorted(discovery) == urls
+    mdl = MassDownloader(providers=urls[::-1], service_cache=cache)
+    assert list(mdl._initialized_clients) == urls[::-1]
+    assert len(discovery) == 2
+
+
+def test_initialize_clients_timeout(tmpdir, discovery):
+    urls = ["http://slow.example.com", "http://fast.example.com"]
+    start = time.time()
+    mdl = MassDownloader(providers=urls, init_timeout=0.3,
+                         service_cache=utils.ServiceCache(
+                             directory=str(tmpdir)))
+    assert time.time() - start < 0.9
+    assert list(mdl._initialized_clients) == urls[1:]
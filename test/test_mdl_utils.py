@@ -0,0 +1,746 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the utilities of the mass downloader.
+
+Run with ``python -m pytest test`` from the root of the repository.
+"""
+import collections
+import io
+import itertools
+import logging
+import os
+import pickle
+import time
+
+import numpy as np
+import obspy
+import pytest
+from obspy.clients.fdsn.header import (FDSNBadRequestException,
+                                       FDSNRequestTooLargeException,
+                                       FDSNServiceUnavailableException)
+
+from concurrent_downloader.mdl.mass_downloader import utils
+
+logger = logging.getLogger("test_mdl_utils")
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Like a real one it takes a little longer.
+        self.now += seconds + 1e-6
+
+
+def get_streams():
+    t = obspy.UTCDateTime(2020, 1, 1, 0, 0, 0, 5000)
+    rs = np.random.RandomState(42)
+
+    def trace(station, channel, starttime, npts, sampling_rate=20.0,
+              dtype=np.int32):
+        tr = obspy.Trace(rs.randint(-1000, 1000, npts).astype(dtype))
+        tr.stats.update(dict(network="AA", station=station, channel=channel,
+                             starttime=starttime,
+                             sampling_rate=sampling_rate))
+        return tr
+
+    return {
+        "single": (obspy.Stream([trace("A", "BHZ", t, 20000)]), {}),
+        "gap": (obspy.Stream([trace("A", "BHZ", t, 5000),
+                              trace("A", "BHZ", t + 600, 5000)]), {}),
+        "channels": (obspy.Stream([
+            trace("A", "BHZ", t, 3000), trace("A", "BHN", t, 3000),
+            trace("B", "HHZ", t + 10, 30000, 100.0)]), {}),
+        "float": (obspy.Stream([
+            trace("A", "LHZ", t, 4000, 1.0, np.float32)]),
+            {"encoding": "FLOAT32"}),
+        "reclen": (obspy.Stream([trace("A", "BHZ", t, 20000)]),
+                   {"reclen": 4096}),
+    }
+
+
+@pytest.mark.parametrize("name", sorted(get_streams()))
+def test_scanner_matches_obspy(tmpdir, name):
+    st, kwargs = get_streams()[name]
+    filename = os.path.join(str(tmpdir), "%s.mseed" % name)
+    kwargs.setdefault("reclen", 512)
+    st.write(filename, format="MSEED", **kwargs)
+
+    headers = utils.scan_mseed_headers(filename)
+    assert len(headers) == os.path.getsize(filename) // kwargs["reclen"]
+
+    expected = [((tr.stats.network, tr.stats.station, tr.stats.location,
+                  tr.stats.channel), tr.stats.starttime.ns,
+                 tr.stats.endtime.ns)
+                for tr in obspy.read(filename, headonly=True)]
+    assert sorted(utils.get_mseed_segments(filename)) == sorted(expected)
+
+
+def get_records(reclen=512):
+    tr = obspy.Trace(np.arange(20000, dtype=np.int32))
+    tr.stats.update(dict(network="AA", station="A", channel="BHZ"))
+    buf = io.BytesIO()
+    tr.write(buf, format="MSEED", reclen=reclen)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("padding", [300, 512, 1000, 3 * 2 ** 20])
+def test_iter_mseed_records_ignores_trailing_padding(padding):
+    data = get_records()
+    fh = io.BytesIO(data + b"\0" * padding)
+    with pytest.warns(UserWarning, match="Ignoring %i bytes" % padding):
+        records = list(utils.iter_mseed_records(fh, block_size=2 ** 16))
+    assert b"".join(_i[-1] for _i in records) == data
+    # Everything has been consumed.
+    assert not fh.read()
+
+
+def test_iter_mseed_records_unparsable_record():
+    data = get_records()
+    # A data record with an invalid day of year.
+    bad = data[:20] + b"\0" * 4 + data[24:512]
+    with pytest.raises(utils.MseedParseError) as e:
+        list(utils.iter_mseed_records(io.BytesIO(data + bad)))
+    # Failed requests are retried and split up, not aborted.
+    assert isinstance(e.value, utils.ERRORS)
+
+
+class FakeResponse(object):
+    """
+    A still open HTTP response returning the data in small pieces. If it
+    is truncated, ``length`` stays positive like for a closed connection.
+    """
+    def __init__(self, data, truncate=None):
+        self.length = len(data)
+        self._fh = io.BytesIO(data[:truncate])
+
+    def read(self, size=-1):
+        data = self._fh.read(min(size, 1000))
+        self.length -= len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class FakeDataselect(object):
+    def __init__(self, data):
+        self.data = data
+
+    def get_waveforms_bulk(self, bulk, filename):
+        with open(filename, "wb") as fh:
+            fh.write(self.data)
+
+
+def get_hourly_chunks(directory, hours=3):
+    t = obspy.UTCDateTime(2020, 1, 1)
+    return [("AA", "A", "", "BHZ", t + _i * 3600, t + (_i + 1) * 3600,
+             os.path.join(directory, "%i.mseed" % _i))
+            for _i in range(hours)]
+
+
+def get_hourly_records():
+    tr = obspy.Trace(np.arange(3 * 3600 * 20, dtype=np.int32))
+    tr.stats.update(dict(network="AA", station="A", channel="BHZ",
+                         sampling_rate=20.0,
+                         starttime=obspy.UTCDateTime(2020, 1, 1)))
+    buf = io.BytesIO()
+    tr.write(buf, format="MSEED", reclen=512)
+    return buf.getvalue()
+
+
+def test_split_stream_matches_temporary_file(tmpdir, monkeypatch):
+    data = get_hourly_records()
+    monkeypatch.setattr(utils, "open_waveforms_bulk_stream",
+                        lambda client, bulk: FakeResponse(data))
+    contents = []
+    for stream in (False, True):
+        directory = str(tmpdir.mkdir(str(stream)))
+        filenames = utils.download_and_split_mseed_bulk(
+            FakeDataselect(data), "test", get_hourly_chunks(directory),
+            logger, stream=stream)
+        assert [os.path.basename(_i) for _i in filenames] == \
+            ["0.mseed", "1.mseed", "2.mseed"]
+        contents.append([open(_i, "rb").read() for _i in filenames])
+    assert contents[0] == contents[1]
+    # Every record ends up in exactly one file.
+    assert sum(len(_i) for _i in contents[1]) == len(data)
+
+
+def test_split_stream_incomplete_response(tmpdir, monkeypatch):
+    data = get_hourly_records()
+    monkeypatch.setattr(
+        utils, "open_waveforms_bulk_stream",
+        lambda client, bulk: FakeResponse(data, truncate=len(data) // 2))
+    with pytest.raises(utils.http_client.IncompleteRead):
+        utils.download_and_split_mseed_bulk(
+            None, "test", get_hourly_chunks(str(tmpdir)), logger,
+            stream=True)
+    # The files of the partial response are deleted.
+    assert tmpdir.listdir() == []
+
+
+def run_window(controller, clock, nbytes=0, error=None):
+    """
+    Send as many requests as the limit allows at once, all taking a second.
+    """
+    count = controller.limit
+    for _ in range(count):
+        controller.acquire()
+    clock.now += 1.0
+    for _ in range(count):
+        controller.release(1.0, nbytes=nbytes, error=error)
+
+
+def test_controller_sustained_congestion_from_cold_start(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils.time, "time", clock)
+    controller = utils.ConcurrencyController(initial=8, maximum=16)
+    limits = []
+    for _ in range(5):
+        run_window(controller, clock,
+                   error=FDSNServiceUnavailableException("503"))
+        limits.append(controller.limit)
+    # Halved once per window, all requests in flight saw the same
+    # congestion.
+    assert limits == [4, 2, 1, 1, 1]
+    assert controller._in_flight == 0
+
+
+def test_controller_grows_only_on_throughput_gains(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils.time, "time", clock)
+    controller = utils.ConcurrencyController(initial=2, maximum=16)
+    # The data center delivers 1 MB/s no matter the number of requests.
+    for _ in range(5):
+        run_window(controller, clock, nbytes=2 ** 20 // controller.limit)
+    # Only the first window grows the limit, there is no previous one to
+    # compare it to.
+    assert controller.limit == 3
+
+
+def test_controller_grows_with_throughput(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils.time, "time", clock)
+    controller = utils.ConcurrencyController(initial=2, maximum=5)
+    for _ in range(5):
+        run_window(controller, clock, nbytes=2 ** 20)
+    assert controller.limit == 5
+
+
+def get_chunks(count):
+    t = obspy.UTCDateTime(2020, 1, 1)
+    return [("AA", "S%02i" % _i, "", "BHZ", t, t + 3600, "S%02i.mseed" % _i)
+            for _i in range(count)]
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    """
+    Replaces the actual download. Requests of more than ``limit`` chunks
+    are too large and requests containing a bad station are rejected.
+    """
+    class Server(object):
+        def __init__(self):
+            self.limit = None
+            self.bad = ()
+            self.requests = []
+
+        def download(self, client, client_name, chunks, logger, **kwargs):
+            self.requests.append(len(chunks))
+            if self.limit is not None and len(chunks) > self.limit:
+                raise FDSNRequestTooLargeException("Too large.")
+            if any(_i[1] in self.bad for _i in chunks):
+                raise FDSNBadRequestException("Bad request.")
+            return [_i[-1] for _i in chunks]
+
+    server = Server()
+    monkeypatch.setattr(utils, "download_and_split_mseed_bulk",
+                        server.download)
+    return server
+
+
+def download_with_retry(chunks):
+    return utils.download_and_split_mseed_bulk_with_retry(
+        None, "test", chunks, logger, retries=2, backoff=0.0)
+
+
+def test_bisect_request_four_times_too_large(requests):
+    requests.limit = 4
+    chunks = get_chunks(16)
+    filenames = download_with_retry(chunks)
+    assert sorted(filenames) == sorted(_i[-1] for _i in chunks)
+    # 16 -> 2 x 8 -> 4 x 4, the rejected requests are not retried.
+    assert requests.requests == [16, 8, 8, 4, 4, 4, 4]
+
+
+def test_bisect_two_bad_stations_in_different_halves(requests):
+    requests.bad = ("S01", "S06")
+    chunks = get_chunks(8)
+    filenames = download_with_retry(chunks)
+    assert sorted(filenames) == sorted(
+        _i[-1] for _i in chunks if _i[1] not in requests.bad)
+
+
+def test_bisect_only_bad_stations(requests):
+    requests.bad = ("S00", "S01")
+    assert download_with_retry(get_chunks(2)) == []
+
+
+def test_interval_index_matches_linear_scan():
+    rs = np.random.RandomState(0)
+    starts = rs.randint(0, 1000, 200)
+    intervals = [{"starttime": int(_i), "endtime": int(_i + _j), "id": _k}
+                 for _k, (_i, _j) in enumerate(
+                     zip(starts, rs.randint(0, 50, 200)))]
+    # A few long intervals hiding behind shorter later ones.
+    intervals += [{"starttime": 10, "endtime": 900, "id": 200},
+                  {"starttime": 500, "endtime": 501, "id": 201}]
+    index = utils.IntervalIndex(intervals)
+    assert len(index) == len(intervals)
+    for time in list(range(-5, 1100)) + [10, 900, 500, 501]:
+        expected = sorted(_i["id"] for _i in intervals
+                          if _i["starttime"] <= time <= _i["endtime"])
+        assert sorted(_i["id"] for _i in index.query(time)) == expected
+
+
+def test_interval_index_empty():
+    assert utils.IntervalIndex([]).query(0) == []
+
+
+def test_file_handle_pool_reopens_evicted_files_in_append_mode(tmpdir):
+    pool = utils.FileHandlePool(max_open_files=2, buffer_size=1)
+    filenames = [os.path.join(str(tmpdir), "sub", "%i.mseed" % _i)
+                 for _i in range(5)]
+    # A stale file from an earlier run is overwritten.
+    os.makedirs(os.path.dirname(filenames[0]))
+    with open(filenames[0], "wb") as fh:
+        fh.write(b"old")
+    for round in range(3):
+        for i, filename in enumerate(filenames):
+            pool.write(filename, b"%i%i" % (round, i))
+            assert len(pool._handles) <= 2
+    pool.close(filenames)
+    for i, filename in enumerate(filenames):
+        with open(filename, "rb") as fh:
+            assert fh.read() == b"0%i1%i2%i" % (i, i, i)
+    # Closed files are forgotten, the bookkeeping does not grow.
+    assert not pool._opened and not pool._handles and not pool._buffers
+
+
+def test_file_handle_pool_buffers_and_discards(tmpdir):
+    filename = os.path.join(str(tmpdir), "a.mseed")
+    pool = utils.FileHandlePool(buffer_size=10)
+    pool.write(filename, b"12345")
+    # Still buffered, nothing has been created yet.
+    assert not os.path.exists(filename)
+    pool.write(filename, b"67890")
+    assert os.path.exists(filename)
+    pool.discard([filename])
+    assert not os.path.exists(filename)
+    pool.write(filename, b"abc")
+    pool.close_all()
+    with open(filename, "rb") as fh:
+        assert fh.read() == b"abc"
+
+
+def test_file_existence_index(tmpdir, monkeypatch):
+    directory = str(tmpdir)
+    a, b = os.path.join(directory, "a"), os.path.join(directory, "b")
+    open(a, "wb").close()
+    index = utils.FileExistenceIndex()
+    assert index.exists_many([a, b, os.path.join(directory, "x", "c")]) == \
+        [True, False, False]
+    # Listed once, later changes are not seen.
+    open(b, "wb").close()
+    assert not index.exists(b)
+    index.add(b)
+    assert index.exists(b)
+    index.discard(a)
+    assert not index.exists(a)
+    index.invalidate()
+    assert index.exists(a) and index.exists(b)
+
+    # Only a single listing per directory.
+    calls = []
+    scandir = os.scandir
+    monkeypatch.setattr(utils.os, "scandir",
+                        lambda path: calls.append(path) or scandir(path))
+    index = utils.FileExistenceIndex()
+    index.exists_many([os.path.join(directory, "%i" % _i)
+                       for _i in range(100)])
+    index.exists(a)
+    assert calls == [directory]
+
+
+def test_file_handle_pool_updates_existence_index(tmpdir):
+    filename = os.path.join(str(tmpdir), "a.mseed")
+    index = utils.FileExistenceIndex()
+    assert not index.exists(filename)
+    pool = utils.FileHandlePool(buffer_size=1, file_index=index)
+    pool.write(filename, b"abc")
+    assert index.exists(filename)
+    pool.discard([filename])
+    assert not index.exists(filename)
+
+
+@pytest.mark.parametrize("setting", [
+    "waveforms",
+    "{network}/{station}/{location}.{channel}_{starttime}_{endtime}.mseed",
+    lambda n, s, l, c, st, et: True if s == "B" else
+    "%s.%s.%s.%s.%s.%s" % (n, s, l, c, st, et)])
+def test_mseed_storage_matches_get_mseed_filename(setting):
+    storage = utils.MseedStorage(setting)
+    t = obspy.UTCDateTime(2019, 12, 31, 23, 59, 59, 500000)
+    starts = [t + _i * 3600.5 for _i in range(30)]
+    ends = [_i + 3600.5 for _i in starts]
+    for station in ("A", "B"):
+        filenames = storage.get_filenames(
+            "AA", station, "00", "BHZ", np.array([_i.ns for _i in starts]),
+            np.array([_i.ns for _i in ends]))
+        assert filenames == [
+            utils.get_mseed_filename(setting, "AA", station, "00", "BHZ",
+                                     _s, _e)
+            for _s, _e in zip(starts, ends)]
+
+
+def test_mseed_storage_sds():
+    storage = utils.MseedStorage(utils.SDS_KEY + "/archive")
+    starts = [obspy.UTCDateTime(2020, 12, 30) + _i * 86400
+              for _i in range(4)]
+    filenames = storage.get_filenames(
+        "AA", "A", "", "BHZ", np.array([_i.ns for _i in starts]),
+        np.array([(_i + 86400).ns for _i in starts]))
+    assert filenames == [
+        utils.get_mseed_sdsfilename("/archive", "AA", "A", "", "BHZ",
+                                    _i.year, _i.julday) for _i in starts]
+    assert filenames[-1] == "/archive/2021/AA/A/BHZ.D/AA.A..BHZ.D.2021.002"
+
+
+def test_mseed_storage_invalid_function_result():
+    storage = utils.MseedStorage(lambda *args: 1)
+    with pytest.raises(TypeError):
+        storage.get_filenames("AA", "A", "", "BHZ", np.array([0]),
+                              np.array([1]))
+
+
+def reference_vertex_cover(pairs):
+    """
+    The original implementation :func:`utils.greedy_vertex_cover` replaced.
+    """
+    pairs = [tuple(_i) for _i in pairs]
+    removed = []
+    while pairs:
+        most_common = collections.Counter(
+            itertools.chain.from_iterable(pairs)).most_common()[0][0]
+        removed.append(most_common)
+        pairs = [_i for _i in pairs if most_common not in _i]
+    return removed
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_greedy_vertex_cover_matches_reference(seed):
+    rs = np.random.RandomState(seed)
+    count = rs.randint(2, 60)
+    pairs = set()
+    for _ in range(rs.randint(0, 200)):
+        a, b = sorted(rs.choice(count, 2, replace=False).tolist())
+        pairs.add((a, b))
+    pairs = sorted(pairs, key=lambda x: rs.rand())
+    removed = utils.greedy_vertex_cover(np.array(pairs).reshape(-1, 2),
+                                        count)
+    assert removed == reference_vertex_cover(pairs)
+    # No edge is left.
+    assert all(a in removed or b in removed for a, b in pairs)
+
+
+def get_client_ports(provider, pool=None, count=3):
+    client = provider.client()
+    if pool is not None:
+        utils.enable_keep_alive(client, pool)
+    del provider.requests[:]
+    for _ in range(count):
+        client.get_stations(network="AA", level="station", format="text")
+    return [_i[3] for _i in provider.requests]
+
+
+def test_connection_pool_reuses_connections(fake_provider):
+    provider = fake_provider("AA", [("S00", 0, 0)])
+    assert len(set(get_client_ports(provider))) == 3
+    pool = utils.ConnectionPool()
+    assert len(set(get_client_ports(provider, pool))) == 1
+    # Shared by another client of the same data center.
+    ports = get_client_ports(provider, pool)
+    assert len(set(ports)) == 1
+    assert get_client_ports(provider, pool) == ports
+    pool.close()
+    assert get_client_ports(provider, pool) != ports
+
+
+def test_connection_pool_without_idle_connections(fake_provider):
+    provider = fake_provider("AA", [("S00", 0, 0)])
+    pool = utils.ConnectionPool(max_idle_per_host=0)
+    assert len(set(get_client_ports(provider, pool))) == 3
+
+
+def test_connection_pool_reconnects_closed_connections(fake_provider):
+    provider = fake_provider("AA", [("S00", 0, 0)])
+    pool = utils.ConnectionPool()
+    provider.drop_connections = True
+    ports = get_client_ports(provider, pool, count=3)
+    assert len(set(ports)) == 3
+    assert len(pool._idle[("http", "127.0.0.1:%i" %
+                           provider.server.server_port)]) == 1
+
+
+def test_connection_pool_pickles_without_connections(fake_provider):
+    provider = fake_provider("AA", [("S00", 0, 0)])
+    pool = utils.ConnectionPool(max_idle_per_host=4)
+    get_client_ports(provider, pool, count=1)
+    assert pool._idle
+    copy = pickle.loads(pickle.dumps(pool))
+    assert copy.max_idle_per_host == 4
+    assert not copy._idle
+
+
+def test_service_cache(tmpdir, discovery):
+    directory = os.path.join(str(tmpdir), "services")
+    cache = utils.ServiceCache(directory=directory)
+    client = cache.get_client("http://example.com")
+    assert discovery == ["http://example.com"]
+    assert len(os.listdir(directory)) == 1
+    # Another run.
+    other = utils.ServiceCache(directory=directory).get_client(
+        "http://example.com", user="a", password="b")
+    assert discovery == ["http://example.com"]
+    assert other.services == client.services
+    utils.ServiceCache(directory=directory).get_client("http://example.org")
+    assert discovery == ["http://example.com", "http://example.org"]
+    assert len(os.listdir(directory)) == 2
+
+    # Expired.
+    del discovery[:]
+    assert not cache.is_expired(client)
+    os.utime(cache._get_filename(client), (0, 0))
+    assert cache.is_expired(client)
+    assert cache.get(client) is None
+    cache.get_client("http://example.com")
+    assert discovery == ["http://example.com"]
+    assert not cache.is_expired(client)
+
+    # Broken entries are discovered again.
+    with open(cache._get_filename(client), "wb") as fh:
+        fh.write(b"abc")
+    cache.get_client("http://example.com")
+    assert discovery == ["http://example.com"] * 2
+
+
+def test_service_cache_disabled(tmpdir, discovery):
+    directory = os.path.join(str(tmpdir), "services")
+    cache = utils.ServiceCache(directory=directory, ttl=0)
+    cache.get_client("http://example.com")
+    cache.get_client("http://example.com")
+    assert discovery == ["http://example.com"] * 2
+    assert not os.path.exists(directory)
+
+
+def test_service_cache_revalidate(tmpdir, discovery):
+    cache = utils.ServiceCache(directory=str(tmpdir), revalidate=True)
+    client = cache.get_client("http://example.com")
+    filename = cache._get_filename(client)
+    os.utime(filename, (0, 0))
+    # The expired entry is used and refreshed in the background.
+    assert cache.get_client("http://example.com").services == \
+        client.services
+    for _ in range(100):
+        if not cache.is_expired(client):
+            break
+        time.sleep(0.01)
+    assert not cache.is_expired(client)
+    assert discovery == ["http://example.com"] * 2
+
+
+def get_clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils.time, "time", clock)
+    monkeypatch.setattr(utils.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_rate_limiter_requests(tmpdir, monkeypatch):
+    clock = get_clock(monkeypatch)
+    limiter = utils.RateLimiter(requests_per_second=10,
+                                directory=str(tmpdir))
+    # A full bucket.
+    for _ in range(10):
+        limiter.acquire("a")
+    assert clock.now == 1000.0
+    for _ in range(20):
+        limiter.acquire("a")
+    assert clock.now == pytest.approx(1002.0, abs=0.01)
+    # Every host has its own bucket.
+    now = clock.now
+    limiter.acquire("b")
+    assert clock.now == now
+
+
+def test_rate_limiter_is_shared(tmpdir, monkeypatch):
+    clock = get_clock(monkeypatch)
+    directory = os.path.join(str(tmpdir), "a")
+    # E.g. in another process.
+    a = utils.RateLimiter(requests_per_second=10, directory=directory)
+    b = pickle.loads(pickle.dumps(a))
+    assert b.directory == directory
+    for _ in range(10):
+        a.acquire("a")
+    b.acquire("a")
+    assert clock.now == pytest.approx(1000.1, abs=0.01)
+    now = clock.now
+    # Another directory or other limits.
+    for limiter in (
+            utils.RateLimiter(requests_per_second=10,
+                              directory=os.path.join(str(tmpdir), "b")),
+            utils.RateLimiter(requests_per_second=10,
+                              megabytes_per_second=1, directory=directory)):
+        limiter.acquire("a")
+        assert clock.now == now
+
+
+def test_rate_limiter_bandwidth(tmpdir, monkeypatch):
+    clock = get_clock(monkeypatch)
+    limiter = utils.RateLimiter(megabytes_per_second=1,
+                                directory=str(tmpdir))
+    for _ in range(3):
+        limiter.consume("a", 2 ** 20)
+    assert clock.now == pytest.approx(1002.0, abs=0.01)
+
+
+def test_rate_limiter_bandwidth_is_charged_in_blocks(tmpdir, monkeypatch):
+    clock = get_clock(monkeypatch)
+    limiter = utils.RateLimiter(megabytes_per_second=1,
+                                directory=str(tmpdir))
+    charges = []
+    take = limiter._take
+
+    def wrapper(host, **kwargs):
+        charges.append(kwargs["nbytes"])
+        return take(host, **kwargs)
+
+    monkeypatch.setattr(limiter, "_take", wrapper)
+    size = 3 * 2 ** 20 + 1000
+    fh = utils._CountingReader(
+        io.BytesIO(b"\0" * size),
+        lambda x: limiter.consume("a", x))
+    while fh.read(1000):
+        pass
+    assert len(charges) == 12
+    assert all(_i >= utils.RATE_LIMIT_BLOCK_SIZE for _i in charges[:-1])
+    assert sum(charges) == size
+    assert clock.now == pytest.approx(1002.0, abs=0.01)
+
+    # The rest is charged once the response is closed.
+    del charges[:]
+    fh = utils._CountingReader(io.BytesIO(b"\0" * size),
+                               lambda x: limiter.consume("a", x))
+    fh.read(1000)
+    fh.close()
+    assert charges == [1000]
+
+
+def test_rate_limiter_charges_responses(fake_provider, tmpdir, monkeypatch):
+    provider = fake_provider("AA", [("S%02i" % _i, 0, 0)
+                                    for _i in range(100)])
+    limiter = utils.RateLimiter(requests_per_second=1000,
+                                megabytes_per_second=1000,
+                                directory=str(tmpdir))
+    charges = []
+    consume = limiter.consume
+    monkeypatch.setattr(limiter, "consume", lambda host, nbytes: (
+        charges.append(nbytes), consume(host, nbytes)))
+    client = provider.client()
+    utils.enable_keep_alive(client, utils.ConnectionPool(
+        rate_limiter=limiter))
+    client.get_stations(network="AA", level="channel", format="text")
+    client.get_stations(network="AA", level="channel", format="text")
+    buf = io.StringIO()
+    provider.inventory.write(buf, format="STATIONTXT", level="channel")
+    assert sum(charges) == 2 * len(buf.getvalue().encode())
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_pack_chunks(seed):
+    rs = np.random.RandomState(seed)
+    sizes = list(rs.randint(1, 100, 200))
+    chunks = utils.pack_chunks(range(len(sizes)), sizes, 250, 5)
+    assert list(itertools.chain.from_iterable(chunks)) == \
+        list(range(len(sizes)))
+    for chunk, following in zip(chunks, chunks[1:] + [None]):
+        assert 1 <= len(chunk) <= 5
+        size = sum(sizes[_i] for _i in chunk)
+        if following is None or len(chunk) == 5:
+            continue
+        # Adding the next item would have been further off.
+        assert abs(size + sizes[following[0]] - 250) > abs(size - 250)
+
+
+def test_pack_chunks_large_items():
+    assert utils.pack_chunks("abc", [1, 10, 1], 3, 10) == \
+        [["a"], ["b"], ["c"]]
+    assert utils.pack_chunks("", [], 3, 10) == []
+
+
+def test_mseed_size_estimator(tmpdir, monkeypatch):
+    estimator = utils.MseedSizeEstimator(files_per_channel=2)
+    assert estimator.bytes_per_sample("AA", "A") == \
+        utils.DEFAULT_BYTES_PER_SAMPLE
+    estimator.add("AA", "A", 1000, 1000)
+    estimator.add("AA", "B", 3000, 1000)
+    estimator.add("AA", "C", 1000, 0)
+    assert estimator.bytes_per_sample("AA", "A") == 1.0
+    assert estimator.bytes_per_sample("AA", "B") == 3.0
+    # Stations without observations use all of them.
+    assert estimator.bytes_per_sample("AA", "C") == 2.0
+    assert estimator.estimate("AA", "B", 20.0, 10) == 600.0
+
+    filenames = []
+    for i, size in enumerate((100, 300, 500)):
+        filenames.append(os.path.join(str(tmpdir), "%i.mseed" % i))
+        with open(filenames[-1], "wb") as fh:
+            fh.write(b"\0" * size)
+    index = utils.FileExistenceIndex()
+    index.exists(filenames[0])
+
+    # The sizes come from the directory listing.
+    def getsize(filename):
+        raise AssertionError("Not listed: %s" % filename)
+
+    monkeypatch.setattr(utils.os.path, "getsize", getsize)
+    estimator = utils.MseedSizeEstimator(files_per_channel=2)
+    files = [(os.path.join(str(tmpdir), "missing.mseed"), 10)] + \
+        [(_i, 10) for _i in filenames]
+    estimator.add_files("AA", "A", 10.0, files, file_index=index)
+    # The missing file is skipped and only two files are used.
+    assert estimator.bytes_per_sample("AA", "A") == 2.0
+
+
+def test_file_existence_index_sizes(tmpdir, monkeypatch):
+    filename = os.path.join(str(tmpdir), "a")
+    with open(filename, "wb") as fh:
+        fh.write(b"abc")
+    index = utils.FileExistenceIndex()
+    assert index.getsize(filename) == 3
+    with open(filename, "ab") as fh:
+        fh.write(b"abc")
+    # Cached.
+    assert index.getsize(filename) == 3
+    index.add(filename)
+    assert index.getsize(filename) == 6
+    index.invalidate()
+    assert index.getsize(filename) == 6
+    with pytest.raises(OSError):
+        index.getsize(os.path.join(str(tmpdir), "b"))
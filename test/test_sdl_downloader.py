@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the downloader of continuous data.
+
+Run with ``python -m pytest test`` from the root of the repository.
+"""
+import os
+import warnings
+
+import numpy as np
+import pytest
+from obspy import Stream, Trace, UTCDateTime
+from obspy.core.inventory import (Channel, Inventory, Network, Site,
+                                  Station)
+
+from concurrent_downloader.sdl import downloader
+from concurrent_downloader.sdl import utils2download as u2d
+from concurrent_downloader.sdl.downloader import MseedDownloader
+from concurrent_downloader.sdl.restrictions import (DownloadRestrictions,
+                                                    PreprocRestrictions)
+
+T0 = UTCDateTime(2020, 1, 1)
+
+STORAGE = "{network}/{station}/{network}.{station}.{location}.{channel}" \
+    "__{starttime}__{endtime}.mseed"
+
+
+class FakeClient(object):
+    """
+    Serves one sample per second of the channels BHZ and BHN of a station.
+
+    :param fail: Start times of the chunks whose download fails.
+    :param error: Raised instead of downloading anything.
+    """
+    def __init__(self, fail=(), error=None):
+        self.fail = fail
+        self.error = error
+        self.requests = []
+
+    def get_waveforms(self, network, station, location, channel, starttime,
+                      endtime):
+        self.requests.append((starttime, endtime))
+        if self.error is not None:
+            raise self.error
+        if starttime in self.fail:
+            raise Exception("No data available")
+        st = Stream()
+        for channel in ("BHZ", "BHN"):
+            tr = Trace(np.arange(int(endtime - starttime), dtype=np.int32))
+            tr.stats.update(dict(network="AA", station="A", channel=channel,
+                                 starttime=starttime, sampling_rate=1.0))
+            st += tr
+        return st
+
+
+class FakeStationClient(FakeClient):
+    """
+    Also lists the channels.
+    """
+    def get_stations(self, **kwargs):
+        self.requests.append(kwargs["level"])
+        return Inventory(networks=[Network(code="AA", stations=[Station(
+            code="A", latitude=0, longitude=0, elevation=0,
+            site=Site(name="A"), channels=[Channel(
+                code=_i, location_code="", latitude=0, longitude=0,
+                elevation=0, depth=0, sample_rate=1.0,
+                start_date=T0 - 86400) for _i in ("BHZ", "BHN")])])],
+            source="test")
+
+
+def get_restrictions(hours=4):
+    return DownloadRestrictions(
+        network="AA", station="A", location="*", channel="BH*",
+        starttime=T0, endtime=T0 + hours * 3600, chunklength_in_sec=3600,
+        overlap_in_sec=None, groupby="{network}.{station}.{channel}")
+
+
+def download(directory, client=None, **kwargs):
+    client = client or FakeClient()
+    MseedDownloader(os.path.join(directory, STORAGE), client,
+                    get_restrictions(), **kwargs)
+    files = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            with open(path, "rb") as fh:
+                files[os.path.relpath(path, directory)] = fh.read()
+    return files
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(n_fetchers=3, queue_depth=1),
+    dict(n_processor=2, concurrent_feature="thread"),
+    dict(n_processor=2, concurrent_feature="thread", n_fetchers=2),
+    dict(n_processor=2, concurrent_feature="process", n_fetchers=2)])
+def test_pipeline_matches_serial_download(tmpdir, kwargs):
+    expected = download(str(tmpdir.mkdir("a")))
+    assert len(expected) == 8
+    assert download(str(tmpdir.mkdir("b")), **kwargs) == expected
+
+
+def test_pipeline_skips_failed_chunks(tmpdir):
+    client = FakeClient(fail=[T0 + 3600])
+    with pytest.warns(UserWarning, match="No:"):
+        files = download(str(tmpdir), client, n_fetchers=2)
+    assert len(client.requests) == 4
+    assert len(files) == 6
+    assert not any("T010000Z__" in _i for _i in files)
+
+
+@pytest.mark.parametrize("n_fetchers", [1, 3])
+def test_pipeline_raises_fetcher_errors(tmpdir, n_fetchers):
+    # Nothing can be downloaded and the warning becomes an error in the
+    # fetcher threads.
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        with pytest.raises(UserWarning, match="No:"):
+            download(str(tmpdir), FakeClient(error=Exception("down")),
+                     n_fetchers=n_fetchers, queue_depth=1)
+
+
+def test_skip_existing_chunks(tmpdir):
+    files = download(str(tmpdir))
+    client = FakeStationClient()
+    assert download(str(tmpdir), client, skip_existing=True) == files
+    assert client.requests == ["channel"]
+
+    # An interrupted run.
+    missing = [_i for _i in files if "T020000Z__" in _i]
+    assert len(missing) == 2
+    os.remove(os.path.join(str(tmpdir), missing[0]))
+    client = FakeStationClient()
+    assert download(str(tmpdir), client, skip_existing=True) == files
+    assert client.requests == ["channel", (T0 + 7200, T0 + 10800)]
+
+
+def test_skip_existing_without_get_stations(tmpdir):
+    client = FakeClient()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", UserWarning)
+        assert len(download(str(tmpdir), client, skip_existing=True)) == 8
+    assert len(client.requests) == 4
+
+
+def get_channels(start_date=None, end_date=None):
+    return [{"network": "AA", "station": "A", "location": "",
+             "channel": _i, "sampling_rate": 1.0, "start_date": start_date,
+             "end_date": end_date} for _i in ("BHZ", "BHN")]
+
+
+def test_get_existing_files(tmpdir):
+    directory = str(tmpdir)
+    for channel, start, ppc in (("BHZ", T0, False), ("BHZ", T0 + 3600, True),
+                                ("BHN", T0, False)):
+        open(u2d.get_mseed_filename(
+            _str=directory, network="AA", station="A", location="",
+            channel=channel, starttime=start, endtime=start + 3599,
+            ppc=ppc), "wb").close()
+    open(os.path.join(directory, "AA.A..BHN__2020__2020..mseed"),
+         "wb").close()
+    groups = u2d.get_existing_files(directory, get_channels(), "id", None)
+    assert sorted(groups) == ["AA.A..BHN", "AA.A..BHZ"]
+    for key, (channels, files) in groups.items():
+        assert [_i["channel"] for _i in channels] == [key[-3:]]
+        assert files == [(T0, T0 + 3599)]
+
+    ppc = PreprocRestrictions(seed_ids=["AA.A"])
+    groups = u2d.get_existing_files(directory, get_channels(),
+                                    "{network}.{station}", ppc)
+    assert list(groups) == ["AA.A"]
+    assert len(groups["AA.A"][0]) == 2
+    assert groups["AA.A"][1] == [(T0 + 3600, T0 + 7199)]
+
+
+def test_chunk_exists():
+    channels = get_channels()
+    groups = {"BHZ": (channels[:1], [(T0, T0 + 3599)]),
+              "BHN": (channels[1:], [(T0 + 1, T0 + 3598)])}
+    assert u2d.chunk_exists(groups, T0, T0 + 3600)
+    assert not u2d.chunk_exists(groups, T0 + 3600, T0 + 7200)
+    # More than a sample period and a second off.
+    groups["BHN"] = (channels[1:], [(T0 + 3, T0 + 3599)])
+    assert not u2d.chunk_exists(groups, T0, T0 + 3600)
+    # Files of two chunks or longer belong to other chunks.
+    groups["BHN"] = (channels[1:], [(T0, T0 + 7200)])
+    assert not u2d.chunk_exists(groups, T0, T0 + 3600)
+    # Channels not recording during the chunk do not need any files.
+    groups["BHN"] = (get_channels(end_date=T0 - 1)[1:], [])
+    assert u2d.chunk_exists(groups, T0, T0 + 3600)
+    groups["BHZ"] = (get_channels(start_date=T0 + 7200)[:1], [])
+    assert not u2d.chunk_exists(groups, T0, T0 + 3600)
+    assert not u2d.chunk_exists({}, T0, T0 + 3600)
+
+
+def test_share_stream(monkeypatch):
+    if downloader.shared_memory is None:
+        pytest.skip("Requires Python 3.8 or later.")
+    st = Stream([Trace(np.arange(10, dtype=np.int32),
+                       header=dict(station="A", channel="BHZ")),
+                 Trace(np.linspace(0, 1, 7),
+                       header=dict(station="A", channel="BHN",
+                                   sampling_rate=20.0))])
+    written = []
+
+    def write_stream(st, ppc_restrictions, mseed_storage):
+        written.append((st.copy(), ppc_restrictions, mseed_storage))
+
+    monkeypatch.setattr(u2d, "write_stream", write_stream)
+    shm, headers = downloader.share_stream(st)
+    downloader.run_shared_process(None, "storage", shm.name, headers)
+    downloader.release_shared(shm)
+    with pytest.raises(FileNotFoundError):
+        downloader.shared_memory.SharedMemory(name=shm.name)
+
+    (shared, ppc_restrictions, mseed_storage), = written
+    assert (ppc_restrictions, mseed_storage) == (None, "storage")
+    assert shared == st
+    assert [_i.data.dtype for _i in shared] == [np.int32, np.float64]